@@ -5,11 +5,21 @@ from LiDAR profiles
 Michael Itzkin, 6/28/2021
 """
 
+from Functions import Compact_Functions as cmpfuncs
 from Functions import Data_Functions as dfuncs
+from Functions import Decimate_Functions as decfuncs
+from Functions import Geodesy_Functions as gfuncs
 from Functions import Morpho_Functions as mfuncs
+from Functions import Pipeline_Functions as pipefuncs
 from Functions import Plot_Functions as pfuncs
+from Functions import Raster_Functions as rfuncs
+from Functions import PointCloud_Functions as cfuncs
+from Functions import QC_Functions as qfuncs
+from Functions import Uncertainty_Functions as ufuncs
 
+import numpy as np
 import pandas as pd
+import functools
 import shutil
 import os
 
@@ -17,6 +27,411 @@ import os
 # Set paths to other folders
 DATA_DIR = os.path.join('..', 'Data')
 
+# Set the detection parameters
+SETTINGS = {
+    'grid_size': 0.5,           # Doesn't matter: The gridded profiles aren't used
+    'mhw': 0.34,                # St. Pete = 0.187, NC = 0.34
+    'mhw_pad': 0.5,             # Elevation range (+/-) around MHW to fit
+    'heel_threshold': 0.6,
+    'crest_pct': 0.1,
+    'decimate_tolerance': None,     # Largest vertical error (m) when thinning profiles. None = Off
+    'ensemble_size': 0,         # Monte Carlo members per profile for the uncertainty. 0 = Off
+    'error': ufuncs.error_model(sigma=0.15,              # Vertical LiDAR error (m)
+                                correlation_length=0.0,  # Along-profile error correlation (m)
+                                bias=0.0),               # Survey-wide vertical offset error (m)
+    'percentiles': [2.5, 50, 97.5],
+    'qc_limits': qfuncs.SLOPE_LIMITS,
+    'render': 'flagged',        # Profiles to plot: "all", "flagged" (failed QC), or "none"
+    'alongshore': False,        # Search for the crest and toe near where they are on the last profile
+    'alongshore_window': 10.0,  # Distance (+/-) to search around the last profile's landmarks (m)
+}
+
+# Settings changed to rerun profiles that fail QC
+FALLBACK = {'mhw_pad': 1.0, 'heel_threshold': 0.3,
+            'crest_pct': 0.2, 'decimate_tolerance': None, 'alongshore': False}
+
+
+def load_profile(location, year, profile, settings, data=None):
+    """
+    Load a profile and decimate it if the settings ask for it. Returns
+    the cross-shore distances, elevations, latitudes, longitudes, and
+    the number of points before decimation
+
+    location: String with the location
+    year: String with the year being looked at
+    profile: Int with the profile number
+    settings: Dict with the run settings from main()
+    data: Profile already loaded by cmpfuncs.profile_chunks() (Default: None)
+    """
+
+    # Determine the profile length and interpolate onto a grid
+    # of a pre-defined spacing, unless it was already loaded
+    if data is None:
+        dist_cross, elev_cross, ex, why, lats, lons =\
+            dfuncs.setup_profile(location, year, profile, settings['grid_size'])
+    else:
+        dist_cross, elev_cross, lats, lons = cmpfuncs.profile_arrays(data)
+    num_points = len(elev_cross)
+
+    # Thin out dense profiles while keeping the elevations
+    # within the tolerance and the extrema around MHW and the dunes
+    if settings['decimate_tolerance'] is not None:
+        dist_cross, elev_cross, lats, lons = decfuncs.decimate_profile(
+            dist_cross, elev_cross, lats, lons,
+            settings['decimate_tolerance'], settings['mhw'])
+
+    return dist_cross, elev_cross, lats, lons, num_points
+
+
+def neighbor_prior(morpho, profile, settings):
+    """
+    Return the crest and toe positions of the profile before this one to
+    narrow the searches on this one, or None when the alongshore mode is
+    off, the last profile in the morpho dict isn't the one before this
+    one, or it failed QC
+
+    morpho: Dict with morphometrics
+    profile: Int with the profile number about to be run
+    settings: Dict with the run settings from main()
+    """
+
+    if not settings['alongshore'] or len(morpho['Profile']) == 0 or\
+            morpho['Profile'][-1] != profile - 1:
+        return None
+    if morpho['QC Flag'][-1] & qfuncs.FAILURES:
+        return None
+
+    return mfuncs.alongshore_prior(morpho)
+
+
+def find_dune(morpho, dist_cross, elev_cross, lats, lons, settings, cache, windows):
+    """
+    Find the dune crest, heel, and toe for a profile
+
+    morpho: Dict with morphometrics
+    dist_cross: Array with the cross-shore distance values
+    elev_cross: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    settings: Dict with the run settings from main()
+    cache: Dict from mfuncs.profile_cache()
+    windows: Dict with the (first, last) indices to search for the crest and toe
+    """
+
+    # Identify the dune crest
+    morpho = mfuncs.find_crest(morpho, dist_cross, elev_cross,
+                               lats, lons, settings['mhw'],
+                               settings['heel_threshold'], settings['crest_pct'],
+                               cache=cache, window=windows.get('Crest'))
+
+    # Identify the dune heel
+    morpho = mfuncs.find_heel(morpho, dist_cross, elev_cross,
+                              lats, lons, cache=cache)
+
+    # Identify the dune toe
+    morpho = mfuncs.find_toe(morpho, dist_cross, elev_cross,
+                             lats, lons, cache=cache, window=windows.get('Toe'))
+
+    return morpho
+
+
+def find_morphometrics(morpho, profile, dist_cross, elev_cross, lats, lons,
+                       settings, crossings=None, prior=None):
+    """
+    Find the morphometrics for a profile and add them to the morpho dict
+
+    morpho: Dict with morphometrics
+    profile: Int with the profile number
+    dist_cross: Array with the cross-shore distance values
+    elev_cross: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    settings: Dict with the run settings from main()
+    crossings: Array with the sand fence crossings on the profile (Default: None)
+    prior: Dict with the crest and toe positions on the neighboring
+           profile from neighbor_prior() (Default: None, search the whole profile)
+    """
+
+    mhw = settings['mhw']
+
+    # Store the profile number
+    morpho['Profile'].append(profile)
+
+    # Find the peaks and cumulative area of the profile once. The
+    # detectors share these and the landmark indices they find
+    cache = mfuncs.profile_cache(dist_cross, elev_cross)
+
+    # Identify the MHW contour. This function also calculates
+    # the foreshore slope since the error method for MHW includes
+    # calculating it.
+    morpho = mfuncs.find_mhw(morpho, dist_cross, elev_cross,
+                             lats, lons, mhw, settings['mhw_pad'], cache=cache)
+
+    # Identify the dune crest, heel, and toe. With a prior from the
+    # neighboring profile the crest and toe are only searched for near
+    # where they are on it. The whole profile is searched again if the
+    # landmarks found that way fail QC
+    windows = mfuncs.prior_windows(morpho, dist_cross, prior, settings['alongshore_window'])
+    morpho = find_dune(morpho, dist_cross, elev_cross, lats, lons, settings, cache, windows)
+    flag = qfuncs.PASSED
+    if settings['alongshore']:
+        flag = qfuncs.last_flag(morpho, settings['qc_limits'])
+    if len(windows) > 0 and flag & qfuncs.FAILURES:
+        for col in ['Crest', 'Heel', 'Toe']:
+            morpho = mfuncs.remove_morpho(col, morpho)
+        morpho = find_dune(morpho, dist_cross, elev_cross, lats, lons, settings, cache, {})
+        flag = qfuncs.last_flag(morpho, settings['qc_limits'])
+
+    # Identify the berm
+    morpho = mfuncs.find_berm(morpho, dist_cross, elev_cross,
+                              lats, lons, cache=cache)
+
+    # Identify the sand fence and the fenced dune
+    morpho = mfuncs.find_fence(morpho, dist_cross, elev_cross,
+                               lats, lons, crossings, cache=cache)
+    morpho = mfuncs.find_fence_crest(morpho, dist_cross, elev_cross,
+                                     lats, lons, cache=cache)
+    morpho = mfuncs.find_fence_heel(morpho, dist_cross, elev_cross,
+                                    lats, lons, cache=cache)
+    morpho = mfuncs.find_fence_toe(morpho, dist_cross, elev_cross,
+                                   lats, lons, cache=cache)
+
+    # Calculate volumes
+    morpho = mfuncs.dune_volume(dist_cross, elev_cross, morpho, cache)
+    morpho = mfuncs.beach_volume(dist_cross, elev_cross, morpho, cache)
+    morpho = mfuncs.profile_volume(dist_cross, elev_cross, morpho)
+    morpho = mfuncs.fenced_dune_volume(dist_cross, elev_cross, morpho, cache)
+    morpho = mfuncs.total_dune_volume(dist_cross, elev_cross, morpho, cache)
+
+    # Estimate the uncertainty of the morphometrics from a Monte
+    # Carlo ensemble of the profile. The random numbers are seeded
+    # by the profile so a resumed run gets the same results
+    if settings['ensemble_size'] > 0:
+        ensemble = ufuncs.run_ensemble(dist_cross, elev_cross, mhw, settings['mhw_pad'],
+                                       settings['ensemble_size'], settings['error'],
+                                       cache['index'].get('Fence'),
+                                       settings['heel_threshold'], settings['crest_pct'],
+                                       np.random.default_rng(profile))
+        morpho = ufuncs.store_percentiles(morpho, ensemble, settings['percentiles'])
+
+    # Store the ends of the transect for the survey geometry. The
+    # QC flag is filled in once the whole batch has been checked. In
+    # the alongshore mode it starts as the check of the landmarks so
+    # the next profile knows if this one can be used as a prior
+    morpho = mfuncs.transect_ends(morpho, lats, lons)
+    morpho['QC Flag'].append(flag)
+
+    return morpho
+
+
+def qc_batch(morpho, start, settings, fallback, load, fences):
+    """
+    Check the profiles in the morpho dict from the start row on and run
+    the ones that fail again with the fallback settings. A rerun is kept
+    if it fails fewer checks than the first run. Returns the morpho dict
+    and an array with the QC flag of each profile in the batch
+
+    morpho: Dict with morphometrics
+    start: Int with the first row of the batch
+    settings: Dict with the run settings from main()
+    fallback: Dict with the settings to rerun failed profiles with
+    load: Function taking a profile number and a settings dict and
+          returning the dist_cross, elev_cross, lats, and lons arrays
+    fences: Dict with the sand fence crossings from dfuncs.load_fences()
+    """
+
+    # Check the whole batch at once
+    flags = qfuncs.qc_flags(morpho, slice(start, None), settings['qc_limits'])
+
+    # Rerun the profiles that failed
+    for ix in np.flatnonzero(qfuncs.needs_reprocessing(flags)):
+        profile = morpho['Profile'][start + ix]
+        dist_cross, elev_cross, lats, lons = load(profile, fallback)
+        rerun = find_morphometrics(dfuncs.morpho_dict(settings['extra_columns']),
+                                   profile, dist_cross, elev_cross, lats, lons,
+                                   fallback, fences.get(profile))
+        rerun_flag = qfuncs.qc_flags(rerun, limits=settings['qc_limits'])[0]
+        failures = [bin(flag & qfuncs.FAILURES).count('1') for flag in (flags[ix], rerun_flag)]
+        if failures[1] < failures[0]:
+            dfuncs.replace_row(morpho, start + ix, rerun)
+            flags[ix] = rerun_flag | qfuncs.REPROCESSED
+    morpho['QC Flag'][start:] = flags.tolist()
+
+    return morpho, flags
+
+
+def check_batch(morpho, start, location, year, settings, fallback, fences):
+    """
+    Check the profiles in the morpho dict from the start row on, run the
+    ones that fail again with the fallback settings, and plot the
+    profiles picked by the render setting
+
+    morpho: Dict with morphometrics
+    start: Int with the first row of the batch
+    location: String with the location
+    year: String with the year being looked at
+    settings: Dict with the run settings from main()
+    fallback: Dict with the settings to rerun failed profiles with
+    fences: Dict with the sand fence crossings from dfuncs.load_fences()
+    """
+
+    def load(profile, used):
+        return load_profile(location, year, profile, used)[:4]
+
+    # Check the batch and rerun the failures
+    morpho, flags = qc_batch(morpho, start, settings, fallback, load, fences)
+
+    # Plot the profiles picked by the render setting
+    for ix in np.flatnonzero(qfuncs.needs_rendering(flags, settings['render'])):
+        profile = morpho['Profile'][start + ix]
+        used = fallback if flags[ix] & qfuncs.REPROCESSED else settings
+        dist_cross, elev_cross, _, _ = load(profile, used)
+        pfuncs.plot_profile(dfuncs.morpho_row(morpho, start + ix),
+                            dist_cross, elev_cross, location, year,
+                            profile, settings['mhw'], save=True)
+
+    return morpho
+
+
+def find_surveys(use_extension='.xyz'):
+    """
+    Return a list of dicts with the data file, transects file, and kind of
+    each survey in the data directory. Only consider profiles with an .xyz
+    extension or DEMs and point clouds that have a matching
+    "<location> <year> Transects.csv" file next to them. An ASCII .xyz
+    point cloud is told apart from a file of cross-sections by having a
+    transects file
+
+    use_extension: String with the extension of cross-section files (Default: ".xyz")
+    """
+
+    surveys = []
+    for file in os.listdir(DATA_DIR):
+        transect_file = os.path.join(DATA_DIR, dfuncs.transect_file_name(file))
+        has_transects = os.path.exists(transect_file)
+        use_dem = file.lower().endswith(rfuncs.DEM_EXTENSIONS) and has_transects
+        use_cloud = file.lower().endswith(cfuncs.ASCII_EXTENSIONS + cfuncs.CLOUD_EXTENSIONS)\
+            and has_transects and not use_dem
+        if file.endswith(use_extension) or use_dem or use_cloud:
+            surveys.append({'file': file, 'transect_file': transect_file,
+                            'use_dem': use_dem, 'use_cloud': use_cloud})
+
+    return surveys
+
+
+def parse_survey(survey, location, year, num_profiles, epsg, dem_spacing=None,
+                 cloud_half_width=1.0, cloud_classes=(2,)):
+    """
+    Parse out the individual profiles from the main file
+    into individual .txt files, or cut them out of the DEM
+    or point cloud
+
+    survey: Dict with a survey from find_surveys()
+    location: String with the location
+    year: String with the year being looked at
+    num_profiles: Int with the number of profiles in the survey
+    epsg: Int with the number code for the in projection
+    dem_spacing: Float with the sample spacing along DEM transects (Default: None)
+    cloud_half_width: Float with the half width of point cloud transects (Default: 1.0)
+    cloud_classes: List of LAS classes to use (Default: (2,))
+    """
+
+    file = survey['file']
+    if survey['use_dem']:
+        rfuncs.make_dem_profile_files(file, location, year, epsg,
+                                      dem_spacing)
+    elif survey['use_cloud']:
+        cfuncs.make_cloud_profile_files(file, location, year, epsg,
+                                        half_width=cloud_half_width,
+                                        classes=cloud_classes)
+    else:
+        dfuncs.make_profile_files(file, location, year,
+                                  num_profiles, epsg)
+
+
+def read_survey(survey, settings, epsg, dem_spacing=None,
+                cloud_half_width=1.0, cloud_classes=(2,)):
+    """
+    Do the reading for a survey: check for work from an earlier run and
+    parse the profiles out of the data file. This is the part of a survey
+    that waits on the disk so it runs on the reader thread while the
+    survey before it is computed. Returns the survey dict with the
+    results added
+
+    survey: Dict with a survey from find_surveys()
+    settings: Dict with the run settings from main()
+    epsg: Int with the number code for the in projection
+    dem_spacing: Float with the sample spacing along DEM transects (Default: None)
+    cloud_half_width: Float with the half width of point cloud transects (Default: 1.0)
+    cloud_classes: List of LAS classes to use (Default: (2,))
+    """
+
+    file, transect_file = survey['file'], survey['transect_file']
+    use_dem, use_cloud = survey['use_dem'], survey['use_cloud']
+
+    # Get basic information about the current set of profiles and
+    # make a folder to store results in
+    location, year, num_profiles = dfuncs.get_basic_information(
+        file, transect_file if use_dem or use_cloud else None)
+
+    # Check for work from an earlier run. A survey is finished if its
+    # .csv has every profile in it, otherwise pick the morpho dict
+    # back up from the checkpoint file and skip the finished profiles.
+    # Transects skipped while parsing have no profile file and are
+    # not part of the survey
+    profiles = dfuncs.parsed_profiles(location, year, num_profiles)
+    survey_done = len(profiles) > 0 and dfuncs.survey_complete(location, year, profiles)
+    morpho = dfuncs.load_checkpoint(location, year,
+                                    settings['extra_columns'])
+    if survey_done:
+        finished = set(profiles)
+    else:
+        finished = set(morpho['Profile'])
+
+    # Load the sand fence crossings for the location, if there are any
+    fences = dfuncs.load_fences(os.path.join(DATA_DIR,
+                                             dfuncs.fence_file_name(location)))
+
+    # Parse out the profiles. The profile files
+    # already exist when resuming
+    if len(finished) == 0:
+        parse_survey(survey, location, year, num_profiles, epsg,
+                     dem_spacing, cloud_half_width, cloud_classes)
+        profiles = dfuncs.parsed_profiles(location, year, num_profiles)
+
+    survey.update(location=location, year=year, num_profiles=num_profiles,
+                  profiles=profiles, survey_done=survey_done, morpho=morpho,
+                  finished=finished, fences=fences)
+
+    return survey
+
+
+def write_survey(survey, df=None):
+    """
+    Save the morphometrics for a survey and move the data file to the
+    location and year sub-folder. This runs on the writer thread
+
+    survey: Dict with a survey from read_survey()
+    df: DataFrame with the morphometrics, None if they are already saved (Default: None)
+    """
+
+    location, year, file = survey['location'], survey['year'], survey['file']
+
+    # Save the DataFrame. This raises an error if the saved
+    # file can't be verified so the data file isn't moved
+    if df is not None:
+        dfuncs.save_morphometrics(df, location, year)
+
+    # Move the .txt file to the location and year sub-folder. DEMs and
+    # point clouds also take their transects and header files with them
+    dst = os.path.join('..', f'{location}', f'{year}')
+    shutil.move(os.path.join(DATA_DIR, file), os.path.join(dst, file))
+    if survey['use_dem']:
+        for src in rfuncs.dem_sidecar_files(file):
+            shutil.move(src, dst)
+    elif survey['use_cloud']:
+        shutil.move(survey['transect_file'], dst)
+
 
 def main():
     """
@@ -26,96 +441,157 @@ def main():
     # Set parameters
     use_extension = '.xyz'
     epsg = 3358             # St. Pete = 2778, NC = 3358
-    grid_size = 0.5         # Doesn't matter: The gridded profiles aren't used
-    mhw = 0.34              # St. Pete = 0.187, NC = 0.34
-    heel_threshold = 0.6
-    crest_pct = 0.1
+    dem_spacing = None      # Sample spacing along DEM transects. None = cell size
+    cloud_half_width = 1.0  # Keep point cloud points within this distance of a transect
+    cloud_classes = [2]     # LAS classes to use (2 = Ground). None = all points
+    checkpoint_every = 50   # Number of profiles between checkpoints (and QC batch size)
+    prefetch = 1            # Surveys (and chunks of profiles) to read ahead while one is computed. 0 = Off
+    background_writes = True    # Save results on a writer thread
+    compact = False         # Hold loaded profiles as float32 with lat/lon only at the ends
+    memory_budget = None    # Most memory (MB) for loaded profiles. None = No limit
+    decimate_sample = 10    # Rerun every Nth profile without decimation to report the changes
+    compact_sample = 10     # Rerun every Nth compact profile in float64 to report the changes
+    settings = dict(SETTINGS)
 
-    # Loop through the files in the data directory. Only
-    # consider profiles with an .xyz extension
-    for file in os.listdir(DATA_DIR):
-        if file.endswith(use_extension):
-
-            # Setup a dictionary with blank lists to loop into
-            morpho = dfuncs.morpho_dict()
+    # Add columns for the uncertainty of every morphometric
+    settings['extra_columns'] = ufuncs.percentile_columns(settings['percentiles'])\
+        if settings['ensemble_size'] > 0 else []
+    fallback = dict(settings, **FALLBACK)
 
-            # Get basic information about the current set of profiles and
-            # make a folder to store results in
-            location, year, num_profiles = dfuncs.get_basic_information(file)
+    # Read the surveys on a background thread while the one before is
+    # computed, and write the results on another background thread
+    surveys = find_surveys(use_extension)
+    reader = functools.partial(read_survey, settings=settings, epsg=epsg,
+                               dem_spacing=dem_spacing,
+                               cloud_half_width=cloud_half_width,
+                               cloud_classes=cloud_classes)
+    with pipefuncs.Writer(background_writes) as writer:
+        for survey in pipefuncs.prefetch(surveys, reader, prefetch):
+            location, year = survey['location'], survey['year']
+            num_profiles, finished = survey['num_profiles'], survey['finished']
+            morpho, fences = survey['morpho'], survey['fences']
 
             # Print out a header to the terminal
             print('\n------------------------------------------------')
             print(f'Currently Working On: {location} {year}')
             print(f'Profiles: {num_profiles}')
             print('------------------------------------------------')
+            if len(finished) > 0:
+                print(f'Resuming: {len(finished)} profiles already finished')
+
+            # Load the unfinished profiles in chunks that fit the memory
+            # budget on the reader thread while the chunk before is computed
+            todo = [profile for profile in survey['profiles'] if profile not in finished]
+            chunks = cmpfuncs.profile_chunks(location, year, todo, settings['grid_size'], compact,
+                                             cmpfuncs.chunk_budget(memory_budget, prefetch),
+                                             checkpoint_every)
+
+            # Loop over the profiles. Every batch of profiles is checked,
+            # failures are rerun, and the picked profiles are plotted
+            # before the batch is checkpointed. The checkpoint gets a copy
+            # of the batch since the writer runs while morpho grows
+            batch_start = len(morpho['Profile'])
+            points_in, points_out = 0, 0
+            reference = dfuncs.morpho_dict(settings['extra_columns'])
+            sample = dfuncs.morpho_dict(settings['extra_columns'])
+            float64_reference = dfuncs.morpho_dict(settings['extra_columns'])
+            compacted = dfuncs.morpho_dict(settings['extra_columns'])
+            position_errors = []
+            for chunk in pipefuncs.prefetch(chunks, depth=prefetch):
+                for profile, data in chunk.items():
+
+                    # Load the profile and find the morphometrics. In the
+                    # alongshore mode the profile before is used as a prior
+                    dist_cross, elev_cross, lats, lons, num_points =\
+                        load_profile(location, year, profile, settings, data)
+                    points_in += num_points
+                    points_out += len(elev_cross)
+                    prior = neighbor_prior(morpho, profile, settings)
+                    morpho = find_morphometrics(morpho, profile, dist_cross, elev_cross,
+                                                lats, lons, settings, fences.get(profile), prior)
+
+                    # Run some of the decimated profiles again without
+                    # decimating them to report what it changes
+                    if settings['decimate_tolerance'] is not None and\
+                            profile % decimate_sample == 0:
+                        full = dict(settings, decimate_tolerance=None)
+                        dist_cross, elev_cross, lats, lons, _ =\
+                            load_profile(location, year, profile, full, data)
+                        reference = find_morphometrics(reference, profile, dist_cross,
+                                                       elev_cross, lats, lons, full,
+                                                       fences.get(profile), prior)
+                        for key, values in morpho.items():
+                            sample[key].append(values[-1])
+
+                    # Run some of the compact profiles again from the
+                    # float64 profile to report what compacting changes
+                    if compact and profile % compact_sample == 0:
+                        dist_cross, elev_cross, _, _, lats, lons =\
+                            dfuncs.setup_profile(location, year, profile, settings['grid_size'])
+                        position_errors.append(cmpfuncs.position_error(lats, lons, data))
+                        dist_cross, elev_cross, lats, lons, _ =\
+                            load_profile(location, year, profile, settings,
+                                         (dist_cross, elev_cross, lats, lons))
+                        float64_reference = find_morphometrics(float64_reference, profile,
+                                                               dist_cross, elev_cross, lats, lons,
+                                                               settings, fences.get(profile), prior)
+                        for key, values in morpho.items():
+                            compacted[key].append(values[-1])
+
+                    # Periodically check and checkpoint the finished profiles
+                    unsaved = len(morpho['Profile']) - batch_start
+                    if unsaved >= checkpoint_every:
+                        morpho = check_batch(morpho, batch_start, location, year,
+                                             settings, fallback, fences)
+                        batch = {key: values[batch_start:] for key, values in morpho.items()}
+                        writer.submit(dfuncs.append_checkpoint, location, year, batch, unsaved)
+                        batch_start = len(morpho['Profile'])
+            unsaved = len(morpho['Profile']) - batch_start
+            if unsaved > 0:
+                morpho = check_batch(morpho, batch_start, location, year,
+                                     settings, fallback, fences)
+                batch = {key: values[batch_start:] for key, values in morpho.items()}
+                writer.submit(dfuncs.append_checkpoint, location, year, batch, unsaved)
+            if settings['decimate_tolerance'] is not None and points_out > 0:
+                print(f'Decimation kept {points_out} of {points_in} points '
+                      f'({decfuncs.compression_ratio(points_in, points_out):.1f}x compression)')
+                if len(sample['Profile']) > 0:
+                    print(f'Changes on {len(sample["Profile"])} profiles run without decimation:')
+                    deltas = decfuncs.morphometric_deltas(reference, sample,
+                                                          decfuncs.REPORT_METRICS)
+                    for metric, delta in deltas.items():
+                        print(f'    {metric}: mean {delta["mean"]:.4f}, max {delta["max"]:.4f}')
+            if len(compacted['Profile']) > 0:
+                print(f'Changes on {len(compacted["Profile"])} compact profiles run in float64 '
+                      f'(largest position error {max(position_errors):.2e} m):')
+                deltas = decfuncs.morphometric_deltas(float64_reference, compacted,
+                                                      decfuncs.REPORT_METRICS)
+                for metric, delta in deltas.items():
+                    print(f'    {metric}: mean {delta["mean"]:.2e}, max {delta["max"]:.2e}')
+
+            # Report the QC results
+            flags = morpho['QC Flag']
+            print(f'QC: {sum(flag == qfuncs.PASSED for flag in flags)} of {len(flags)} profiles passed')
+            for name, count in qfuncs.summary(flags).items():
+                if count > 0:
+                    print(f'    {name}: {count}')
+
+            df = None
+            if not survey['survey_done']:
+
+                # Convert morpho to a DataFrame
+                df = pd.DataFrame.from_dict(morpho)
+
+                # Calculate metrics that can be done without
+                # looping through the profiles
+                df = mfuncs.derived_metrics(df)
+
+                # Calculate the profile bearings from heel to MHW, the transect
+                # lengths and spacing, and the alongshore-integrated volumes
+                df = gfuncs.survey_geometry(df)
 
-            # Parse out the individual profiles from the main file
-            # into individual .txt files
-            dfuncs.make_profile_files(file, location, year, num_profiles, epsg)
-
-            # Loop over the profiles
-            for profile in range(1, num_profiles + 1):
-
-                # Store the profile number
-                morpho['Profile'].append(profile)
-
-                # Determine the profile length and interpolate onto a grid
-                # of a pre-defined spacing
-                dist_cross, elev_cross, ex, why, lats, lons =\
-                    dfuncs.setup_profile(location, year, profile, grid_size)
-
-                # Identify the MHW contour. This function also calculates
-                # the foreshore slope since the error method for MHW includes
-                # calculating it.
-                morpho = mfuncs.find_mhw(morpho, dist_cross, elev_cross,
-                                         lats, lons, mhw)
-
-                # Identify the dune crest
-                morpho = mfuncs.find_crest(morpho, dist_cross, elev_cross,
-                                           lats, lons, mhw,
-                                           heel_threshold, crest_pct)
-
-                # Identify the dune heel
-                morpho = mfuncs.find_heel(morpho, dist_cross, elev_cross,
-                                          lats, lons)
-
-                # Identify the dune toe
-                morpho = mfuncs.find_toe(morpho, dist_cross, elev_cross,
-                                         lats, lons)
-
-                # Calculate volumes
-                morpho = mfuncs.dune_volume(dist_cross, elev_cross, morpho)
-                morpho = mfuncs.beach_volume(dist_cross, elev_cross, morpho)
-                morpho = mfuncs.profile_volume(dist_cross, elev_cross, morpho)
-
-                # Calculate the profile bearing from heel to MHW
-                morpho = mfuncs.orientation(morpho, dist_cross, lats, lons)
-
-                # Plot the profile
-                pfuncs.plot_profile(morpho, dist_cross, elev_cross, location,
-                                    year, profile, mhw, save=True)
-
-            # Convert morpho to a DataFrame
-            df = pd.DataFrame.from_dict(morpho)
-
-            # Calculate metrics that can be done without
-            # looping through the profiles
-            df['Dune Height'] = df['YCrest'] - df['YToe']
-            df['Dune Width'] = df['XToe'] - df['XHeel']
-            df['Dune Aspect Ratio'] = df['Dune Height'] / df['Dune Width']
-            df['Dune Face Slope'] = df['Dune Height'] / (df['XToe'] - df['XCrest'])
-            df['Beach Width'] = df['XMHW'] - df['XToe']
-            df['Beach Slope'] = (df['YToe'] - df['YMHW']) / df['Beach Width']
-
-            # Save the DataFrame
-            path = os.path.join('..', f'{location}', f'{year}')
-            fname = os.path.join(path, f'Morphometrics for {location} {year}.csv')
-            df.to_csv(fname, index=False)
-
-        # Move the .txt file to the location and year sub-folder
-        src = os.path.join(DATA_DIR, file)
-        dst = os.path.join('..', f'{location}', f'{year}', file)
-        shutil.move(src, dst)
+            # Save the morphometrics and move the data file
+            writer.submit(write_survey, survey, df)
 
 
 if __name__ == '__main__':
@@ -1,22 +1,52 @@
 """
 Analyze morphometrics identified from running Automorph
 
+The morphometrics are first reduced to a quantile cube with the
+quantiles of every metric for every year (and for every alongshore
+bin in every year) in one grouped pass. The cube is cached next to
+the data so figures can be remade without reading the .csv files
+again, and the box and alongshore figures are drawn from it. Map and
+scatter views are binned onto a raster in the same pass and cached with
+the cube, so they take the same time to draw for a thousand points or
+millions of them.
+Batches of figures are rendered in parallel worker processes. The
+morphometrics of the transects in an area or a range of years can be
+loaded through the transect catalog without reading whole files
+
 Michael Itzkin, 7/2/2021
 """
 
+from Functions import Catalog_Functions as catfuncs
+from Functions.Lazy_Import import lazy_import
 
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import numpy as np
 import os
 
+# Heavy dependencies are only imported when first used
+plt = lazy_import('matplotlib.pyplot')
+pd = lazy_import('pandas')
+
 
 # General plot parameters
 font = {'fontname': 'Arial', 'fontsize': 14, 'fontweight': 'normal'}
 inches = 3.8
 dpi = 300
 
+# Quantile cube parameters. The boxplot whiskers are
+# drawn at the outer quantiles instead of 1.5 x IQR
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+BIN_SIZE = 10       # Profiles per alongshore bin
+MISSING = 9999
+
+# Metrics that are only valid when MHW was found on the profile. Without
+# MHW they hold values worked out from the 9999 placeholder or from the
+# seaward end of the profile
+MHW_METRICS = ['XMHW', 'YMHW', 'MHW Lat', 'MHW Lon', 'MHW CI', 'MHW Lidar Error',
+               'MHW X Error', 'MHW Error', 'Foreshore Slope', 'Beach Width',
+               'Beach Slope', 'Beach Volume', 'Alongshore Beach Volume']
+
 
 """
 Functions to load and format data
@@ -34,20 +64,231 @@ def load_morphometrics(loc, years):
     # Set a generic component of the path to the data
     path = os.path.join('..', loc)
 
-    # Create a blank DataFrame
-    df = pd.DataFrame()
-
-    # Loop through the years
+    # Load the data for each year and add a column with the year.
+    # Join them all at once instead of growing the DataFrame
+    frames = []
     for yy in years:
-
-        # Load the data and add a column with the year and
-        # append it to the main DataFrame
         fname = os.path.join(path, f'{yy}', f'Morphometrics for {loc} {yy}.csv')
         temp_df = pd.read_csv(fname, header=0, delimiter=',')
         temp_df['Year'] = yy
-        df = pd.concat([df, temp_df])
+        frames.append(temp_df)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def select_morphometrics(locations=None, years=None, bbox=None):
+    """
+    Load the morphometrics of the finished transects that match the filters
+    into a single DataFrame. The transects are found with the transect
+    catalog and only their rows of each .csv are read
+
+    locations: String or list of strings with the locations (Default: None, all)
+    years: Tuple with the (first, last) years to use (Default: None, all)
+    bbox: Tuple with the (min lon, min lat, max lon, max lat) of an area (Default: None, all)
+    """
+
+    transects = catfuncs.find_transects(locations, years, bbox, status=catfuncs.DONE)
+
+    # Load the rows of each survey and add columns with the location and year
+    frames = []
+    for (loc, yy), group in transects.groupby(['location', 'year'], sort=False):
+        fname = os.path.join('..', loc, yy, f'Morphometrics for {loc} {yy}.csv')
+        temp_df = catfuncs.read_rows(fname, group)
+        temp_df['Location'] = loc
+        temp_df['Year'] = int(yy)
+        frames.append(temp_df)
+
+    return pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame()
+
 
-    return df
+def mask_missing(df, columns):
+    """
+    Return the columns of the morphometrics as floats with NaN where a
+    value is missing. Values of 9999 are missing, and so are the metrics
+    that need MHW on profiles where MHW wasn't found
+
+    df: DataFrame with the morphometrics from load_morphometrics()
+    columns: List of strings with the columns to use
+    """
+
+    data = df[list(columns)].astype(np.float64)
+    data = data.mask(data >= MISSING)
+    no_mhw = ~(df['XMHW'].to_numpy(dtype=np.float64) < MISSING)
+    for column in data.columns:
+        if column in MHW_METRICS:
+            data.loc[no_mhw, column] = np.nan
+
+    return data
+
+
+def quantile_cube(df, metrics, quantiles=QUANTILES, bin_size=BIN_SIZE, rasters=None):
+    """
+    Reduce the morphometrics to the quantiles of each metric for
+    each year and for each alongshore bin of each year. Returns a
+    dict of arrays:
+
+    years: Array with the years (Y)
+    metrics: Array with the metric names (M)
+    quantiles: Array with the quantiles (Q)
+    values: Array (Y, M, Q) with the quantiles of each metric for each year
+    count: Array (Y, M) with the number of profiles with each metric
+    bins: Array with the first profile number in each alongshore bin (B)
+    alongshore: Array (Y, B, M, Q) with the quantiles in each alongshore bin
+    raster <name>, extent <name>: The grid and extent of each raster
+
+    df: DataFrame with the morphometrics from load_morphometrics()
+    metrics: List of strings with the metrics to reduce
+    quantiles: List of floats with the quantiles (0-1) (Default: QUANTILES)
+    bin_size: Int with the number of profiles in each alongshore bin
+    rasters: Dict with the name of each raster to make in the same pass and
+             a tuple with its (x column, y column, value column or None, bins)
+             for rasterize() (Default: None)
+    """
+
+    # Mask the missing values. The raster columns are masked too
+    rasters = {} if rasters is None else rasters
+    columns = list(dict.fromkeys(list(metrics) + [column for spec in rasters.values()
+                                                  for column in spec[:3]
+                                                  if column is not None]))
+    masked = mask_missing(df, columns)
+    data = masked[list(metrics)].copy()
+    data['Year'] = df['Year'].to_numpy()
+    data['Bin'] = (df['Profile'].to_numpy() - 1) // bin_size * bin_size + 1
+
+    # One grouped pass for all of the metrics and quantiles by year and
+    # one by year and bin, then pivot into (year, [bin], metric, quantile)
+    years = np.sort(data['Year'].unique())
+    bins = np.sort(data['Bin'].unique())
+    by_year = data.drop(columns='Bin').groupby('Year')
+    by_bin = data.groupby(['Year', 'Bin'])
+    yearly = by_year.quantile(quantiles).reindex(
+        pd.MultiIndex.from_product([years, quantiles]))
+    alongshore = by_bin.quantile(quantiles).reindex(
+        pd.MultiIndex.from_product([years, bins, quantiles]))
+
+    # Bin the raster views from the same masked values
+    grids = {}
+    for name, (x, y, values, cells) in rasters.items():
+        grid, extent = rasterize(masked[x], masked[y],
+                                 None if values is None else masked[values], cells)
+        grids[f'raster {name}'], grids[f'extent {name}'] = grid, np.array(extent)
+
+    return {'years': years,
+            'metrics': np.array(metrics),
+            'quantiles': np.array(quantiles),
+            'values': yearly.to_numpy().reshape(len(years), len(quantiles),
+                                                len(metrics)).transpose(0, 2, 1),
+            'count': by_year.count().reindex(years).to_numpy(),
+            'bins': bins,
+            'alongshore': alongshore.to_numpy().reshape(
+                len(years), len(bins), len(quantiles), len(metrics)).transpose(0, 1, 3, 2),
+            **grids}
+
+
+def load_cube(loc, years, metrics, quantiles=QUANTILES, bin_size=BIN_SIZE, rasters=None):
+    """
+    Return the quantile cube for a location. The cube is cached in
+    "<location>/Morphometric Quantiles.npz" and only remade if the
+    morphometrics files or the cube settings have changed
+
+    loc: String with the data location
+    years: List of ints with years of available data
+    metrics: List of strings with the metrics to reduce
+    quantiles: List of floats with the quantiles (0-1) (Default: QUANTILES)
+    bin_size: Int with the number of profiles in each alongshore bin
+    rasters: Dict with the rasters to make, see quantile_cube() (Default: None)
+    """
+
+    # Describe the inputs with the size and time of every file
+    key = [f'{list(metrics)} {list(quantiles)} {bin_size} {sorted((rasters or {}).items())}']
+    for yy in years:
+        fname = os.path.join('..', loc, f'{yy}', f'Morphometrics for {loc} {yy}.csv')
+        stat = os.stat(fname)
+        key.append(f'{yy} {stat.st_size} {stat.st_mtime_ns}')
+    key = '\n'.join(key)
+
+    # Use the cached cube if it was made from the same inputs
+    fname = os.path.join('..', loc, 'Morphometric Quantiles.npz')
+    if os.path.exists(fname):
+        with np.load(fname, allow_pickle=False) as cached:
+            if str(cached['key']) == key:
+                return {name: cached[name] for name in cached.files if name != 'key'}
+
+    cube = quantile_cube(load_morphometrics(loc, years), metrics, quantiles, bin_size, rasters)
+    temp_fname = f'{fname}.tmp.npz'
+    np.savez(temp_fname, key=key, **cube)
+    os.replace(temp_fname, fname)
+
+    return cube
+
+
+def cube_slice(cube, metric, alongshore=False):
+    """
+    Return the quantiles of one metric from the cube as an array of
+    shape (years, quantiles), or (years, bins, quantiles) if alongshore
+
+    cube: Dict from quantile_cube()
+    metric: String with the metric name
+    alongshore: Bool to return the alongshore bins (Default: False)
+    """
+
+    ix = list(cube['metrics']).index(metric)
+    if alongshore:
+        return cube['alongshore'][:, :, ix, :]
+
+    return cube['values'][:, ix, :]
+
+
+def cube_raster(cube, name):
+    """
+    Return the grid and extent of a raster made with the cube
+
+    cube: Dict from quantile_cube()
+    name: String with the raster name
+    """
+
+    return cube[f'raster {name}'], tuple(cube[f'extent {name}'])
+
+
+def rasterize(x, y, values=None, bins=512, extent=None):
+    """
+    Bin points onto a regular grid. Returns the mean value (or the
+    number of points if there are no values) in every cell, with NaN
+    in empty cells, and the extent of the grid as (xmin, xmax, ymin, ymax).
+    The grid rows go from the top (ymax) to the bottom (ymin)
+
+    x: Array with the X (e.g. longitude) of each point
+    y: Array with the Y (e.g. latitude) of each point
+    values: Array with a value at each point (Default: None)
+    bins: Int (or pair of ints) with the number of cells across the grid
+    extent: Tuple with (xmin, xmax, ymin, ymax) (Default: the data extent)
+    """
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    nx, ny = (bins, bins) if np.isscalar(bins) else bins
+    keep = np.isfinite(x) & np.isfinite(y)
+    if values is not None:
+        values = np.asarray(values, dtype=np.float64)
+        keep &= np.isfinite(values) & (values < MISSING)
+    x, y = x[keep], y[keep]
+    if extent is None:
+        extent = (x.min(), x.max(), y.min(), y.max())
+    xmin, xmax, ymin, ymax = extent
+
+    # Find the cell of every point and add them up in one pass
+    col = np.clip(((x - xmin) / max(xmax - xmin, 1e-12) * nx).astype(np.int64), 0, nx - 1)
+    row = np.clip(((ymax - y) / max(ymax - ymin, 1e-12) * ny).astype(np.int64), 0, ny - 1)
+    cell = row * nx + col
+    count = np.bincount(cell, minlength=nx * ny).reshape(ny, nx).astype(np.float64)
+    if values is None:
+        grid = count
+    else:
+        total = np.bincount(cell, weights=values[keep], minlength=nx * ny).reshape(ny, nx)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid = total / count
+    grid[count == 0] = np.nan
+
+    return grid, extent
 
 
 """
@@ -55,32 +296,38 @@ Functions to make figures
 """
 
 
-def annual_boxplots(df, metric, ylabel, yhi, ylo=0, save=False):
+def annual_boxplots(cube, metric, ylabel, yhi, ylo=0, save=False, fig_dir=None):
     """
-    Make a boxplot showing the annual evolution of some metric
+    Make a boxplot showing the annual evolution of some metric. The
+    boxes are drawn from the quantile cube, the whiskers go to the
+    outer quantiles
 
-    df: DataFrame with the morphometrics
+    cube: Dict from quantile_cube()
     metric: String with the column name of the metric to look at
     ylabel: String with the Y-Axis label
     yhi: Y-Axis upper limit
     ylo: Y-AXis lower limit
     save: Display the data (False) or close and save the figure (True)
+    fig_dir: String with the folder to save the figure in (Default: FIG_DIR)
     """
 
+    # Make the box statistics from the cube. Years without
+    # any data for the metric are left empty
+    stats = []
+    for year, (whislo, q1, med, q3, whishi) in zip(cube['years'],
+                                                   cube_slice(cube, metric)):
+        stats.append({'label': str(year), 'whislo': whislo, 'q1': q1, 'med': med,
+                      'q3': q3, 'whishi': whishi, 'fliers': []})
+
     # Setup the figure
     fig, ax = plt.subplots(figsize=(inches * 2, inches), dpi=dpi)
 
     # Plot the data
-    sns.boxplot(x='Year', y=metric, data=df, ax=ax)
-
-    # iterate over boxes
-    for i, box in enumerate(ax.artists):
-        box.set_edgecolor('black')
-        box.set_facecolor('white')
-
-        # iterate over whiskers and median lines
-        for j in range(6 * i, 6 * (i + 1)):
-            ax.lines[j].set_color('black')
+    ax.bxp(stats, showfliers=False, patch_artist=True,
+           boxprops={'facecolor': 'white', 'edgecolor': 'black'},
+           medianprops={'color': 'black'},
+           whiskerprops={'color': 'black'},
+           capprops={'color': 'black'})
 
     # Set the X-Axis
     ax.set_xlabel('')
@@ -91,10 +338,93 @@ def annual_boxplots(df, metric, ylabel, yhi, ylo=0, save=False):
 
     # Save and close the figure
     title = f'Annual {metric} Boxplot'
-    save_figure(title, fig, save)
+    save_figure(title, fig, save, fig_dir)
 
 
-def save_figure(title, figure, save):
+def alongshore_plot(cube, metric, ylabel, yhi, ylo=0, save=False, fig_dir=None):
+    """
+    Plot the median of a metric along the shore for every year with
+    the interquartile range shaded, from the alongshore bins of the cube
+
+    cube: Dict from quantile_cube()
+    metric: String with the column name of the metric to look at
+    ylabel: String with the Y-Axis label
+    yhi: Y-Axis upper limit
+    ylo: Y-AXis lower limit
+    save: Display the data (False) or close and save the figure (True)
+    fig_dir: String with the folder to save the figure in (Default: FIG_DIR)
+    """
+
+    # Get the quartiles and median for the metric
+    quantiles = list(cube['quantiles'])
+    values = cube_slice(cube, metric, alongshore=True)
+    colors = plt.get_cmap('viridis')(np.linspace(0, 1, len(cube['years'])))
+
+    # Setup the figure
+    fig, ax = plt.subplots(figsize=(inches * 2, inches), dpi=dpi)
+
+    # Plot the data
+    for year, color, year_values in zip(cube['years'], colors, values):
+        if 0.25 in quantiles and 0.75 in quantiles:
+            ax.fill_between(cube['bins'],
+                            year_values[:, quantiles.index(0.25)],
+                            year_values[:, quantiles.index(0.75)],
+                            color=color, alpha=0.2, linewidth=0)
+        ax.plot(cube['bins'], year_values[:, quantiles.index(0.5)],
+                color=color, linewidth=1, label=str(year))
+
+    # Set the X-Axis
+    ax.set_xlim(cube['bins'].min(), cube['bins'].max())
+    ax.set_xlabel('Profile', **font)
+
+    # Set the Y-Axis
+    ax.set_ylim(ylo, yhi)
+    ax.set_ylabel(ylabel, **font)
+
+    # Add a legend
+    ax.legend(loc='upper left', bbox_to_anchor=(1, 1), fontsize=8, frameon=False)
+
+    # Save and close the figure
+    title = f'Alongshore {metric}'
+    save_figure(title, fig, save, fig_dir)
+
+
+def raster_plot(grid, extent, title, xlabel, ylabel, clabel,
+                log=False, save=False, fig_dir=None):
+    """
+    Plot a grid from rasterize() as an image, for map views
+    and scatter plots with too many points to draw one by one
+
+    grid: 2D array from rasterize()
+    extent: Tuple with (xmin, xmax, ymin, ymax) from rasterize()
+    title: String with the figure title
+    xlabel: String with the X-Axis label
+    ylabel: String with the Y-Axis label
+    clabel: String with the colorbar label
+    log: Bool to use a log color scale, e.g. for counts (Default: False)
+    save: Display the data (False) or close and save the figure (True)
+    fig_dir: String with the folder to save the figure in (Default: FIG_DIR)
+    """
+
+    # Setup the figure
+    fig, ax = plt.subplots(figsize=(inches * 2, inches * 2), dpi=dpi)
+
+    # Plot the data
+    norm = plt.matplotlib.colors.LogNorm() if log else None
+    image = ax.imshow(grid, extent=extent, origin='upper', aspect='auto',
+                      interpolation='nearest', cmap='viridis', norm=norm)
+    colorbar = fig.colorbar(image, ax=ax)
+    colorbar.set_label(clabel, **font)
+
+    # Set the axes
+    ax.set_xlabel(xlabel, **font)
+    ax.set_ylabel(ylabel, **font)
+
+    # Save and close the figure
+    save_figure(title, fig, save, fig_dir)
+
+
+def save_figure(title, figure, save, fig_dir=None):
     """
     Save and close the figure. Add a
     transparent background first
@@ -102,6 +432,7 @@ def save_figure(title, figure, save):
     title: String with the figure title
     figure: Figure object to save
     save: Bool to save the figure (True) or display it (False)
+    fig_dir: String with the folder to save the figure in (Default: FIG_DIR)
     """
 
     if save:
@@ -112,7 +443,9 @@ def save_figure(title, figure, save):
         figure.patch.set_alpha(0.0)
 
         # Set the save directory
-        title_w_extension = os.path.join(FIG_DIR, f'{title}.png')
+        if fig_dir is None:
+            fig_dir = FIG_DIR
+        title_w_extension = os.path.join(fig_dir, f'{title}.png')
 
         # Save the figure and print out a notification
         plt.savefig(title_w_extension,
@@ -128,6 +461,53 @@ def save_figure(title, figure, save):
         plt.show()
 
 
+"""
+Functions to render batches of figures
+"""
+
+
+def start_worker():
+    """
+    Set up a worker process to draw figures without a display
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def render_figure(job):
+    """
+    Make one figure from a (function, kwargs) job
+    """
+
+    function, kwargs = job
+    function(**kwargs)
+
+
+def render_figures(jobs, workers=None):
+    """
+    Make a batch of figures in parallel worker processes. Every figure
+    is saved so the jobs should be made with save=True. The work for
+    each job should already be reduced (a cube or a raster) so that
+    little data is sent to the workers
+
+    jobs: List of (function, kwargs) tuples, e.g. (annual_boxplots, {...})
+    workers: Int with the number of worker processes. 1 draws the figures
+             in this process (Default: None = one per CPU)
+    """
+
+    if workers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            render_figure(job)
+        return
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=start_worker) as executor:
+        for _ in executor.map(render_figure, jobs):
+            pass
+
+
 """
 Run the analysis
 """
@@ -143,6 +523,12 @@ def main():
     location = 'Nags_Head_A'
     years = [1998, 1999, 2001, 2004, 2005, 2008, 2009, 2012,
              2013, 2014, 2015, 2016, 2017, 2018, 2019]
+    workers = None      # Figure workers. None = one per CPU, 1 = no workers
+
+    # Metrics to plot as (column, label, upper limit)
+    metrics = [('YCrest', 'D$_{high}$ (m NAVD88)', 15),
+               ('Dune Volume', 'Dune Volume (m$^{3}$/m)', 300),
+               ('Beach Width', 'Beach Width', 300)]
 
     # Make a folder for the results
     global FIG_DIR
@@ -150,22 +536,37 @@ def main():
     if not os.path.exists(FIG_DIR):
         os.makedirs(FIG_DIR)
 
-    # Load the morphometrics into a single DataFrame
-    df = load_morphometrics(location, years)
-
-    # Plot the profiles on a Basemap
-
-    # Plot overlays of the profiles for all years
-
-    # Make boxplots of the metrics by year
-    annual_boxplots(df, 'YCrest', 'D$_{high}$ (m NAVD88)', 15, save=True)
-    annual_boxplots(df, 'Dune Volume', 'Dune Volume (m$^{3}$/m)', 300, save=True)
-    annual_boxplots(df, 'Beach Width', 'Beach Width', 300, save=True)
-
-    # Make yearly alongshore plots of the metrics
-    sns.scatterplot(x='Beach Width', y='YCrest', data=df)
-    plt.show()
-
+    # Rasters to make as {name: (x column, y column, value column, bins)}
+    rasters = {'Map of YCrest': ('Crest Lon', 'Crest Lat', 'YCrest', 512),
+               'Beach Width vs YCrest': ('Beach Width', 'YCrest', None, 256)}
+
+    # Reduce the morphometrics to the quantile cube and the rasters
+    cube = load_cube(location, years, [metric for metric, _, _ in metrics], rasters=rasters)
+
+    # Make boxplots of the metrics by year and
+    # yearly alongshore plots of the metrics
+    jobs = []
+    for metric, ylabel, yhi in metrics:
+        kwargs = {'cube': cube, 'metric': metric, 'ylabel': ylabel, 'yhi': yhi,
+                  'save': True, 'fig_dir': FIG_DIR}
+        jobs.append((annual_boxplots, kwargs))
+        jobs.append((alongshore_plot, kwargs))
+
+    # Map the dune crest elevations and make a density plot
+    # of the beach width against the crest elevation
+    grid, extent = cube_raster(cube, 'Map of YCrest')
+    jobs.append((raster_plot, {'grid': grid, 'extent': extent,
+                               'title': 'Map of YCrest', 'xlabel': 'Longitude',
+                               'ylabel': 'Latitude', 'clabel': 'D$_{high}$ (m NAVD88)',
+                               'save': True, 'fig_dir': FIG_DIR}))
+    grid, extent = cube_raster(cube, 'Beach Width vs YCrest')
+    jobs.append((raster_plot, {'grid': grid, 'extent': extent,
+                               'title': 'Beach Width vs YCrest', 'xlabel': 'Beach Width (m)',
+                               'ylabel': 'D$_{high}$ (m NAVD88)', 'clabel': 'Profiles',
+                               'log': True, 'save': True, 'fig_dir': FIG_DIR}))
+
+    # Render all the figures
+    render_figures(jobs, workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+"""
+Search the transect catalog and rerun parts of surveys
+
+Automorph.py adds every transect to the catalog when a survey is parsed
+and keeps its status up to date as the survey is run. The catalog can be
+searched by location, year, profile number, area, and status without
+opening any profile or morphometrics files, and the transects that are
+found can be run again with the current settings. A rerun only loads the
+profiles that were picked and replaces their rows in the saved
+morphometrics .csv
+
+Surveys that were parsed before there was a catalog are added to it with
+the "index" command, which reads the profile files that are already in
+the location and year folders
+
+Run from the Python folder:
+    python Automorph_Catalog.py index
+    python Automorph_Catalog.py find [--location NAME ...] [--years 2012 2019]
+                                     [--bbox MIN_LON MIN_LAT MAX_LON MAX_LAT]
+                                     [--profiles FIRST LAST] [--status done]
+    python Automorph_Catalog.py rerun [the same filters as find]
+"""
+
+from Functions import Catalog_Functions as catfuncs
+from Functions import Data_Functions as dfuncs
+from Functions import Geodesy_Functions as gfuncs
+from Functions import Morpho_Functions as mfuncs
+from Functions import Uncertainty_Functions as ufuncs
+from Automorph import (DATA_DIR, SETTINGS, FALLBACK, load_profile, find_morphometrics,
+                       neighbor_prior, check_batch)
+
+import pandas as pd
+import argparse
+import re
+import os
+
+
+"""
+Functions to fill in the catalog
+"""
+
+
+def index_survey(location, year):
+    """
+    Add the parsed profiles of a survey to the catalog. The rows of the
+    morphometrics .csv are indexed too if the survey is finished. Returns
+    the number of profiles added
+
+    location: String with the location
+    year: String with the year
+    """
+
+    folder = os.path.join('..', location, year, 'Profiles')
+    pattern = re.compile(rf'{re.escape(location)} {re.escape(year)} (\d+)\.txt$')
+    records = []
+    for file in os.listdir(folder):
+        match = pattern.match(file)
+        if match is None:
+            continue
+        profile = int(match.group(1))
+        df = dfuncs.read_profile(location, year, profile)
+        records.append(catfuncs.profile_record(location, year, profile, df,
+                                               os.path.join(folder, file), None))
+    records.sort(key=lambda record: record['profile'])
+    catfuncs.add_transects(records)
+
+    # Index the morphometrics if the survey was finished
+    fname = dfuncs.morphometrics_file(location, year)
+    if os.path.exists(fname):
+        catfuncs.index_morphometrics(location, year, fname)
+
+    return len(records)
+
+
+def index_surveys():
+    """
+    Add every parsed survey in the location and year folders to the catalog
+    """
+
+    for location in sorted(os.listdir('..')):
+        if not os.path.isdir(os.path.join('..', location)):
+            continue
+        for year in sorted(os.listdir(os.path.join('..', location))):
+            if os.path.isdir(os.path.join('..', location, year, 'Profiles')):
+                count = index_survey(location, year)
+                print(f'{location} {year}: {count} profiles')
+
+
+"""
+Functions to rerun transects
+"""
+
+
+def saved_prior(df, profile, settings):
+    """
+    Return the prior for a profile from the saved row of the profile
+    before it, or None if there is no such row or it failed QC. Used in
+    the alongshore mode when the profile before isn't being rerun
+
+    df: DataFrame with the saved morphometrics
+    profile: Int with the profile number about to be rerun
+    settings: Dict with the run settings
+    """
+
+    row = df[df['Profile'] == profile - 1]
+    if len(row) == 0:
+        return None
+    saved = {key: list(row[key]) for key in ['Profile', 'QC Flag', 'XMHW', 'XCrest', 'XToe']}
+
+    return neighbor_prior(saved, profile, settings)
+
+
+def rerun_survey(location, year, profiles, settings):
+    """
+    Find the morphometrics of some profiles of a finished survey again and
+    replace their rows in the morphometrics .csv. The metrics that need
+    every profile are found again for the whole survey. In the alongshore
+    mode a profile whose neighbor isn't rerun with it uses the saved
+    landmarks of the neighbor as its prior
+
+    location: String with the location
+    year: String with the year
+    profiles: List of ints with the profile numbers in order
+    settings: Dict with the run settings
+    """
+
+    fname = dfuncs.morphometrics_file(location, year)
+    if not os.path.exists(fname):
+        print(f'Skipping {location} {year}: Run Automorph.py on it first')
+        return
+
+    # The saved values are read back exactly so the other rows don't change
+    df = pd.read_csv(fname, header=0, float_precision='round_trip')
+
+    # Find and check the morphometrics the same way Automorph.py does
+    fallback = dict(settings, **FALLBACK)
+    fences = dfuncs.load_fences(os.path.join(DATA_DIR, dfuncs.fence_file_name(location)))
+    morpho = dfuncs.morpho_dict(settings['extra_columns'])
+    for profile in profiles:
+        dist_cross, elev_cross, lats, lons, _ = load_profile(location, year, profile, settings)
+        if settings['alongshore'] and profile - 1 not in profiles:
+            prior = saved_prior(df, profile, settings)
+        else:
+            prior = neighbor_prior(morpho, profile, settings)
+        morpho = find_morphometrics(morpho, profile, dist_cross, elev_cross,
+                                    lats, lons, settings, fences.get(profile), prior)
+    morpho = check_batch(morpho, 0, location, year, settings, fallback, fences)
+
+    # Replace the rows and find the metrics that need every profile again
+    df = pd.concat([df[~df['Profile'].isin(profiles)], pd.DataFrame.from_dict(morpho)],
+                   ignore_index=True)
+    df = df.sort_values(by='Profile').reset_index(drop=True)
+    df = mfuncs.derived_metrics(df)
+    df = gfuncs.survey_geometry(df)
+    dfuncs.save_morphometrics(df, location, year)
+    print(f'{location} {year}: Reran {len(profiles)} profiles')
+
+
+def main():
+    """
+    Run the command
+    """
+
+    parser = argparse.ArgumentParser(description='Search the transect catalog')
+    parser.add_argument('command', choices=['index', 'find', 'rerun'])
+    parser.add_argument('--location', nargs='+', default=None)
+    parser.add_argument('--years', nargs=2, type=int, default=None)
+    parser.add_argument('--bbox', nargs=4, type=float, default=None,
+                        help='MIN_LON MIN_LAT MAX_LON MAX_LAT')
+    parser.add_argument('--profiles', nargs=2, type=int, default=None)
+    parser.add_argument('--status', default=None,
+                        choices=[catfuncs.PARSED, catfuncs.CHECKPOINTED, catfuncs.DONE])
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        index_surveys()
+        return
+
+    transects = catfuncs.find_transects(args.location, args.years, args.bbox,
+                                        args.profiles, args.status)
+    if args.command == 'find':
+        with pd.option_context('display.max_rows', 20, 'display.width', 120):
+            print(transects[['location', 'year', 'profile', 'num_points',
+                             'status', 'qc_flag']])
+        print(f'{len(transects)} transects')
+        return
+
+    # Use the same settings as Automorph.py
+    settings = dict(SETTINGS)
+    settings['extra_columns'] = ufuncs.percentile_columns(settings['percentiles'])\
+        if settings['ensemble_size'] > 0 else []
+    for (location, year), group in transects.groupby(['location', 'year'], sort=False):
+        rerun_survey(location, year, list(group['profile']), settings)
+
+
+if __name__ == '__main__':
+    main()
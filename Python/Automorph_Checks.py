@@ -0,0 +1,768 @@
+"""
+Check that the fast paths in Automorph give the same results as the
+plain code they replace
+
+Each check runs random profiles through a fast path and through the
+plain code, prints how long each took and how far apart the results
+are, and fails if they are further apart than the check allows:
+
+    kernels     The NumPy and Numba kernels return the same indices as
+                the plain Python loops
+    ensemble    Every member of the Monte Carlo ensemble that is compared
+                matches the detectors run on that member alone
+    decimation  Every dropped point is within the tolerance of the
+                decimated profile and MHW, the crest, and the heel don't move
+    compact     Compact profiles move the landmarks and volumes less than
+                COMPACT_LIMITS
+    alongshore  The alongshore mode never has more crest jumps than
+                searching the whole profile, and none on a smooth coast
+    cloud       Profiles cut out of a point cloud have cross-shore distances
+                that only go one way and span the transect, at any bearing
+
+The decimation, compact, and alongshore checks use the parsed profiles of
+a survey instead of random ones when a location and year are given. Survey
+elevations are rounded, so a landmark that is picked from points at almost
+the same elevation can move to a neighboring point in a compact or
+decimated profile. For a survey the changes in the morphometrics are only
+printed and the rest is still checked. Exits with a non-zero status if any
+check fails
+
+Run from the Python folder:
+    python Automorph_Checks.py [kernels ensemble ...] [--survey LOCATION YEAR]
+"""
+
+from Functions import Compact_Functions as cmpfuncs
+from Functions import Data_Functions as dfuncs
+from Functions import Decimate_Functions as decfuncs
+from Functions import Kernel_Functions as kfuncs
+from Functions import Morpho_Functions as mfuncs
+from Functions import PointCloud_Functions as pcfuncs
+from Functions import Uncertainty_Functions as ufuncs
+from Automorph import SETTINGS, find_morphometrics, neighbor_prior
+
+import numpy as np
+import tempfile
+import argparse
+import shutil
+import time
+import sys
+import os
+
+
+# Check parameters
+SEED = 2021
+MHW = 0.34
+PAD = 0.5
+THRESHOLD = 0.6
+CREST_PCT = 0.1
+
+# Kernels
+KERNEL_PROFILES = 500
+
+# Ensemble
+ENSEMBLE_PROFILES = 20
+ENSEMBLE_SIZE = 1000
+NUM_COMPARE = 25        # Members per profile run one at a time
+
+# Decimation
+TOLERANCES = [0.01, 0.02, 0.05, 0.1]
+DECIMATE_PROFILES = 50
+DECIMATE_SPACING = 0.05     # Point spacing of the random profiles (m)
+UNMOVED = ['XMHW', 'XCrest', 'YCrest', 'XHeel']
+
+# Compact profiles. Largest change allowed in each morphometric
+COMPACT_PROFILES = 50
+COMPACT_SPACING = 0.25      # Average point spacing of the random profiles (m)
+COMPACT_LIMITS = {'XMHW': 1e-3, 'YMHW': 1e-6, 'XCrest': 1e-3, 'YCrest': 1e-5,
+                  'XHeel': 1e-3, 'XToe': 1e-3, 'YToe': 1e-5, 'XBerm': 1e-3,
+                  'Foreshore Slope': 1e-6, 'Dune Volume': 1e-3,
+                  'Beach Volume': 1e-3, 'Profile Volume': 1e-3}
+
+# Alongshore mode
+ALONGSHORE_PROFILES = 200
+ALONGSHORE_SPACING = 0.5    # Point spacing of the random profiles (m)
+MOUNDS = 0.3                # Share of the random profiles with a mound on the beach
+JUMP = 10.0                 # Crest moves between neighbors counted as jumps (m)
+
+# Point clouds
+CLOUD_EPSG = 3358
+CLOUD_BEARINGS = [0, 30, 45, 90, 135, 180, 225, 270, 315]
+CLOUD_LENGTH = 150.0        # Length of the transects (m)
+CLOUD_HALF_WIDTH = 1.0      # Half width of the transect corridors (m)
+CLOUD_DENSITY = 20          # Points per square meter
+CLOUD_LIMIT = 0.5           # Largest difference from the transect length (m)
+
+
+"""
+Functions to make profiles and run the detectors
+"""
+
+
+def survey_profiles(location, year):
+    """
+    Load the parsed profiles of a survey
+
+    location: String with the location
+    year: String with the year
+    """
+
+    folder = os.path.join('..', location, year, 'Profiles')
+    profiles = []
+    for profile in range(1, len(os.listdir(folder)) + 1):
+        X, y, _, _, lats, lons = dfuncs.setup_profile(location, year, profile)
+        profiles.append((X, y, lats, lons))
+
+    return profiles
+
+
+def run_profile(morpho, X, y, lats, lons, crossing=None):
+    """
+    Find the morphometrics for a profile with the Morpho_Functions
+    detectors in the same order as Automorph.py. The sand fence
+    landmarks are only found when there is a crossing
+
+    morpho: Dict with morphometrics
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    crossing: Array with the sand fence crossing on the profile (Default: None)
+    """
+
+    cache = mfuncs.profile_cache(X, y)
+    morpho = mfuncs.find_mhw(morpho, X, y, lats, lons, MHW, PAD, cache=cache)
+    morpho = mfuncs.find_crest(morpho, X, y, lats, lons, MHW,
+                               THRESHOLD, CREST_PCT, cache=cache)
+    morpho = mfuncs.find_heel(morpho, X, y, lats, lons, cache=cache)
+    morpho = mfuncs.find_toe(morpho, X, y, lats, lons, cache=cache)
+    morpho = mfuncs.find_berm(morpho, X, y, lats, lons, cache=cache)
+    if crossing is not None:
+        morpho = mfuncs.find_fence(morpho, X, y, lats, lons, crossing, cache=cache)
+        morpho = mfuncs.find_fence_crest(morpho, X, y, lats, lons, cache=cache)
+        morpho = mfuncs.find_fence_heel(morpho, X, y, lats, lons, cache=cache)
+        morpho = mfuncs.find_fence_toe(morpho, X, y, lats, lons, cache=cache)
+    morpho = mfuncs.dune_volume(X, y, morpho, cache)
+    morpho = mfuncs.beach_volume(X, y, morpho, cache)
+    morpho = mfuncs.profile_volume(X, y, morpho)
+    if crossing is not None:
+        morpho = mfuncs.fenced_dune_volume(X, y, morpho, cache)
+        morpho = mfuncs.total_dune_volume(X, y, morpho, cache)
+
+    return morpho
+
+
+def print_deltas(deltas):
+    """
+    Print the changes from decfuncs.morphometric_deltas()
+
+    deltas: Dict with the mean and largest change in each morphometric
+    """
+
+    for metric, delta in deltas.items():
+        print(f'    {metric:<18} mean {delta["mean"]:10.2e}  max {delta["max"]:10.2e}'
+              f'  missing {delta["missing"]}')
+
+
+def found_changes(original, changed, metrics):
+    """
+    Return the metrics that were found on a profile in one run but
+    not in the other, with the number of profiles where that happened
+
+    original: Dict with lists of the metrics from the first run
+    changed: Dict with lists of the metrics from the second run
+    metrics: List of strings with the metrics to compare
+    """
+
+    changes = {}
+    for metric in metrics:
+        a = np.asarray(original[metric], dtype=np.float64)
+        b = np.asarray(changed[metric], dtype=np.float64)
+        count = int(np.sum((np.isfinite(a) & (a < 9999)) != (np.isfinite(b) & (b < 9999))))
+        if count > 0:
+            changes[metric] = count
+
+    return changes
+
+
+"""
+Kernels
+"""
+
+
+def kernel_cases(rng):
+    """
+    Make random inputs for every kernel: dune-like profiles with noise
+    and flat spots, and unevenly spaced cross-shore distances like a
+    decimated profile
+
+    rng: NumPy random Generator
+    """
+
+    cases = []
+    for _ in range(KERNEL_PROFILES):
+        n = int(rng.integers(5, 800))
+        s = np.linspace(0, 1, n)
+        y = 3 * np.exp(-((s - rng.uniform(0.2, 0.8)) / rng.uniform(0.02, 0.2)) ** 2)
+        y += np.cumsum(rng.normal(0, 0.05, n)) + rng.uniform(-1, 2) * s
+        flat = int(rng.integers(0, n))
+        y[flat:flat + int(rng.integers(1, 20))] = y[flat]
+        y = np.round(y, 3)
+        x = np.cumsum(rng.uniform(0.05, 2, n))[::-1]
+        pks_idx = np.flatnonzero((y[1:-1] > y[:-2]) & (y[1:-1] >= y[2:])) + 1
+        crest_idx = int(rng.integers(0, n))
+        lo, hi = sorted(rng.integers(0, n, size=2))
+        cases.append((y, x, pks_idx, crest_idx, int(lo), int(hi)))
+
+    return cases
+
+
+def run_kernels(kernels, cases):
+    """
+    Run every case through a set of kernels and return the
+    results and the average time per call in microseconds
+
+    kernels: Dict with the kernels to use
+    cases: List of inputs from kernel_cases()
+    """
+
+    results = []
+    start_time = time.perf_counter()
+    for y, x, pks_idx, crest_idx, lo, hi in cases:
+        results.append((int(kernels['backshore_peak'](y, pks_idx, THRESHOLD)),
+                        int(kernels['heel_walk'](y, crest_idx, THRESHOLD)),
+                        int(kernels['toe_search'](y, x, lo, hi))))
+    elapsed = (time.perf_counter() - start_time) / (3 * len(cases)) * 1e6
+
+    return results, elapsed
+
+
+def check_kernels(survey=None):
+    """
+    Check that every installed kernel backend matches the plain loops.
+    Returns a list with the failures
+
+    survey: Not used, the kernels are checked on random inputs
+    """
+
+    cases = kernel_cases(np.random.default_rng(SEED))
+
+    # The plain loops are the reference
+    backends = {'python': {'backshore_peak': kfuncs._backshore_peak_loop,
+                           'heel_walk': kfuncs._heel_walk_loop,
+                           'toe_search': kfuncs._toe_search_loop}}
+    for name in ('numpy', 'numba'):
+        try:
+            kfuncs.set_backend(name)
+            backends[name] = kfuncs.kernels()
+        except ImportError:
+            print(f'{name:<8} not installed, skipped')
+    kfuncs.set_backend('auto')
+
+    failures, reference = [], None
+    for name, kernels in backends.items():
+        run_kernels(kernels, cases[:5])
+        results, elapsed = run_kernels(kernels, cases)
+        if reference is None:
+            reference = results
+        mismatches = sum(a != b for a, b in zip(results, reference))
+        print(f'{name:<8}{elapsed:10.1f} us/call  {mismatches} mismatches')
+        if mismatches > 0:
+            failures.append(f'The {name} kernels disagree on {mismatches} of {len(cases)} cases')
+
+    return failures
+
+
+"""
+Monte Carlo ensemble
+"""
+
+
+def ensemble_profile(rng):
+    """
+    Make a random profile with a beach, a fenced dune, and a natural
+    dune. Returns the profile and the index of the fence. The indices
+    increase landward
+
+    rng: NumPy random Generator
+    """
+
+    n = int(rng.integers(200, 600))
+    X = np.linspace(200, 0, n)
+    s = 200 - X
+    y = 0.02 * s - 0.5
+    y += rng.uniform(0.2, 0.8) * np.exp(-((s - rng.uniform(50, 70)) / 4) ** 2)
+    y += rng.uniform(2, 5) * np.exp(-((s - rng.uniform(100, 130)) / 10) ** 2)
+    y += rng.uniform(0, 0.4) * np.exp(-((s - 30) / 3) ** 2)
+    fence_idx = int(np.argmin(np.abs(s - rng.uniform(45, 60))))
+
+    return X, y, fence_idx
+
+
+def run_member(X, y, fence_idx):
+    """
+    Run one member of an ensemble through the detectors and return
+    a dict with its morphometrics, with NaN where one is missing
+
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    fence_idx: Int with the fence index
+    """
+
+    lats = np.linspace(34, 34.002, len(y))
+    lons = np.full(len(y), -77.0)
+    crossing = np.array([[lats[fence_idx], lons[fence_idx]]])
+    morpho = run_profile(dfuncs.morpho_dict(), X, y, lats, lons, crossing)
+
+    return {key: np.nan if values[-1] == 9999 else values[-1]
+            for key, values in morpho.items() if len(values) > 0}
+
+
+def check_ensemble(survey=None):
+    """
+    Check that the members of the Monte Carlo ensemble match the
+    detectors run one member at a time. Returns a list with the failures
+
+    survey: Not used, the ensemble is checked on random profiles
+    """
+
+    rng = np.random.default_rng(SEED)
+    model = ufuncs.error_model(sigma=0.15, correlation_length=2.0, bias=0.05)
+
+    mismatches, compared = {}, 0
+    ensemble_time, single_time = 0.0, 0.0
+    for _ in range(ENSEMBLE_PROFILES):
+        X, y, fence_idx = ensemble_profile(rng)
+        seed = int(rng.integers(1e9))
+
+        # Run the whole ensemble at once
+        start_time = time.perf_counter()
+        ensemble = ufuncs.run_ensemble(X, y, MHW, PAD, ENSEMBLE_SIZE, model, fence_idx,
+                                       THRESHOLD, CREST_PCT, np.random.default_rng(seed))
+        ensemble_time += time.perf_counter() - start_time
+
+        # Run the first members one at a time on the same elevations
+        Y = ufuncs.perturb(X, y, ENSEMBLE_SIZE, model, np.random.default_rng(seed))
+        start_time = time.perf_counter()
+        for member in range(NUM_COMPARE):
+            try:
+                single = run_member(X, Y[member], fence_idx)
+            except ValueError:
+                # The crest re-adjustment in find_heel fails
+                # when the heel is on the crest
+                continue
+            for metric in ufuncs.METRICS:
+                if metric in single and not np.isclose(single[metric], ensemble[metric][member],
+                                                       rtol=1e-6, atol=1e-6, equal_nan=True):
+                    mismatches[metric] = mismatches.get(metric, 0) + 1
+            compared += 1
+        single_time += (time.perf_counter() - start_time) / NUM_COMPARE
+
+    print(f'{compared} members compared, {sum(mismatches.values())} mismatches')
+    print(f'Ensemble of {ENSEMBLE_SIZE}: {ensemble_time / ENSEMBLE_PROFILES * 1000:.1f} '
+          f'ms/profile (one at a time: '
+          f'{single_time * ENSEMBLE_SIZE / ENSEMBLE_PROFILES * 1000:.1f} ms/profile)')
+
+    return [f'{metric} differs from the detectors on {count} members'
+            for metric, count in mismatches.items()]
+
+
+"""
+Decimation
+"""
+
+
+def decimate_profiles(rng):
+    """
+    Make dense random profiles with a beach, a dune, and a
+    little noise. The indices increase landward
+
+    rng: NumPy random Generator
+    """
+
+    profiles = []
+    for _ in range(DECIMATE_PROFILES):
+        X = np.arange(200, 0, -DECIMATE_SPACING)
+        s = 200 - X
+        y = 0.02 * s - 0.5
+        y += rng.uniform(2, 5) * np.exp(-((s - rng.uniform(100, 130)) / 10) ** 2)
+        y += rng.uniform(0, 0.4) * np.exp(-((s - 30) / 3) ** 2)
+        y += np.cumsum(rng.normal(0, 0.002, len(s)))
+        lats = np.linspace(34, 34.002, len(s))
+        lons = np.full(len(s), -77.0)
+        profiles.append((X, y, lats, lons))
+
+    return profiles
+
+
+def run_decimated(profiles, tolerance=None):
+    """
+    Run every profile and return the morpho dict, the average time per
+    profile (ms), the number of points used, and the largest vertical
+    distance from a dropped point to the decimated profile
+
+    profiles: List of (X, y, lats, lons) tuples
+    tolerance: Float with the decimation tolerance, None to not decimate
+    """
+
+    morpho, points, error = dfuncs.morpho_dict(), 0, 0.0
+    start_time = time.perf_counter()
+    for X, y, lats, lons in profiles:
+        if tolerance is not None:
+            X_dec, y_dec, lats, lons = decfuncs.decimate_profile(X, y, lats, lons,
+                                                                 tolerance, MHW)
+            error = max(error, np.max(np.abs(y - np.interp(X, X_dec[::-1], y_dec[::-1]))))
+            X, y = X_dec, y_dec
+        points += len(y)
+        morpho = run_profile(morpho, X, y, lats, lons)
+    elapsed = (time.perf_counter() - start_time) / len(profiles) * 1000
+
+    return morpho, elapsed, points, error
+
+
+def check_decimation(survey=None):
+    """
+    Check that decimating keeps every point within the tolerance and, on
+    the random profiles, doesn't move MHW, the crest, or the heel. Returns
+    a list with the failures
+
+    survey: Tuple with the location and year to use (Default: None, random profiles)
+    """
+
+    if survey is not None:
+        profiles = survey_profiles(*survey)
+    else:
+        profiles = decimate_profiles(np.random.default_rng(SEED))
+
+    # Run without decimation as the reference
+    original, original_time, original_points, _ = run_decimated(profiles)
+    print(f'{len(profiles)} profiles, {original_points} points, '
+          f'{original_time:.1f} ms/profile without decimation')
+
+    failures = []
+    for tolerance in TOLERANCES:
+        decimated, elapsed, points, error = run_decimated(profiles, tolerance)
+        ratio = decfuncs.compression_ratio(original_points, points)
+        print(f'Tolerance {tolerance} m: {ratio:.1f}x compression, {elapsed:.1f} ms/profile '
+              f'(includes decimating), largest error {error:.4f} m')
+        deltas = decfuncs.morphometric_deltas(original, decimated, decfuncs.REPORT_METRICS)
+        print_deltas(deltas)
+
+        if error > tolerance * (1 + 1e-9):
+            failures.append(f'A dropped point is {error:.4f} m from the profile '
+                            f'decimated at {tolerance} m')
+        if survey is not None:
+            continue
+        for metric in UNMOVED:
+            if deltas[metric]['max'] > 0:
+                failures.append(f'{metric} moved up to {deltas[metric]["max"]:.4f} '
+                                f'at a tolerance of {tolerance} m')
+        for metric, count in found_changes(original, decimated, UNMOVED).items():
+            failures.append(f'{metric} was found on {count} profiles only with or '
+                            f'without decimating at {tolerance} m')
+
+    return failures
+
+
+"""
+Compact profiles
+"""
+
+
+def compact_profiles(rng):
+    """
+    Make random profiles with a beach and a dune, several hundred meters
+    from the start of the cross-shore distance so float32 rounding shows.
+    The points wander a little off of a straight line. The indices
+    increase landward
+
+    rng: NumPy random Generator
+    """
+
+    profiles = []
+    for _ in range(COMPACT_PROFILES):
+        s = np.cumsum(rng.uniform(0.5, 1.5, int(200 / COMPACT_SPACING)) * COMPACT_SPACING)
+        X = 700 - s
+        y = 0.02 * s - 0.5
+        y += rng.uniform(2, 5) * np.exp(-((s - rng.uniform(100, 130)) / 10) ** 2)
+        y += rng.normal(0, 0.02, len(s))
+        lats = 35.0 + 9e-6 * s + rng.normal(0, 2e-6, len(s))
+        lons = np.full(len(s), -75.7) + rng.normal(0, 2e-6, len(s))
+        profiles.append((X, y, lats, lons))
+
+    return profiles
+
+
+def run_compact(profiles, compact=False):
+    """
+    Run every profile the way Automorph.py does and return the morpho
+    dict, the average memory per profile (bytes), and the largest
+    distance (m) a point moved
+
+    profiles: List of (X, y, lats, lons) tuples
+    compact: Bool to run the compact profiles (Default: False)
+    """
+
+    settings = dict(SETTINGS, extra_columns=[])
+    morpho, nbytes, error = dfuncs.morpho_dict(), 0, 0.0
+    for profile, data in enumerate(profiles, start=1):
+        if compact:
+            lats, lons = data[2], data[3]
+            data = cmpfuncs.compact_profile(*data)
+            error = max(error, cmpfuncs.position_error(lats, lons, data))
+        nbytes += cmpfuncs.profile_nbytes(data)
+        X, y, lats, lons = cmpfuncs.profile_arrays(data)
+        morpho = find_morphometrics(morpho, profile, X, y, lats, lons, settings)
+
+    return morpho, nbytes / len(profiles), error
+
+
+def check_compact(survey=None):
+    """
+    Check that compact profiles move the landmarks and volumes of the
+    random profiles less than COMPACT_LIMITS. Returns a list with the
+    failures
+
+    survey: Tuple with the location and year to use (Default: None, random profiles)
+    """
+
+    if survey is not None:
+        profiles = survey_profiles(*survey)
+    else:
+        profiles = compact_profiles(np.random.default_rng(SEED))
+
+    original, original_bytes, _ = run_compact(profiles)
+    compact, compact_bytes, error = run_compact(profiles, compact=True)
+    print(f'{len(profiles)} profiles: {original_bytes / 1024:.1f} KB/profile loaded, '
+          f'{compact_bytes / 1024:.1f} KB/profile compact '
+          f'({original_bytes / compact_bytes:.1f}x smaller)')
+    print(f'Largest distance a point moved off of the transect: {error:.3f} m')
+    deltas = decfuncs.morphometric_deltas(original, compact, list(COMPACT_LIMITS))
+    print_deltas(deltas)
+    if survey is not None:
+        return []
+
+    failures = [f'{metric} changed by up to {deltas[metric]["max"]:.2e}, '
+                f'more than {limit:g}'
+                for metric, limit in COMPACT_LIMITS.items() if deltas[metric]['max'] > limit]
+    for metric, count in found_changes(original, compact, list(COMPACT_LIMITS)).items():
+        failures.append(f'{metric} was found on {count} profiles only as loaded or compact')
+
+    return failures
+
+
+"""
+Alongshore mode
+"""
+
+
+def alongshore_profiles(rng):
+    """
+    Make random profiles of a coastline. The dune crest wanders a little
+    from one profile to the next and some profiles have a mound on the
+    beach seaward of the dune. The indices increase landward
+
+    rng: NumPy random Generator
+    """
+
+    crest = 110 + np.cumsum(rng.normal(0, 1.0, ALONGSHORE_PROFILES))
+    profiles = []
+    for center in crest:
+        s = np.arange(0, 200, ALONGSHORE_SPACING)
+        X = 200 - s
+        y = 0.02 * s - 0.5
+        y += rng.uniform(3, 4) * np.exp(-((s - center) / 10) ** 2)
+        if rng.random() < MOUNDS:
+            y += rng.uniform(0.5, 1.0) * np.exp(-((s - center + 35) / 3) ** 2)
+        y += rng.normal(0, 0.02, len(s))
+        lats = 35.0 + 9e-6 * s
+        lons = np.full(len(s), -75.7)
+        profiles.append((X, y, lats, lons))
+
+    return profiles
+
+
+def run_alongshore(profiles, alongshore=False):
+    """
+    Run every profile in order the way Automorph.py does and return
+    the morpho dict and the average time per profile (ms)
+
+    profiles: List of (X, y, lats, lons) tuples
+    alongshore: Bool to use the profile before as a prior (Default: False)
+    """
+
+    settings = dict(SETTINGS, extra_columns=[], alongshore=alongshore)
+    morpho = dfuncs.morpho_dict()
+    start_time = time.perf_counter()
+    for profile, (X, y, lats, lons) in enumerate(profiles, start=1):
+        morpho = find_morphometrics(morpho, profile, X, y, lats, lons, settings,
+                                    prior=neighbor_prior(morpho, profile, settings))
+    elapsed = time.perf_counter() - start_time
+
+    return morpho, elapsed * 1000 / len(profiles)
+
+
+def check_alongshore(survey=None):
+    """
+    Check that the alongshore mode never has more crest jumps than
+    searching the whole profile, and none on the random coast where the
+    dune wanders slowly. Returns a list with the failures
+
+    survey: Tuple with the location and year to use (Default: None, random profiles)
+    """
+
+    if survey is not None:
+        profiles = survey_profiles(*survey)
+    else:
+        profiles = alongshore_profiles(np.random.default_rng(SEED))
+
+    # Run once first so the kernels are compiled before the timing
+    run_alongshore(profiles[:2])
+    full, full_ms = run_alongshore(profiles)
+    coherent, coherent_ms = run_alongshore(profiles, alongshore=True)
+    print(f'{len(profiles)} profiles: {full_ms:.2f} ms/profile searching the whole '
+          f'profile, {coherent_ms:.2f} ms/profile alongshore')
+
+    jumps = {}
+    for name, morpho in [('whole profile', full), ('alongshore', coherent)]:
+        jumps[name] = int(np.sum(np.abs(np.diff(np.asarray(morpho['XCrest'], dtype=float)))
+                                 > JUMP))
+        print(f'    Crest jumps over {JUMP:g} m, {name}: {jumps[name]}')
+    for metric in ['XCrest', 'XHeel', 'XToe']:
+        changed = np.sum(np.asarray(full[metric]) != np.asarray(coherent[metric]))
+        print(f'    {metric:<8} changed on {changed} profiles')
+
+    failures = []
+    if jumps['alongshore'] > jumps['whole profile']:
+        failures.append(f'The alongshore mode has {jumps["alongshore"]} crest jumps, '
+                        f'more than the {jumps["whole profile"]} searching the whole profile')
+    if survey is None and jumps['alongshore'] > 0:
+        failures.append(f'The alongshore mode has {jumps["alongshore"]} crest jumps '
+                        f'on a coast without any')
+
+    return failures
+
+
+"""
+Point clouds
+"""
+
+
+def write_cloud(folder, rng):
+    """
+    Write an ASCII point cloud with a dune profile along a transect at
+    each of CLOUD_BEARINGS and the transect file that goes with it.
+    The points are spread across a corridor wider than the one kept.
+    Returns the paths to the point cloud and the transect file
+
+    folder: String with the folder to write to
+    rng: NumPy random Generator
+    """
+
+    transects, clouds = [], []
+    for number, bearing in enumerate(CLOUD_BEARINGS):
+        ux, uy = np.cos(np.radians(bearing)), np.sin(np.radians(bearing))
+        x_start, y_start = 600000.0 + 500 * number, 200000.0
+        transects.append((x_start, y_start,
+                          x_start + CLOUD_LENGTH * ux, y_start + CLOUD_LENGTH * uy))
+
+        num_points = int(CLOUD_DENSITY * CLOUD_LENGTH * 4 * CLOUD_HALF_WIDTH)
+        along = rng.uniform(0, CLOUD_LENGTH, num_points)
+        across = rng.uniform(-2 * CLOUD_HALF_WIDTH, 2 * CLOUD_HALF_WIDTH, num_points)
+        z = 0.02 * along - 0.5 + 3 * np.exp(-((along - 100) / 10) ** 2)
+        clouds.append(np.column_stack((x_start + along * ux - across * uy,
+                                       y_start + along * uy + across * ux, z)))
+
+    cloud_file = os.path.join(folder, 'Cloud.pts')
+    np.savetxt(cloud_file, rng.permutation(np.concatenate(clouds)), fmt='%.3f',
+               header='X Y Z')
+    transect_file = os.path.join(folder, 'Cloud Transects.csv')
+    with open(transect_file, 'w') as outfile:
+        outfile.write('X Start,Y Start,X End,Y End\n')
+        for transect in transects:
+            outfile.write(','.join(f'{value:.3f}' for value in transect) + '\n')
+
+    return cloud_file, transect_file
+
+
+def check_cloud(survey=None):
+    """
+    Check that the cross-shore distances of profiles cut out of a point
+    cloud only go one way and span the transect. Returns a list with the
+    failures
+
+    survey: Not used, the check writes its own point cloud
+    """
+
+    folder = tempfile.mkdtemp(prefix='automorph_check_')
+    try:
+        cloud_file, transect_file = write_cloud(folder, np.random.default_rng(SEED))
+        start_time = time.perf_counter()
+        profiles = list(pcfuncs.cloud_profiles(cloud_file, transect_file, CLOUD_EPSG,
+                                               half_width=CLOUD_HALF_WIDTH))
+        elapsed = time.perf_counter() - start_time
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    print(f'{len(profiles)} profiles cut in {elapsed:.2f} s')
+
+    failures = []
+    for (profile, data), bearing in zip(profiles, CLOUD_BEARINGS):
+        dist_cross = data[0]
+        steps = np.diff(dist_cross)
+        monotonic = np.all(steps <= 0) or np.all(steps >= 0)
+        span = np.max(dist_cross) - np.min(dist_cross)
+        print(f'    Bearing {bearing:>3}: {len(dist_cross)} points, spans {span:.2f} m, '
+              f'{"monotonic" if monotonic else "not monotonic"}')
+        if not monotonic:
+            failures.append(f'The cross-shore distances of the profile at a bearing of '
+                            f'{bearing} go back and forth')
+        if abs(span - CLOUD_LENGTH) > CLOUD_LIMIT:
+            failures.append(f'The profile at a bearing of {bearing} spans {span:.2f} m '
+                            f'of a {CLOUD_LENGTH:g} m transect')
+
+    return failures
+
+
+"""
+Run the checks
+"""
+
+
+CHECKS = {'kernels': check_kernels,
+          'ensemble': check_ensemble,
+          'decimation': check_decimation,
+          'compact': check_compact,
+          'alongshore': check_alongshore,
+          'cloud': check_cloud}
+
+
+def main():
+    """
+    Run the checks
+    """
+
+    parser = argparse.ArgumentParser(description='Check the fast paths in Automorph')
+    parser.add_argument('checks', nargs='*', default=list(CHECKS),
+                        help=f'Checks to run: {", ".join(CHECKS)} (Default: all)')
+    parser.add_argument('--survey', nargs=2, default=None, metavar=('LOCATION', 'YEAR'),
+                        help='Use the parsed profiles of a survey')
+    args = parser.parse_args()
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if len(unknown) > 0:
+        parser.error(f'Unknown checks: {", ".join(unknown)}')
+
+    failures = {}
+    for name in args.checks:
+        print(f'\n---- {name} ----')
+        failures[name] = CHECKS[name](args.survey)
+        for failure in failures[name]:
+            print(f'FAILED: {failure}')
+
+    print()
+    for name, found in failures.items():
+        print(f'{name:<12} {"FAILED" if len(found) > 0 else "passed"}')
+
+    sys.exit(1 if any(len(found) > 0 for found in failures.values()) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Send profiles to the Automorph service and measure how fast it answers
+
+With a file the profiles in it are sent to the service and the
+morphometrics are printed. With --load the client instead sends random
+dune profiles from several threads at once and prints the latency
+percentiles and the throughput, so the cost of a warm request can be
+compared against a full run of Automorph.py
+
+Start the service first (python Automorph_Service.py), then from the
+Python folder:
+    python Automorph_Client.py PROFILES.xyz [--epsg 3358]
+    python Automorph_Client.py --load 500 [--concurrency 4] [--batch 1]
+
+Use --url unix:/path/to/socket for a service on a Unix socket
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import http.client
+import argparse
+import threading
+import socket
+import json
+import time
+import sys
+
+
+# Client parameters
+URL = 'http://127.0.0.1:8765'
+TIMEOUT = 60.0
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket
+    """
+
+    def __init__(self, path, timeout=TIMEOUT):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+"""
+Functions to talk to the service
+"""
+
+
+def connect(url=URL, timeout=TIMEOUT):
+    """
+    Open a connection to the service. The connection is kept
+    open so it can be used for many requests
+
+    url: String with "http://host:port" or "unix:/path/to/socket" (Default: URL)
+    timeout: Float with the seconds to wait for a reply (Default: TIMEOUT)
+    """
+
+    if url.startswith('unix:'):
+        return UnixHTTPConnection(url[len('unix:'):], timeout)
+    host = url.split('://', 1)[-1].rstrip('/')
+
+    return http.client.HTTPConnection(host, timeout=timeout)
+
+
+def send(connection, method, path, payload=None):
+    """
+    Send a request and return the HTTP status and the reply
+
+    connection: Connection from connect()
+    method: String with "GET" or "POST"
+    path: String with the endpoint
+    payload: Dict to send as JSON (Default: None)
+    """
+
+    body = None if payload is None else json.dumps(payload)
+    headers = {} if body is None else {'Content-Type': 'application/json'}
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+
+    return response.status, json.loads(response.read())
+
+
+def morphometrics(connection, profiles=None, xyz=None, epsg=None, settings=None):
+    """
+    Return a list with the morphometrics of each profile. Raises a
+    RuntimeError if the service couldn't run the request
+
+    connection: Connection from connect()
+    profiles: List of {"x": [...], "z": [...]} dicts (Default: None)
+    xyz: String with .xyz text (Default: None)
+    epsg: Int with the projection of the .xyz text (Default: None, the service default)
+    settings: Dict with detection settings to change (Default: None)
+    """
+
+    payload = {}
+    if profiles is not None:
+        payload['profiles'] = profiles
+    if xyz is not None:
+        payload['xyz'] = xyz
+    if epsg is not None:
+        payload['epsg'] = epsg
+    if settings is not None:
+        payload['settings'] = settings
+    status, reply = send(connection, 'POST', '/morphometrics', payload)
+    if status != 200:
+        raise RuntimeError(f'The service replied {status}: {reply.get("error")}')
+
+    return reply['results']
+
+
+"""
+Functions for the load test
+"""
+
+
+def random_profiles(rng, count, spacing=0.5):
+    """
+    Make random profiles with a beach and a dune as
+    request dicts. The indices increase landward
+
+    rng: NumPy random Generator
+    count: Int with the number of profiles
+    spacing: Float with the point spacing (m) (Default: 0.5)
+    """
+
+    profiles = []
+    for _ in range(count):
+        X = np.arange(200, 0, -spacing)
+        s = 200 - X
+        z = 0.02 * s - 0.5
+        z += rng.uniform(2, 5) * np.exp(-((s - rng.uniform(100, 130)) / 10) ** 2)
+        z += rng.normal(0, 0.02, len(s))
+        profiles.append({'x': X.round(3).tolist(), 'z': z.round(3).tolist()})
+
+    return profiles
+
+
+def load_test(url, requests, concurrency, batch):
+    """
+    Send random profiles from several threads at once and
+    print the latency percentiles and the throughput
+
+    url: String with the service address
+    requests: Int with the number of requests to send
+    concurrency: Int with the number of threads sending requests
+    batch: Int with the number of profiles in each request
+    """
+
+    payloads = random_profiles(np.random.default_rng(2021), batch * requests)
+    payloads = [payloads[ii * batch:(ii + 1) * batch] for ii in range(requests)]
+    local = threading.local()
+
+    def run(profiles):
+        if not hasattr(local, 'connection'):
+            local.connection = connect(url)
+        start_time = time.perf_counter()
+        try:
+            morphometrics(local.connection, profiles)
+            ok = True
+        except RuntimeError:
+            ok = False
+        return (time.perf_counter() - start_time) * 1000, ok
+
+    # One warm request first so the connection setup isn't timed
+    run(payloads[0])
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run, payloads))
+    elapsed = time.perf_counter() - start_time
+
+    latency = np.array([ms for ms, _ in results])
+    failed = sum(not ok for _, ok in results)
+    print(f'{requests} requests of {batch} profile(s) from {concurrency} thread(s), '
+          f'{failed} failed')
+    print(f'Latency (ms): p50 {np.percentile(latency, 50):.1f}  '
+          f'p90 {np.percentile(latency, 90):.1f}  p99 {np.percentile(latency, 99):.1f}  '
+          f'max {latency.max():.1f}')
+    print(f'Throughput: {requests / elapsed:.1f} requests/s, '
+          f'{requests * batch / elapsed:.1f} profiles/s')
+
+    connection = connect(url)
+    _, status = send(connection, 'GET', '/health')
+    print(f'Service: {status["requests"]} requests, mean {status["mean_ms"]:.1f} ms '
+          f'inside the service')
+
+
+def main():
+    """
+    Run the client
+    """
+
+    parser = argparse.ArgumentParser(description='Send profiles to the Automorph service')
+    parser.add_argument('file', nargs='?', help='.xyz file with the profiles to send')
+    parser.add_argument('--url', default=URL)
+    parser.add_argument('--epsg', type=int, default=None)
+    parser.add_argument('--load', type=int, default=0, help='Requests to send in a load test')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=1, help='Profiles per load test request')
+    args = parser.parse_args()
+
+    if args.load > 0:
+        load_test(args.url, args.load, args.concurrency, args.batch)
+    elif args.file is not None:
+        with open(args.file) as xyz_file:
+            xyz = xyz_file.read()
+        start_time = time.perf_counter()
+        records = morphometrics(connect(args.url), xyz=xyz, epsg=args.epsg)
+        elapsed = (time.perf_counter() - start_time) * 1000
+        for record in records:
+            print(json.dumps(record))
+        print(f'{len(records)} profiles in {elapsed:.1f} ms', file=sys.stderr)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
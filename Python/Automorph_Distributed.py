@@ -0,0 +1,520 @@
+"""
+Run Automorph on many machines at once
+
+The work for every survey in the data folder is split into tasks: one
+to parse the survey into profile files, one for each chunk of profiles,
+and one to merge the chunks into the same "Morphometrics for <location>
+<year>.csv" that Automorph.py writes (and move the data file, as it does).
+The tasks run on any executor with the concurrent.futures interface. A
+Dask cluster is used when a scheduler address is given and local worker
+processes are used when it isn't, which is also how the runner is tested
+
+Every task reads its inputs from and writes its results to the usual
+location and year folders, so the repository has to be on storage shared
+by every node and the workers have to run from the Python folder. A chunk
+is written to a temporary file that is renamed into place, and a task
+whose result already exists does nothing, so a failed or lost task can
+be run again safely and a stopped run picks up where it left off. A
+survey whose data file changed since it was parsed is parsed again
+
+In the alongshore mode the chunks of a survey are run one after another
+so that every profile has the same prior it has in Automorph.py
+
+Run from the Python folder:
+    python Automorph_Distributed.py [--scheduler ADDRESS] [--workers N]
+                                    [--chunk 200] [--format csv] [--retries 2]
+"""
+
+from Functions import Data_Functions as dfuncs
+from Functions import Geodesy_Functions as gfuncs
+from Functions import Morpho_Functions as mfuncs
+from Functions import Uncertainty_Functions as ufuncs
+from Automorph import (DATA_DIR, SETTINGS, FALLBACK, find_surveys, parse_survey,
+                       write_survey, load_profile, find_morphometrics, neighbor_prior,
+                       check_batch)
+from Automorph_Catalog import saved_prior
+from concurrent.futures import Executor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import multiprocessing
+import pandas as pd
+import importlib.util
+import importlib
+import argparse
+import json
+import glob
+import sys
+import os
+
+
+# Runner parameters
+CHUNK_SIZE = 200        # Profiles in each chunk task
+QC_BATCH = 50           # Profiles checked at once, as checkpoint_every in Automorph.py
+FORMATS = ('csv', 'parquet')
+PARQUET_ENGINES = ('pyarrow', 'fastparquet')
+RETRIES = 2             # Times a failed task is run again
+
+
+"""
+Functions for the task results
+"""
+
+
+def chunk_folder(location, year):
+    """
+    Return the folder the chunk results for a survey are written to
+
+    location: String with the location
+    year: String with the year being looked at
+    """
+
+    return os.path.join('..', f'{location}', f'{year}', 'Chunks')
+
+
+def chunk_file(location, year, first, last, fmt='csv'):
+    """
+    Return the path to the result of a chunk of profiles
+
+    location: String with the location
+    year: String with the year being looked at
+    first: Int with the first profile in the chunk
+    last: Int with the last profile in the chunk
+    fmt: String with "csv" or "parquet" (Default: "csv")
+    """
+
+    return os.path.join(chunk_folder(location, year),
+                        f'{location} {year} {first:05d}-{last:05d}.{fmt}')
+
+
+def parsed_file(location, year):
+    """
+    Return the path to the file marking that a
+    survey has been parsed into profile files
+
+    location: String with the location
+    year: String with the year being looked at
+    """
+
+    return os.path.join('..', f'{location}', f'{year}', f'{location} {year} Parsed.json')
+
+
+def source_stamp(survey):
+    """
+    Return a dict with the size and modification time of the data file
+    of a survey, and of its transect file if it has one, so a parse can
+    be redone when they change
+
+    survey: Dict with a survey from find_surveys()
+    """
+
+    fnames = [os.path.join(DATA_DIR, survey['file'])]
+    if survey['use_dem'] or survey['use_cloud']:
+        fnames.append(survey['transect_file'])
+
+    stamp = {}
+    for fname in fnames:
+        info = os.stat(fname)
+        stamp[os.path.basename(fname)] = {'Size': info.st_size, 'Modified': info.st_mtime_ns}
+
+    return stamp
+
+
+def parsed_current(marker, stamp):
+    """
+    Check if a survey was parsed from the data it has now
+
+    marker: String with the path to the file from parsed_file()
+    stamp: Dict with the data files from source_stamp()
+    """
+
+    try:
+        with open(marker) as infile:
+            return json.load(infile).get('Sources') == stamp
+    except (OSError, ValueError):
+        return False
+
+
+def write_atomic(df, fname, fmt='csv'):
+    """
+    Write a DataFrame to a temporary file, force it to disk, and rename it
+    into place so that a reader never sees a half written file. Writing
+    the same result twice leaves the same file
+
+    df: DataFrame to write
+    fname: String with the path to write to
+    fmt: String with "csv" or "parquet" (Default: "csv")
+    """
+
+    temp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(temp_fname, 'wb') as outfile:
+        if fmt == 'parquet':
+            df.to_parquet(outfile, index=False)
+        else:
+            outfile.write(df.to_csv(index=False).encode())
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_fname, fname)
+
+
+def read_chunk(fname):
+    """
+    Load the result of a chunk of profiles
+
+    fname: String with the path to the chunk result
+    """
+
+    if fname.endswith('.parquet'):
+        return pd.read_parquet(fname)
+
+    return pd.read_csv(fname, header=0, float_precision='round_trip')
+
+
+"""
+Tasks. These run on the workers
+"""
+
+
+def start_worker():
+    """
+    Set up a worker process to save figures without a display
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def parse_task(survey, epsg, dem_spacing=None, cloud_half_width=1.0, cloud_classes=(2,)):
+    """
+    Parse a survey into profile files unless it was already parsed.
+    Returns the survey dict with the location, year, number of profiles,
+    the profiles that have a profile file, and whether the morphometrics
+    are already saved added to it
+
+    survey: Dict with a survey from find_surveys()
+    epsg: Int with the number code for the in projection
+    dem_spacing: Float with the sample spacing along DEM transects (Default: None)
+    cloud_half_width: Float with the half width of point cloud transects (Default: 1.0)
+    cloud_classes: List of LAS classes to use (Default: (2,))
+    """
+
+    file, transect_file = survey['file'], survey['transect_file']
+    location, year, num_profiles = dfuncs.get_basic_information(
+        file, transect_file if survey['use_dem'] or survey['use_cloud'] else None)
+    profiles = dfuncs.parsed_profiles(location, year, num_profiles)
+    survey_done = len(profiles) > 0 and dfuncs.survey_complete(location, year, profiles)
+
+    # Parse the profiles and then mark the survey as parsed with the size
+    # and modification time of its data. A parse that stops partway is
+    # started over on the retry, and a survey whose data changed since it
+    # was parsed is parsed again without the chunk results from before
+    marker = parsed_file(location, year)
+    stamp = source_stamp(survey)
+    if not survey_done and not parsed_current(marker, stamp):
+        for fname in glob.glob(os.path.join(chunk_folder(location, year), '*')):
+            os.remove(fname)
+        parse_survey(survey, location, year, num_profiles, epsg,
+                     dem_spacing, cloud_half_width, cloud_classes)
+        with open(f'{marker}.tmp', 'w') as outfile:
+            json.dump({'Profiles': num_profiles, 'Sources': stamp}, outfile)
+        os.replace(f'{marker}.tmp', marker)
+        profiles = dfuncs.parsed_profiles(location, year, num_profiles)
+
+    return dict(survey, location=location, year=year, num_profiles=num_profiles,
+                profiles=profiles, survey_done=survey_done)
+
+
+def chunk_task(location, year, profiles, settings, fmt='csv', lead=None):
+    """
+    Find the morphometrics for a chunk of profiles, check them, rerun the
+    failures with the fallback settings, and write them to the chunk result
+    file. Does nothing if the result already exists. Returns the path to
+    the result
+
+    location: String with the location
+    year: String with the year being looked at
+    profiles: List of ints with the profiles in the chunk
+    settings: Dict with the run settings
+    fmt: String with "csv" or "parquet" (Default: "csv")
+    lead: String with the path to the result of the chunk before this one. In
+          the alongshore mode its last profile is the prior for the first
+          profile of this chunk (Default: None, no prior)
+    """
+
+    fname = chunk_file(location, year, profiles[0], profiles[-1], fmt)
+    if os.path.exists(fname):
+        return fname
+
+    # Find and check the morphometrics the same way Automorph.py does,
+    # checking every QC_BATCH profiles so that in the alongshore mode
+    # the priors at the ends of the batches are the checked profiles
+    fallback = dict(settings, **FALLBACK)
+    fences = dfuncs.load_fences(os.path.join(DATA_DIR, dfuncs.fence_file_name(location)))
+    morpho = dfuncs.morpho_dict(settings['extra_columns'])
+    batch_start = 0
+    for profile in profiles:
+        dist_cross, elev_cross, lats, lons, _ = load_profile(location, year, profile, settings)
+        if len(morpho['Profile']) == 0 and lead is not None:
+            prior = saved_prior(read_chunk(lead), profile, settings)
+        else:
+            prior = neighbor_prior(morpho, profile, settings)
+        morpho = find_morphometrics(morpho, profile, dist_cross, elev_cross,
+                                    lats, lons, settings, fences.get(profile), prior)
+        if len(morpho['Profile']) - batch_start >= QC_BATCH:
+            morpho = check_batch(morpho, batch_start, location, year, settings, fallback, fences)
+            batch_start = len(morpho['Profile'])
+    if len(morpho['Profile']) > batch_start:
+        morpho = check_batch(morpho, batch_start, location, year, settings, fallback, fences)
+
+    os.makedirs(chunk_folder(location, year), exist_ok=True)
+    write_atomic(pd.DataFrame.from_dict(morpho), fname, fmt)
+
+    return fname
+
+
+def merge_task(survey, fnames):
+    """
+    Merge the chunk results of a survey into the morphometrics .csv, add
+    the metrics that need every profile, and move the data file to the
+    location and year folder. A survey that is already saved is only
+    moved. The chunk results are removed once the .csv is saved
+
+    survey: Dict with a survey from parse_task()
+    fnames: List of strings with the chunk result paths in profile order
+    """
+
+    location, year = survey['location'], survey['year']
+    df = None
+    if not dfuncs.survey_complete(location, year, survey['profiles']):
+        df = pd.concat([read_chunk(fname) for fname in fnames], ignore_index=True)
+        if list(df['Profile']) != list(survey['profiles']):
+            raise IOError(f'The chunks for {location} {year} do not have every profile')
+
+        # Calculate metrics that can be done without looping through the profiles,
+        # the profile bearings, transect lengths and spacing, and the
+        # alongshore-integrated volumes
+        df = mfuncs.derived_metrics(df)
+        df = gfuncs.survey_geometry(df)
+
+    # Save the morphometrics and move the data file, unless
+    # an earlier try of this task already moved it
+    if os.path.exists(os.path.join(DATA_DIR, survey['file'])):
+        write_survey(survey, df)
+    elif df is not None:
+        dfuncs.save_morphometrics(df, location, year)
+
+    # Remove the chunk results
+    for fname in glob.glob(os.path.join(chunk_folder(location, year), '*')):
+        os.remove(fname)
+    if os.path.isdir(chunk_folder(location, year)):
+        os.rmdir(chunk_folder(location, year))
+
+    return f'{location} {year}'
+
+
+"""
+Functions to run the tasks
+"""
+
+
+class ClusterExecutor(Executor):
+    """
+    Executor for a Dask cluster that closes its connection
+    to the scheduler when it is shut down
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.executor = client.get_executor()
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True, **kwargs):
+        try:
+            self.executor.shutdown(wait=wait)
+        finally:
+            self.client.close()
+
+
+def check_format(fmt):
+    """
+    Raise an error if the chunk results can't be written in a format
+
+    fmt: String with "csv" or "parquet"
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError(f'{fmt} is not a chunk result format, use one of {FORMATS}')
+    if fmt == 'parquet' and not any(importlib.util.find_spec(engine) is not None
+                                    for engine in PARQUET_ENGINES):
+        raise ImportError('Parquet chunk results need pyarrow or fastparquet '
+                          '(pip install pyarrow), or use --format csv')
+
+
+def make_executor(scheduler=None, workers=None):
+    """
+    Return the executor to run the tasks on. With a scheduler address the
+    tasks go to a Dask cluster (dask.distributed has to be installed) and
+    the connection to it is closed when the executor is shut down,
+    otherwise they run in local worker processes
+
+    scheduler: String with the address of a Dask scheduler (Default: None)
+    workers: Int with the number of local worker processes (Default: None = one per CPU)
+    """
+
+    if scheduler is None:
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                   initializer=start_worker)
+
+    try:
+        distributed = importlib.import_module('dask.distributed')
+    except ImportError:
+        raise ImportError('Running on a cluster needs dask.distributed '
+                          '(pip install "dask[distributed]")')
+
+    return ClusterExecutor(distributed.Client(scheduler))
+
+
+def chunk_profiles(profiles, chunk_size=CHUNK_SIZE):
+    """
+    Return a list with the profile numbers in each chunk
+
+    profiles: List of ints with the profiles in the survey
+    chunk_size: Int with the most profiles in a chunk (Default: CHUNK_SIZE)
+    """
+
+    profiles = list(profiles)
+
+    return [profiles[ii:ii + chunk_size] for ii in range(0, len(profiles), chunk_size)]
+
+
+def run(executor, surveys, settings, epsg, chunk_size=CHUNK_SIZE, fmt='csv',
+        retries=RETRIES, dem_spacing=None, cloud_half_width=1.0, cloud_classes=(2,)):
+    """
+    Run every survey on the executor. Each survey is parsed, then its
+    chunks are run, then they are merged. A task that fails is run again
+    up to the number of retries before its survey is given up on. Returns
+    a list of the surveys that failed
+
+    In the alongshore mode every profile uses the one before it as a
+    prior, so the chunks of a survey are run one after another, each
+    starting from the last profile of the chunk before, and the chunk
+    size is rounded up to a multiple of QC_BATCH so the chunks end where
+    Automorph.py checks a batch. This gives the same results as
+    Automorph.py, and different surveys still run at the same time
+
+    executor: Executor from make_executor()
+    surveys: List of dicts with the surveys from find_surveys()
+    settings: Dict with the run settings
+    epsg: Int with the number code for the in projection
+    chunk_size: Int with the most profiles in a chunk (Default: CHUNK_SIZE)
+    fmt: String with the chunk result format, "csv" or "parquet" (Default: "csv")
+    retries: Int with the times to run a failed task again (Default: RETRIES)
+    dem_spacing: Float with the sample spacing along DEM transects (Default: None)
+    cloud_half_width: Float with the half width of point cloud transects (Default: 1.0)
+    cloud_classes: List of LAS classes to use (Default: (2,))
+    """
+
+    check_format(fmt)
+    pending, chunks, failed = {}, {}, []
+    if settings['alongshore'] and chunk_size % QC_BATCH != 0:
+        chunk_size += QC_BATCH - chunk_size % QC_BATCH
+        print(f'Using chunks of {chunk_size} profiles to match the QC batches of the alongshore mode')
+
+    def submit(kind, key, func, *args, attempt=0):
+        future = executor.submit(func, *args)
+        pending[future] = (kind, key, func, args, attempt)
+
+    for survey in surveys:
+        submit('parse', survey['file'], parse_task, survey, epsg,
+               dem_spacing, cloud_half_width, cloud_classes)
+
+    while len(pending) > 0:
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            kind, key, func, args, attempt = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as error:
+                if attempt < retries:
+                    print(f'Retrying the {kind} task for {key} after: {error!r}')
+                    submit(kind, key, func, *args, attempt=attempt + 1)
+                elif key not in failed:
+                    print(f'Giving up on {key} after: {error!r}')
+                    failed.append(key)
+                continue
+            if key in failed:
+                continue
+
+            # Submit the chunks of a parsed survey, or merge it
+            # right away if its morphometrics are already saved
+            if kind == 'parse':
+                survey = result
+                print(f'Parsed {survey["location"]} {survey["year"]}: '
+                      f'{survey["num_profiles"]} profiles')
+                if survey['survey_done']:
+                    submit('merge', key, merge_task, survey, [])
+                    continue
+                queue = chunk_profiles(survey['profiles'], chunk_size)
+                chunks[key] = {'survey': survey, 'fnames': {}, 'count': len(queue), 'queue': []}
+                if settings['alongshore']:
+                    queue, chunks[key]['queue'] = queue[:1], queue[1:]
+                for profiles in queue:
+                    submit('chunk', key, chunk_task, survey['location'],
+                           survey['year'], profiles, settings, fmt)
+
+            # Submit the next chunk of a survey in the alongshore mode,
+            # and merge a survey once its last chunk is done
+            elif kind == 'chunk':
+                chunks[key]['fnames'][args[2][0]] = result
+                if len(chunks[key]['queue']) > 0:
+                    submit('chunk', key, chunk_task, args[0], args[1],
+                           chunks[key]['queue'].pop(0), settings, fmt, result)
+                elif len(chunks[key]['fnames']) == chunks[key]['count']:
+                    fnames = [chunks[key]['fnames'][first] for first in sorted(chunks[key]['fnames'])]
+                    submit('merge', key, merge_task, chunks[key]['survey'], fnames)
+
+            elif kind == 'merge':
+                print(f'Finished {result}')
+
+    return failed
+
+
+def main():
+    """
+    Run the surveys in the data folder
+    """
+
+    parser = argparse.ArgumentParser(description='Run Automorph on many machines at once')
+    parser.add_argument('--scheduler', default=None,
+                        help='Dask scheduler address. Local processes are used without one')
+    parser.add_argument('--workers', type=int, default=None, help='Local worker processes')
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE, help='Profiles in each task')
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        help='Format of the chunk results')
+    parser.add_argument('--retries', type=int, default=RETRIES)
+    parser.add_argument('--epsg', type=int, default=3358)
+    args = parser.parse_args()
+
+    # Use the same settings as Automorph.py
+    settings = dict(SETTINGS)
+    settings['extra_columns'] = ufuncs.percentile_columns(settings['percentiles'])\
+        if settings['ensemble_size'] > 0 else []
+
+    check_format(args.format)
+    surveys = find_surveys()
+    executor = make_executor(args.scheduler, args.workers)
+    try:
+        failed = run(executor, surveys, settings, args.epsg, args.chunk,
+                     args.format, args.retries)
+    finally:
+        executor.shutdown()
+
+    print(f'\n{len(surveys) - len(failed)} of {len(surveys)} surveys finished')
+    if len(failed) > 0:
+        print(f'Failed: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
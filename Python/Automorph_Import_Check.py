@@ -0,0 +1,97 @@
+"""
+Check how long the Automorph modules take to import and that
+the heavy dependencies stay out of the startup path
+
+Each module is imported in a fresh interpreter several times and
+the fastest import is compared against a budget on top of the time
+it takes to import NumPy alone, so the check does not depend on how
+fast the machine is. Exits with a non-zero status if a module is
+over budget or loads a dependency it should not
+
+Run from the Python folder:
+    python Automorph_Import_Check.py
+"""
+
+import subprocess
+import json
+import sys
+
+
+# Extra import time (ms) allowed on top of NumPy and
+# the packages that must not be loaded by the import
+BUDGETS = {
+    'Functions.Morpho_Functions': 50,
+    'Functions.Data_Functions': 50,
+    'Functions.Plot_Functions': 50,
+    'Functions.Raster_Functions': 50,
+    'Functions.PointCloud_Functions': 50,
+    'Functions.Kernel_Functions': 50,
+    'Functions.Geodesy_Functions': 50,
+    'Functions.Uncertainty_Functions': 50,
+    'Functions.Decimate_Functions': 50,
+    'Functions.QC_Functions': 50,
+    'Functions.Pipeline_Functions': 50,
+    'Functions.Compact_Functions': 50,
+    'Functions.Catalog_Functions': 50,
+}
+HEAVY = ['pandas', 'scipy', 'sklearn', 'statsmodels', 'pyproj',
+         'matplotlib', 'seaborn', 'rasterio', 'laspy', 'numba']
+REPEATS = 5
+
+# Code run in the fresh interpreter
+PROBE = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module({module!r})
+elapsed = (time.perf_counter() - start) * 1000
+loaded = sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r}))
+print(json.dumps({{'ms': elapsed, 'loaded': loaded}}))
+'''
+
+
+def time_import(module):
+    """
+    Return the fastest import time (ms) of a module over several fresh
+    interpreters and the heavy packages the import loaded
+
+    module: String with the module name
+    """
+
+    times, loaded = [], []
+    for _ in range(REPEATS):
+        output = subprocess.run([sys.executable, '-c',
+                                 PROBE.format(module=module, heavy=HEAVY)],
+                                capture_output=True, text=True, check=True)
+        result = json.loads(output.stdout)
+        times.append(result['ms'])
+        loaded = result['loaded']
+
+    return min(times), loaded
+
+
+def main():
+    """
+    Run the check
+    """
+
+    # Time NumPy alone as the baseline
+    numpy_ms, _ = time_import('numpy')
+    print(f'{"numpy":<35}{numpy_ms:8.1f} ms (baseline)')
+
+    # Check every module against its budget
+    failed = False
+    for module, budget in BUDGETS.items():
+        elapsed, loaded = time_import(module)
+        extra = elapsed - numpy_ms
+        ok = extra <= budget and len(loaded) == 0
+        failed = failed or not ok
+        status = 'OK' if ok else 'FAIL'
+        print(f'{module:<35}{elapsed:8.1f} ms (+{extra:.1f} of {budget} ms) {status}')
+        if len(loaded) > 0:
+            print(f'    Loaded at import: {", ".join(loaded)}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
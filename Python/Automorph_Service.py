@@ -0,0 +1,459 @@
+"""
+Run Automorph as a local service that keeps the detectors warm
+
+Every run of Automorph.py pays for starting Python, importing the heavy
+libraries, compiling the kernels, and scanning the data folder before it
+spends a few milliseconds on each profile. The service does all of that
+once and then answers requests for the morphometrics of one or more
+profiles over HTTP on a local port or a Unix socket. Profiles are sent as
+arrays of cross-shore distance and elevation or as a piece of an .xyz
+file, and the morpho record of each profile comes back as JSON
+
+Run from the Python folder:
+    python Automorph_Service.py [--port 8765] [--socket PATH] [--workers N]
+
+Endpoints:
+    GET  /health            Service status and request counts
+    POST /morphometrics     Find the morphometrics for a batch of profiles
+
+The body of a /morphometrics request is a JSON object with any of:
+    profiles: List of {"x": [...], "z": [...]} objects with the cross-shore
+              distances and elevations, and optionally "profile" (number),
+              "lat" and "lon" (arrays), and "fence" ([[lat, lon], ...])
+    xyz:      String with .xyz text ("Cross Section N" lines and X Y Z rows)
+    epsg:     Int with the projection of the .xyz coordinates
+    settings: Dict with detection settings to change (see OVERRIDES). A
+              setting of the wrong type or outside OVERRIDE_LIMITS, or an
+              ensemble_size over MAX_ENSEMBLE, is refused with a 400
+
+A body over MAX_BODY bytes is refused with a 413
+
+Automorph_Client.py sends requests and runs a load test against the service
+"""
+
+from Functions import Data_Functions as dfuncs
+from Functions import Decimate_Functions as decfuncs
+from Functions import Morpho_Functions as mfuncs
+from Functions import QC_Functions as qfuncs
+from Functions import Uncertainty_Functions as ufuncs
+from Automorph import SETTINGS, FALLBACK, find_morphometrics, neighbor_prior, qc_batch
+
+import numpy as np
+import pandas as pd
+import socketserver
+import http.server
+import threading
+import argparse
+import json
+import time
+import os
+
+
+# Service parameters
+HOST = '127.0.0.1'
+PORT = 8765
+EPSG = 3358             # Projection of .xyz requests without an "epsg"
+MAX_BATCH = 1000        # Most profiles in one request
+MAX_BODY = 64 * 2**20   # Most bytes in the body of a request
+MAX_ENSEMBLE = 1000     # Most Monte Carlo members per profile a request can ask for
+MAX_PERCENTILES = 10    # Most ensemble percentiles a request can ask for
+WAIT = 30.0             # Seconds a request waits for a free worker before a 503
+OVERRIDES = ('mhw', 'mhw_pad', 'heel_threshold', 'crest_pct',
+             'decimate_tolerance', 'ensemble_size', 'percentiles',
+             'alongshore', 'alongshore_window')
+OVERRIDE_LIMITS = {'mhw': (-10.0, 10.0),              # (low, high] of the number settings
+                   'mhw_pad': (0.0, 5.0),
+                   'heel_threshold': (0.0, 10.0),
+                   'crest_pct': (0.0, 1.0),
+                   'decimate_tolerance': (0.0, 5.0),    # Or None for no decimation
+                   'alongshore_window': (0.0, 100.0)}
+
+
+class RequestError(ValueError):
+    """
+    A request that can't be run, with the HTTP status to reply with
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+"""
+Functions to run a request
+"""
+
+
+def request_settings(request, max_ensemble=MAX_ENSEMBLE):
+    """
+    Return the run settings for a request. The defaults from Automorph.py
+    are used for every setting the request doesn't change
+
+    request: Dict with the request
+    max_ensemble: Int with the most ensemble members allowed (Default: MAX_ENSEMBLE)
+    """
+
+    changes = request.get('settings', {})
+    if not isinstance(changes, dict):
+        raise RequestError('settings has to be a JSON object')
+    unknown = set(changes) - set(OVERRIDES)
+    if len(unknown) > 0:
+        raise RequestError(f'Unknown settings: {", ".join(sorted(unknown))}')
+    settings = dict(SETTINGS, **changes)
+
+    # Check the type and range of the settings that were changed
+    for key, (low, high) in OVERRIDE_LIMITS.items():
+        value = settings[key]
+        if key == 'decimate_tolerance' and value is None:
+            continue
+        number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        if not number or not low < value <= high:
+            raise RequestError(f'{key} has to be a number over {low:g} and up to {high:g}'
+                               + (' or null' if key == 'decimate_tolerance' else ''))
+    if not isinstance(settings['alongshore'], bool):
+        raise RequestError('alongshore has to be true or false')
+
+    # Limit the uncertainty work one request can ask for
+    size = settings['ensemble_size']
+    if isinstance(size, bool) or not isinstance(size, int) or not 0 <= size <= max_ensemble:
+        raise RequestError(f'ensemble_size has to be a whole number from 0 to {max_ensemble}')
+    percentiles = settings['percentiles']
+    numbers = isinstance(percentiles, list) and all(
+        isinstance(pct, (int, float)) and not isinstance(pct, bool) and 0 <= pct <= 100
+        for pct in percentiles)
+    if not numbers or not 0 < len(percentiles) <= MAX_PERCENTILES:
+        raise RequestError(f'percentiles has to be a list of 1 to {MAX_PERCENTILES} '
+                           f'numbers from 0 to 100')
+    settings['extra_columns'] = ufuncs.percentile_columns(settings['percentiles'])\
+        if settings['ensemble_size'] > 0 else []
+
+    return settings
+
+
+def read_profiles(request, settings, epsg=EPSG):
+    """
+    Return dicts with the (dist_cross, elev_cross, lats, lons) arrays and the
+    sand fence crossings of each profile in a request. The profiles are
+    flipped if needed so the indices increase landward
+
+    request: Dict with the request
+    settings: Dict with the run settings
+    epsg: Int with the projection of .xyz text without an "epsg" (Default: EPSG)
+    """
+
+    profiles, fences = {}, {}
+
+    # Profiles in .xyz text
+    if 'xyz' in request:
+        epsg = request.get('epsg', epsg)
+        if not isinstance(request['xyz'], str):
+            raise RequestError('xyz has to be a string with .xyz text')
+        if isinstance(epsg, bool) or not isinstance(epsg, int):
+            raise RequestError('epsg has to be a whole number')
+        for profile, df in dfuncs.parse_xyz(request['xyz']).items():
+            df = dfuncs.add_lat_lon(df, epsg)
+            dist_cross, elev_cross, _, _, lats, lons =\
+                dfuncs.format_profile(df, settings['grid_size'])
+            profiles[profile] = (dist_cross, elev_cross, lats, lons)
+
+    # Profiles sent as arrays
+    for number, item in enumerate(request.get('profiles', []), start=len(profiles) + 1):
+        try:
+            profile = int(item.get('profile', number))
+            X = np.asarray(item['x'], dtype=np.float64)
+            y = np.asarray(item['z'], dtype=np.float64)
+            lats = np.asarray(item.get('lat', np.full(len(y), np.nan)), dtype=np.float64)
+            lons = np.asarray(item.get('lon', np.full(len(y), np.nan)), dtype=np.float64)
+        except (KeyError, TypeError, ValueError) as error:
+            raise RequestError(f'Profile {number} is not valid: {error!r}')
+        if X.ndim != 1 or len(X) < 3 or not len(X) == len(y) == len(lats) == len(lons):
+            raise RequestError(f'Profile {profile} needs x, z, lat, and lon '
+                               f'arrays of the same length (at least 3 points)')
+        if not (np.isfinite(X).all() and np.isfinite(y).all()):
+            raise RequestError(f'Profile {profile} has values that are not finite')
+        if profile in profiles:
+            raise RequestError(f'Profile {profile} is in the request more than once')
+        if X[-1] > X[0]:
+            X, y, lats, lons = X[::-1], y[::-1], lats[::-1], lons[::-1]
+        profiles[profile] = (X, y, lats, lons)
+        if 'fence' in item:
+            fences[profile] = np.asarray(item['fence'], dtype=np.float64).reshape(-1, 2)
+
+    return profiles, fences
+
+
+def run_request(request, epsg=EPSG, max_batch=MAX_BATCH):
+    """
+    Find the morphometrics for every profile in a request the same way
+    Automorph.py does, including the QC check and the fallback reruns.
+    Returns a list with a dict of the morphometrics for each profile
+
+    request: Dict with the request
+    epsg: Int with the projection of .xyz text without an "epsg" (Default: EPSG)
+    max_batch: Int with the most profiles allowed in the request (Default: MAX_BATCH)
+    """
+
+    settings = request_settings(request)
+    fallback = dict(settings, **FALLBACK)
+    profiles, fences = read_profiles(request, settings, epsg)
+    if len(profiles) == 0:
+        raise RequestError('The request has no profiles')
+    if len(profiles) > max_batch:
+        raise RequestError(f'The request has {len(profiles)} profiles, '
+                           f'the most allowed is {max_batch}', status=413)
+
+    def load(profile, used):
+        dist_cross, elev_cross, lats, lons = profiles[profile]
+        if used['decimate_tolerance'] is not None:
+            return decfuncs.decimate_profile(dist_cross, elev_cross, lats, lons,
+                                             used['decimate_tolerance'], used['mhw'])
+        return dist_cross, elev_cross, lats, lons
+
+    # Find the morphometrics and check them
+    morpho = dfuncs.morpho_dict(settings['extra_columns'])
+    for profile in profiles:
+        dist_cross, elev_cross, lats, lons = load(profile, settings)
+        morpho = find_morphometrics(morpho, profile, dist_cross, elev_cross,
+                                    lats, lons, settings, fences.get(profile),
+                                    neighbor_prior(morpho, profile, settings))
+    morpho, flags = qc_batch(morpho, 0, settings, fallback, load, fences)
+
+    # Add the metrics Automorph.py adds before saving. NaN
+    # is not valid JSON so missing values are sent as null
+    df = mfuncs.derived_metrics(pd.DataFrame.from_dict(morpho))
+    df['QC'] = [qfuncs.describe(flag) for flag in flags]
+    df = df.astype(object).where(df.notna(), None)
+
+    return df.to_dict(orient='records')
+
+
+"""
+Functions to serve requests
+"""
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Answer the HTTP requests. Connections are kept open between requests
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/health':
+            self.send_json(200, service_status(self.server))
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+
+        # Check the size of the body before reading it. The connection is
+        # closed after a refused body since the body is never read
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.send_json(400, {'error': 'Content-Length has to be a whole number of bytes'})
+            return
+        if length > self.server.max_body:
+            self.close_connection = True
+            self.send_json(413, {'error': f'The body has {length} bytes, '
+                                          f'the most allowed is {self.server.max_body}'})
+            return
+        body = self.rfile.read(length)
+        if self.path.rstrip('/') != '/morphometrics':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise ValueError('The request must be a JSON object')
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        status, reply = handle_request(self.server, request)
+        self.send_json(status, reply)
+
+    def send_json(self, status, reply):
+        body = json.dumps(reply, default=lambda value: value.item()).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Threaded HTTP server on a Unix socket
+    """
+
+    daemon_threads = True
+
+
+def make_server(host=HOST, port=PORT, socket_path=None, workers=None,
+                max_batch=MAX_BATCH, wait=WAIT, epsg=EPSG, verbose=False,
+                max_body=MAX_BODY):
+    """
+    Make the HTTP server. Each connection gets a thread but only the
+    number of workers can run profiles at the same time, the rest wait
+    for up to the wait time for a free worker
+
+    host: String with the address to listen on (Default: HOST)
+    port: Int with the port to listen on (Default: PORT)
+    socket_path: String with a Unix socket to listen on instead of the port (Default: None)
+    workers: Int with the most requests run at the same time (Default: CPU count)
+    max_batch: Int with the most profiles in one request (Default: MAX_BATCH)
+    wait: Float with the seconds to wait for a free worker (Default: WAIT)
+    epsg: Int with the projection of .xyz requests without an "epsg" (Default: EPSG)
+    verbose: Bool to print every request (Default: False)
+    max_body: Int with the most bytes in the body of a request (Default: MAX_BODY)
+    """
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, Handler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+
+    # Service settings and counters
+    server.workers = workers or os.cpu_count() or 1
+    server.slots = threading.BoundedSemaphore(server.workers)
+    server.max_batch, server.wait, server.epsg = max_batch, wait, epsg
+    server.max_body = max_body
+    server.verbose = verbose
+    server.lock = threading.Lock()
+    server.counts = {'requests': 0, 'profiles': 0, 'errors': 0, 'busy': 0,
+                     'busy_ms': 0.0}
+    server.started = time.time()
+
+    return server
+
+
+def handle_request(server, request):
+    """
+    Run a request once a worker is free and return
+    the HTTP status and the reply
+
+    server: HTTP server from make_server()
+    request: Dict with the request
+    """
+
+    if not server.slots.acquire(timeout=server.wait):
+        with server.lock:
+            server.counts['busy'] += 1
+        return 503, {'error': 'Every worker is busy, try again'}
+
+    start_time = time.perf_counter()
+    try:
+        records = run_request(request, server.epsg, server.max_batch)
+        status, reply = 200, {'results': records}
+    except RequestError as error:
+        status, reply = error.status, {'error': str(error)}
+    except Exception as error:
+        status, reply = 500, {'error': f'{type(error).__name__}: {error}'}
+    finally:
+        server.slots.release()
+    elapsed = (time.perf_counter() - start_time) * 1000
+
+    # Update the counters
+    with server.lock:
+        server.counts['requests'] += 1
+        server.counts['busy_ms'] += elapsed
+        if status == 200:
+            server.counts['profiles'] += len(records)
+        else:
+            server.counts['errors'] += 1
+    reply['elapsed_ms'] = elapsed
+
+    return status, reply
+
+
+def service_status(server):
+    """
+    Return a dict with the status of the service
+
+    server: HTTP server from make_server()
+    """
+
+    with server.lock:
+        counts = dict(server.counts)
+    served = max(counts['requests'], 1)
+
+    return {'status': 'ok',
+            'workers': server.workers,
+            'max_batch': server.max_batch,
+            'uptime_s': time.time() - server.started,
+            'requests': counts['requests'],
+            'profiles': counts['profiles'],
+            'errors': counts['errors'],
+            'busy': counts['busy'],
+            'mean_ms': counts['busy_ms'] / served}
+
+
+def warm_up(epsg=EPSG):
+    """
+    Import the heavy libraries, compile the kernels, and build the
+    projection transformer by running a made up profile. Returns the
+    time it took (ms)
+
+    epsg: Int with the projection to build a transformer for (Default: EPSG)
+    """
+
+    start_time = time.perf_counter()
+    dfuncs.lat_lon_transformer(epsg)
+    X = np.arange(200, 0, -0.5)
+    s = 200 - X
+    z = 0.02 * s - 0.5 + 3 * np.exp(-((s - 110) / 10) ** 2)
+    run_request({'profiles': [{'x': X.tolist(), 'z': z.tolist()}]}, epsg)
+
+    return (time.perf_counter() - start_time) * 1000
+
+
+def main():
+    """
+    Run the service
+    """
+
+    parser = argparse.ArgumentParser(description='Run Automorph as a local service')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--socket', default=None, help='Unix socket to listen on instead of a port')
+    parser.add_argument('--workers', type=int, default=None, help='Requests run at the same time')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max-body', type=int, default=MAX_BODY, help='Most bytes in a request')
+    parser.add_argument('--wait', type=float, default=WAIT)
+    parser.add_argument('--epsg', type=int, default=EPSG)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    print(f'Warmed up in {warm_up(args.epsg):.0f} ms')
+    server = make_server(args.host, args.port, args.socket, args.workers,
+                         args.max_batch, args.wait, args.epsg, args.verbose, args.max_body)
+    where = args.socket if args.socket is not None else f'http://{args.host}:{args.port}'
+    print(f'Serving on {where} with {server.workers} workers')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
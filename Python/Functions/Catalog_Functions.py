@@ -0,0 +1,334 @@
+"""
+Functions to keep a catalog of every transect
+
+Finding data by rebuilding the path of each profile file means a question
+like "every transect in this box from 2012 to 2019" has to list and open
+thousands of files. The catalog is a SQLite database next to the location
+folders with one row per transect: the location, year, and profile number,
+the profile file and the data file it came from, the ends and the bounding
+box of the transect, the number of points, where its row starts in the
+morphometrics .csv (so it can be read without reading the rest of the
+file), and how far along the processing it is. Lookups by location, year,
+and profile use the table's index and lookups by area use an R*Tree, so
+both take O(log n) time
+
+SQLite locks the whole file while writing. The catalog can be shared by
+the worker processes of a run, but like the rest of the repository it
+has to be on storage that supports file locks
+"""
+
+from Functions.Lazy_Import import lazy_import
+
+from contextlib import closing
+import numpy as np
+import sqlite3
+import io
+import os
+
+# Heavy dependencies are only imported when first used
+pd = lazy_import('pandas')
+
+
+# Set general information
+CATALOG_FILE = os.path.join('..', 'Transect Catalog.sqlite')
+TIMEOUT = 60.0      # Seconds to wait for another process to finish writing
+
+# Processing status of a transect
+PARSED = 'parsed'               # The profile file has been made
+CHECKPOINTED = 'checkpointed'   # The morphometrics are in the checkpoint file
+DONE = 'done'                   # The morphometrics are in the .csv
+
+# Columns of the catalog
+COLUMNS = ['location', 'year', 'profile', 'file', 'source',
+           'start_lat', 'start_lon', 'end_lat', 'end_lon',
+           'min_lat', 'max_lat', 'min_lon', 'max_lon', 'num_points',
+           'row_offset', 'row_length', 'status', 'qc_flag']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transects (
+    id INTEGER PRIMARY KEY,
+    location TEXT NOT NULL,
+    year TEXT NOT NULL,
+    profile INTEGER NOT NULL,
+    file TEXT,
+    source TEXT,
+    start_lat REAL, start_lon REAL, end_lat REAL, end_lon REAL,
+    min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL,
+    num_points INTEGER,
+    row_offset INTEGER,
+    row_length INTEGER,
+    status TEXT NOT NULL,
+    qc_flag INTEGER,
+    UNIQUE (location, year, profile)
+);
+CREATE INDEX IF NOT EXISTS transects_by_year ON transects (year, location, profile);
+"""
+
+BOUNDS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS transect_bounds
+    USING rtree(id, min_lon, max_lon, min_lat, max_lat)
+"""
+
+
+"""
+Functions to open the catalog
+"""
+
+
+def connect(fname=CATALOG_FILE):
+    """
+    Open the catalog, making the tables if they don't exist yet. The
+    R*Tree of the transect bounds is left out if SQLite was built
+    without it, then areas are searched with the bounding box columns
+
+    fname: String with the path to the catalog (Default: CATALOG_FILE)
+    """
+
+    connection = sqlite3.connect(fname, timeout=TIMEOUT)
+    connection.executescript(SCHEMA)
+    try:
+        connection.execute(BOUNDS)
+    except sqlite3.OperationalError:
+        pass
+
+    return connection
+
+
+def has_bounds(connection):
+    """
+    Check if the catalog has the R*Tree of the transect bounds
+
+    connection: SQLite connection from connect()
+    """
+
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                              "AND name = 'transect_bounds'").fetchone() is not None
+
+
+def profile_record(location, year, profile, df, file, source):
+    """
+    Return a dict with the catalog row of a profile
+
+    location: String with the location
+    year: String with the year
+    profile: Int with the profile number
+    df: DataFrame with the Lat and Lon of every point on the profile
+    file: String with the path to the profile file
+    source: String with the data file the profile came from
+    """
+
+    record = {'location': location, 'year': str(year), 'profile': int(profile),
+              'file': file, 'source': source, 'num_points': len(df)}
+    lats = np.asarray(df['Lat'], dtype=np.float64)
+    lons = np.asarray(df['Lon'], dtype=np.float64)
+    if len(df) > 0 and np.isfinite(lats).any() and np.isfinite(lons).any():
+        record.update(start_lat=lats[0], start_lon=lons[0], end_lat=lats[-1], end_lon=lons[-1],
+                      min_lat=np.nanmin(lats), max_lat=np.nanmax(lats),
+                      min_lon=np.nanmin(lons), max_lon=np.nanmax(lons))
+
+    return {key: float(value) if isinstance(value, np.floating) else value
+            for key, value in record.items()}
+
+
+"""
+Functions to update the catalog
+"""
+
+
+def add_transects(records, fname=CATALOG_FILE):
+    """
+    Add the transects of a parsed survey to the catalog, or reset them if
+    they are already in it. Their status is set to PARSED
+
+    records: List of dicts from profile_record()
+    fname: String with the path to the catalog (Default: CATALOG_FILE)
+    """
+
+    keys = [key for key in COLUMNS if key not in ('row_offset', 'row_length', 'qc_flag')]
+    rows = [[record.get(key) for key in keys[:-1]] + [PARSED] for record in records]
+    updates = ', '.join(f'{key} = excluded.{key}' for key in keys[3:])
+
+    with closing(connect(fname)) as connection, connection:
+        connection.executemany(
+            f'INSERT INTO transects ({", ".join(keys)}) VALUES ({", ".join("?" * len(keys))}) '
+            f'ON CONFLICT (location, year, profile) DO UPDATE SET {updates}, '
+            f'row_offset = NULL, row_length = NULL, qc_flag = NULL', rows)
+
+        # Put the bounds of the transects in the R*Tree
+        if has_bounds(connection):
+            connection.executemany(
+                'INSERT OR REPLACE INTO transect_bounds '
+                'SELECT id, min_lon, max_lon, min_lat, max_lat FROM transects '
+                'WHERE location = ? AND year = ? AND profile = ? AND min_lat IS NOT NULL',
+                [(record['location'], record['year'], record['profile'])
+                 for record in records])
+
+
+def set_status(location, year, profiles, status, flags=None, fname=CATALOG_FILE):
+    """
+    Set the status (and the QC flag) of some transects of a survey.
+    Transects that aren't in the catalog are left out
+
+    location: String with the location
+    year: String with the year
+    profiles: List of ints with the profile numbers
+    status: String with the new status
+    flags: List of ints with the QC flag of each profile (Default: None, leave them)
+    fname: String with the path to the catalog (Default: CATALOG_FILE)
+    """
+
+    if flags is None:
+        query = 'UPDATE transects SET status = ? WHERE location = ? AND year = ? AND profile = ?'
+        rows = [(status, location, str(year), int(profile)) for profile in profiles]
+    else:
+        query = 'UPDATE transects SET status = ?, qc_flag = ? ' \
+                'WHERE location = ? AND year = ? AND profile = ?'
+        rows = [(status, int(flag), location, str(year), int(profile))
+                for profile, flag in zip(profiles, flags)]
+
+    with closing(connect(fname)) as connection, connection:
+        connection.executemany(query, rows)
+
+
+def row_offsets(csv_fname):
+    """
+    Return a list with the profile number, the byte offset and length of
+    its row, and the QC flag (None if the file has no QC Flag column) of
+    every row in a morphometrics .csv
+
+    csv_fname: String with the path to the .csv
+    """
+
+    rows = []
+    with open(csv_fname, 'rb') as infile:
+        header = infile.readline()
+        columns = [col.strip() for col in header.decode().split(',')]
+        profile_col = columns.index('Profile')
+        flag_col = columns.index('QC Flag') if 'QC Flag' in columns else None
+        offset = len(header)
+        for line in infile:
+            fields = line.split(b',')
+            if len(fields) > profile_col and len(line.strip()) > 0:
+                flag = int(float(fields[flag_col])) if flag_col is not None else None
+                rows.append((int(float(fields[profile_col])), offset, len(line), flag))
+            offset += len(line)
+
+    return rows
+
+
+def index_morphometrics(location, year, csv_fname, fname=CATALOG_FILE):
+    """
+    Record where the row of every profile is in the morphometrics .csv of a
+    survey and its QC flag, and set the status of the profiles to DONE
+
+    location: String with the location
+    year: String with the year
+    csv_fname: String with the path to the .csv
+    fname: String with the path to the catalog (Default: CATALOG_FILE)
+    """
+
+    rows = [(offset, length, flag, DONE, location, str(year), profile)
+            for profile, offset, length, flag in row_offsets(csv_fname)]
+
+    with closing(connect(fname)) as connection, connection:
+        connection.executemany(
+            'UPDATE transects SET row_offset = ?, row_length = ?, qc_flag = ?, status = ? '
+            'WHERE location = ? AND year = ? AND profile = ?', rows)
+
+
+"""
+Functions to search the catalog
+"""
+
+
+def find_transects(locations=None, years=None, bbox=None, profiles=None,
+                   status=None, fname=CATALOG_FILE):
+    """
+    Return a DataFrame with the catalog rows of the transects that match
+    every filter given, in order of location, year, and profile
+
+    locations: String or list of strings with the locations (Default: None, all)
+    years: Tuple with the (first, last) years to use (Default: None, all)
+    bbox: Tuple with the (min lon, min lat, max lon, max lat) of an area. A
+          transect is used if its bounding box overlaps it (Default: None, all)
+    profiles: Tuple with the (first, last) profile numbers to use (Default: None, all)
+    status: String with the status to use (Default: None, all)
+    fname: String with the path to the catalog (Default: CATALOG_FILE)
+    """
+
+    clauses, params = [], []
+    if locations is not None:
+        locations = [locations] if isinstance(locations, str) else list(locations)
+        clauses.append(f'location IN ({", ".join("?" * len(locations))})')
+        params += locations
+    if years is not None:
+        clauses.append('year BETWEEN ? AND ?')
+        params += [str(years[0]), str(years[1])]
+    if profiles is not None:
+        clauses.append('profile BETWEEN ? AND ?')
+        params += [int(profiles[0]), int(profiles[1])]
+    if status is not None:
+        clauses.append('status = ?')
+        params.append(status)
+
+    with closing(connect(fname)) as connection:
+
+        # Search the area with the R*Tree when there is one. It stores the
+        # bounds rounded outward to 32-bit floats, so it only picks the
+        # candidates and the exact bounds in the table are checked after
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            overlap = 'max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?'
+            if has_bounds(connection):
+                clauses.append(f'id IN (SELECT id FROM transect_bounds WHERE {overlap})')
+                params += [min_lon, max_lon, min_lat, max_lat]
+            clauses.append(overlap)
+            params += [min_lon, max_lon, min_lat, max_lat]
+
+        where = f'WHERE {" AND ".join(clauses)}' if len(clauses) > 0 else ''
+        cursor = connection.execute(f'SELECT {", ".join(COLUMNS)} FROM transects {where} '
+                                    f'ORDER BY location, year, profile', params)
+        rows = cursor.fetchall()
+
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def read_rows(csv_fname, transects):
+    """
+    Read only the rows of some transects from a morphometrics .csv using
+    their offsets in the catalog. Rows next to each other in the file are
+    read together. The whole file is read and filtered instead if any of
+    the transects hasn't been indexed or the file changed since it was
+
+    csv_fname: String with the path to the .csv
+    transects: DataFrame from find_transects() with the transects of one survey
+    """
+
+    profiles = list(transects['profile'])
+    offsets = transects[['row_offset', 'row_length']]
+    if offsets.isnull().values.any():
+        df = pd.read_csv(csv_fname, header=0, float_precision='round_trip')
+        return df[df['Profile'].isin(profiles)].reset_index(drop=True)
+
+    # Join the rows that are next to each other into one read
+    spans = []
+    for offset, length in sorted(zip(offsets['row_offset'].astype(int),
+                                     offsets['row_length'].astype(int))):
+        if len(spans) > 0 and spans[-1][1] == offset:
+            spans[-1][1] = offset + length
+        else:
+            spans.append([offset, offset + length])
+
+    with open(csv_fname, 'rb') as infile:
+        chunks = [infile.readline()]
+        for start, end in spans:
+            infile.seek(start)
+            chunks.append(infile.read(end - start))
+    df = pd.read_csv(io.BytesIO(b''.join(chunks)), header=0, float_precision='round_trip')
+
+    # Check that the rows are the right ones
+    if sorted(df['Profile']) != sorted(profiles):
+        df = pd.read_csv(csv_fname, header=0, float_precision='round_trip')
+        df = df[df['Profile'].isin(profiles)].reset_index(drop=True)
+
+    return df
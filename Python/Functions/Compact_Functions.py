@@ -0,0 +1,163 @@
+"""
+Functions to hold many profiles in memory at once
+
+A loaded profile keeps float64 cross-shore distances, elevations,
+latitudes, and longitudes for every point. A compact profile keeps the
+cross-shore distances and elevations as float32 and the latitude and
+longitude only at the two ends of the profile. The position of every
+point is found again from its cross-shore distance, which is the
+parameter along the straight line between the ends. The profiles are
+loaded in chunks that fit a memory budget so a whole coastline never
+has to be in memory at the same time
+"""
+
+from Functions import Data_Functions as dfuncs
+
+import numpy as np
+
+
+"""
+Functions to make and use compact profiles
+"""
+
+
+def compact_profile(dist_cross, elev_cross, lats, lons):
+    """
+    Return a compact profile as a dict with float32 "X" and "Z" arrays
+    and an "Ends" array with the latitude and longitude of the first and
+    last points (lat start, lon start, lat end, lon end)
+
+    dist_cross: Array with the cross-shore distance values
+    elev_cross: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    """
+
+    return {'X': np.asarray(dist_cross, dtype=np.float32),
+            'Z': np.asarray(elev_cross, dtype=np.float32),
+            'Ends': np.array([lats[0], lons[0], lats[-1], lons[-1]], dtype=np.float64)}
+
+
+def expand_profile(compact):
+    """
+    Return the float64 dist_cross, elev_cross, lats, and lons arrays of a
+    compact profile. The latitudes and longitudes are put back on the line
+    between the ends using the cross-shore distance of each point
+
+    compact: Dict with a compact profile from compact_profile()
+    """
+
+    dist_cross = compact['X'].astype(np.float64)
+    elev_cross = compact['Z'].astype(np.float64)
+    lat_start, lon_start, lat_end, lon_end = compact['Ends']
+    length = dist_cross[-1] - dist_cross[0]
+    t = (dist_cross - dist_cross[0]) / length if length != 0 else np.zeros(len(dist_cross))
+    lats = lat_start + t * (lat_end - lat_start)
+    lons = lon_start + t * (lon_end - lon_start)
+
+    return dist_cross, elev_cross, lats, lons
+
+
+def profile_arrays(data):
+    """
+    Return the dist_cross, elev_cross, lats, and lons arrays
+    of a loaded profile, expanding compact profiles
+
+    data: Tuple of arrays or a dict with a compact profile
+    """
+
+    return expand_profile(data) if isinstance(data, dict) else data
+
+
+def profile_nbytes(data):
+    """
+    Return the memory used by the arrays of a loaded profile (bytes)
+
+    data: Tuple of arrays or a dict with a compact profile
+    """
+
+    arrays = data.values() if isinstance(data, dict) else data
+
+    return sum(array.nbytes for array in arrays)
+
+
+"""
+Functions to load profiles within a memory budget
+"""
+
+
+def profile_chunks(location, year, profiles, grid=0.5, compact=False,
+                   budget=None, max_profiles=None):
+    """
+    Load profiles and yield them in dicts of profile number to loaded
+    profile. A chunk ends before the memory of its profiles goes over
+    the budget or when it has the most profiles allowed. Each profile
+    is kept as (dist_cross, elev_cross, lats, lons) or as a compact
+    profile
+
+    location: String with the location
+    year: String with the year being looked at
+    profiles: List of ints with the profiles to load in order
+    grid: Float with the grid spacing for dfuncs.setup_profile() (Default: 0.5)
+    compact: Bool to keep compact profiles (Default: False)
+    budget: Int with the most bytes in a chunk (Default: None, no limit)
+    max_profiles: Int with the most profiles in a chunk (Default: None, no limit)
+    """
+
+    chunk, used = {}, 0
+    for profile in profiles:
+        dist_cross, elev_cross, _, _, lats, lons =\
+            dfuncs.setup_profile(location, year, profile, grid)
+        if compact:
+            data = compact_profile(dist_cross, elev_cross, lats, lons)
+        else:
+            data = (dist_cross, elev_cross, lats, lons)
+        size = profile_nbytes(data)
+
+        # Start a new chunk when this profile doesn't fit
+        full = (budget is not None and used + size > budget) or\
+            (max_profiles is not None and len(chunk) >= max_profiles)
+        if len(chunk) > 0 and full:
+            yield chunk
+            chunk, used = {}, 0
+        chunk[profile] = data
+        used += size
+    if len(chunk) > 0:
+        yield chunk
+
+
+def chunk_budget(memory_budget, prefetch):
+    """
+    Return the most bytes in one chunk so the chunk being computed, the
+    chunks read ahead, and the chunk being loaded fit in the budget
+
+    memory_budget: Float with the memory for loaded profiles (MB), None for no limit
+    prefetch: Int with the number of chunks read ahead
+    """
+
+    if memory_budget is None:
+        return None
+
+    return int(memory_budget * 2 ** 20 / (max(prefetch, 0) + 2))
+
+
+"""
+Functions to report on compact profiles
+"""
+
+
+def position_error(lats, lons, compact):
+    """
+    Return the largest distance (m) between the points of a profile and
+    where the compact profile puts them back
+
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    compact: Dict with the compact profile
+    """
+
+    _, _, new_lats, new_lons = expand_profile(compact)
+    north = np.radians(lats - new_lats) * 6371000.0
+    east = np.radians(lons - new_lons) * 6371000.0 * np.cos(np.radians(lats))
+
+    return float(np.nanmax(np.hypot(north, east))) if len(lats) > 0 else 0.0
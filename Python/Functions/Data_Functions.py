@@ -4,37 +4,53 @@ Functions to load and format data for Automorph
 Michael Itzkin, 6/28/2021
 """
 
-from scipy.interpolate import interp1d
+from Functions import Catalog_Functions as catfuncs
+from Functions.Lazy_Import import lazy_import
 
-import statsmodels.nonparametric.smoothers_lowess as lowess
-from pyproj import Proj, transform
-import pandas as pd
 import numpy as np
+import functools
+import json
+import io
+import re
 import os
 
+# Heavy dependencies are only imported when first used
+interpolate = lazy_import('scipy.interpolate')
+lowess = lazy_import('statsmodels.nonparametric.smoothers_lowess')
+pyproj = lazy_import('pyproj')
+pd = lazy_import('pandas')
+
 
 # Set general information
 DATA_DIR = os.path.join('..', 'Data')
+MIN_POINTS = 2      # Fewest elevations a profile can be interpolated from
 
 
-def get_basic_information(file):
+def get_basic_information(file, transect_file=None):
     """
     Identify the location, year, and number of
     profiles for the current set of profiles
     being worked on
 
     file: String with the filename of the current set of profiles
+    transect_file: String with the filename of the transect lines to use
+                   when the profiles are cut from a DEM or point
+                   cloud (Default: None)
     """
 
     # Pull out the location and year from the filename
-    location, year = file[:-4].split()
+    location, year = os.path.splitext(file)[0].split()
 
-    # Identify the number of profiles in the file
+    # Identify the number of profiles in the file. DEMs and point clouds
+    # have no cross-sections in them so count the transect lines instead
     num_profiles = 0
-    with open(os.path.join(DATA_DIR, file)) as topo_file:
-        for line in topo_file:
-            if 'Cross' in line:
-                num_profiles += 1
+    if transect_file is None:
+        with open(os.path.join(DATA_DIR, file)) as topo_file:
+            for line in topo_file:
+                if 'Cross' in line:
+                    num_profiles += 1
+    else:
+        num_profiles = len(load_transects(transect_file))
 
     # Make a folder for the location to place locations into
     new_folder = os.path.join('..', f'{location}', f'{year}', 'Profiles')
@@ -49,6 +65,164 @@ def get_basic_information(file):
     return location, year, num_profiles
 
 
+@functools.lru_cache(maxsize=None)
+def lat_lon_transformer(epsg):
+    """
+    Return a transformer from the projected coordinates to latitude and
+    longitude. Building a transformer is slow so one is kept for each
+    projection
+
+    epsg: Int with the number code for the in projection
+    """
+
+    return pyproj.Transformer.from_crs(f'epsg:{epsg}', 'epsg:4326', always_xy=True)
+
+
+def add_lat_lon(df, epsg):
+    """
+    Add columns with the latitude and longitude of
+    every point on a profile
+
+    df: DataFrame with X and Y columns in the projected coordinates
+    epsg: Int with the number code for the in projection
+    """
+
+    lon, lat = lat_lon_transformer(epsg).transform(np.asarray(df['X'], dtype=np.float64),
+                                                   np.asarray(df['Y'], dtype=np.float64))
+    df['Lat'], df['Lon'] = lat, lon
+
+    return df
+
+
+def parse_xyz(text):
+    """
+    Parse the text of an .xyz file (or a piece of one) into a dict with
+    a DataFrame of the X, Y, and Z values for each cross section. Text
+    without "Cross Section" lines is treated as one profile numbered 1.
+    Header lines and blank lines are skipped and the values can be split
+    by tabs, spaces, or commas
+
+    text: String with the .xyz text
+    """
+
+    profiles, profile, rows = {}, 1, []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('Cross Section'):
+            if len(rows) > 0:
+                profiles[profile] = rows
+            profile, rows = int(line.split()[-1]), []
+            continue
+        values = re.split(r'[\s,]+', line)
+        if len(values) < 3:
+            continue
+        try:
+            rows.append([float(value) for value in values[:3]])
+        except ValueError:
+            continue
+    if len(rows) > 0:
+        profiles[profile] = rows
+
+    return {profile: pd.DataFrame(rows, columns=['X', 'Y', 'Z'])
+            for profile, rows in profiles.items()}
+
+
+def transect_file_name(file):
+    """
+    Return the name of the transect file that goes
+    with a DEM or point cloud
+
+    file: String with the filename of the DEM or point cloud
+    """
+
+    return f'{os.path.splitext(file)[0]} Transects.csv'
+
+
+def load_transects(fname):
+    """
+    Load the transect lines used to cut profiles out
+    of a DEM or point cloud
+
+    The file is a .csv with one row per transect and the columns
+    "X Start", "Y Start", "X End", and "Y End" in the projected
+    coordinates of the data. The transects are numbered in the order
+    of the file, or by the optional "Profile" column if there is one
+
+    fname: String with the path to the transect file
+    """
+
+    df = pd.read_csv(fname, header=0)
+    df.columns = [col.strip() for col in df.columns]
+    if 'Profile' in df.columns:
+        df = df.sort_values(by='Profile')
+    df = df.reset_index(drop=True)
+
+    # A transect that starts and ends at the same point has no direction
+    # to sample along
+    length = np.hypot(df['X End'] - df['X Start'], df['Y End'] - df['Y Start'])
+    if (length == 0).any():
+        numbers = df['Profile'] if 'Profile' in df.columns else df.index + 1
+        bad = ', '.join(str(number) for number in numbers[length == 0])
+        raise ValueError(f'Transects with the same start and end in {fname}: {bad}')
+
+    return df
+
+
+def fence_file_name(location):
+    """
+    Return the name of the sand fence crossings
+    file for a location ("<location> Fences.csv")
+
+    location: String with the location
+    """
+
+    return f'{location} Fences.csv'
+
+
+def load_fences(fname):
+    """
+    Load the sand fence crossings for a location
+
+    The file is a .csv with one row per place a fence crosses a profile
+    and the columns "Profile", "Lat", and "Lon". The same fences are
+    used for every year of the location. Returns a dict with an array
+    of (Lat, Lon) rows for each profile with a fence. The dict is empty
+    if the file does not exist
+
+    fname: String with the path to the fences file
+    """
+
+    if not os.path.exists(fname):
+        return {}
+
+    df = pd.read_csv(fname, header=0)
+    df.columns = [col.strip() for col in df.columns]
+
+    return {int(profile): group[['Lat', 'Lon']].to_numpy(dtype=np.float64)
+            for profile, group in df.groupby('Profile')}
+
+
+def read_cross_sections(fname):
+    """
+    Read a file of cross sections in one pass and yield the profile
+    number and the lines of each "Cross Section N" block in turn
+
+    fname: String with the path to the data file
+    """
+
+    profile, lines = None, []
+    with open(fname) as infile:
+        for line in infile:
+            if line.strip().startswith('Cross Section'):
+                if profile is not None:
+                    yield profile, lines
+                profile, lines = int(line.split()[-1]), []
+            elif profile is not None:
+                lines.append(line)
+    if profile is not None:
+        yield profile, lines
+
+
 def make_profile_files(file, location, year, num_profiles, epsg):
     """
     Make individual profile files from the main data
@@ -62,82 +236,326 @@ def make_profile_files(file, location, year, num_profiles, epsg):
     epsg: Int with the number code for the in projection
     """
 
-    # Loop through the profiles
-    for profile in range(1, num_profiles + 1):
-
-        # Load the data file and find the points for the current profile
-        data_file = os.path.join(DATA_DIR, file)
+    # Read through the data file once and write each profile as it
+    # is reached. Profiles past the number counted are ignored
+    data_file = os.path.join(DATA_DIR, file)
+    records = []
+    for profile, lines in read_cross_sections(data_file):
+        if not 1 <= profile <= num_profiles:
+            continue
         profile_file = os.path.join('..',
                                     f'{location}',
                                     f'{year}',
                                     'Profiles',
                                     f'{location} {year} {profile}.txt')
 
-        # Write the profile files
-        with open(data_file) as infile, open(profile_file, 'w') as outfile:
-            copy = False
-            for line in infile:
-                if line.strip() == f'Cross Section {profile}':
-                    copy = True
-                    continue
-                elif line.strip() == f'Cross Section {profile + 1}':
-                    copy = False
-                    continue
-                elif copy:
-                    outfile.write(line)
-
-        # Reopen the profiles as a DataFrame
-        df = pd.read_table(profile_file, header=0)
+        # Load the profile into a DataFrame
+        df = pd.read_table(io.StringIO(''.join(lines)), header=0)
         new_cols = [col.strip() for col in df.columns]
         df.columns = new_cols
 
         # Add a column for lat and lon
-        inProj = Proj(init=f'epsg:{epsg}', preserve_units=True)
-        outProj = Proj(init='epsg:4326')
-        df['Lat'], df['Lon'] = transform(inProj, outProj, list(df['X']), list(df['Y']))
+        df = add_lat_lon(df, epsg)
 
-        # Save the DataFrame again as a .txt file
+        # Save the DataFrame as a .txt file
         df.to_csv(profile_file, sep='\t', index=False)
+        records.append(catfuncs.profile_record(location, year, profile, df, profile_file, file))
+
+    # Add the profiles to the transect catalog
+    catfuncs.add_transects(records)
 
     print(f'Finished parsing out profiles for {location} {year}...')
 
 
-def morpho_dict():
+def report_skipped(skipped, source):
+    """
+    Print the transects that were left out of a survey
+    because they had too few elevations to make a profile
+
+    skipped: List of ints with the skipped profile numbers
+    source: String describing where the profiles were cut from
+    """
+
+    if len(skipped) > 0:
+        print(f'Skipped {len(skipped)} transects with fewer than {MIN_POINTS} '
+              f'elevations in the {source}: {", ".join(str(p) for p in skipped)}')
+
+
+def parsed_profiles(location, year, num_profiles):
+    """
+    Make a list of the profile numbers that have a profile
+    file. Transects that were skipped while parsing have no
+    file and are left out of the survey
+
+    location: String with the location
+    year: String with the year being looked at
+    num_profiles: Int with the total number of transects in the survey
+    """
+
+    folder = os.path.join('..', f'{location}', f'{year}', 'Profiles')
+    return [profile for profile in range(1, num_profiles + 1)
+            if os.path.exists(os.path.join(folder, f'{location} {year} {profile}.txt'))]
+
+
+def morpho_dict(columns=()):
     """
     Return a blank dictionary with a key, value
     combination for every morphometric value being
     calculated
+
+    columns: List of strings with extra columns to add
+             to the end, e.g. uncertainty percentiles
+    """
+
+    morpho = {'Profile': [],
+              'XMHW': [],
+              'YMHW': [],
+              'MHW Lat': [],
+              'MHW Lon': [],
+              'MHW CI': [],
+              'MHW Lidar Error': [],
+              'MHW X Error': [],
+              'MHW Error': [],
+              'XCrest': [],
+              'YCrest': [],
+              'Crest Lat': [],
+              'Crest Lon': [],
+              'XHeel': [],
+              'YHeel': [],
+              'Heel Lat': [],
+              'Heel Lon': [],
+              'XToe': [],
+              'YToe': [],
+              'Toe Lat': [],
+              'Toe Lon': [],
+              'XBerm': [],
+              'YBerm': [],
+              'Berm Lat': [],
+              'Berm Lon': [],
+              'XFence': [],
+              'YFence': [],
+              'Fence Lat': [],
+              'Fence Lon': [],
+              'XFence Crest': [],
+              'YFence Crest': [],
+              'Fence Crest Lat': [],
+              'Fence Crest Lon': [],
+              'XFence Heel': [],
+              'YFence Heel': [],
+              'Fence Heel Lat': [],
+              'Fence Heel Lon': [],
+              'XFence Toe': [],
+              'YFence Toe': [],
+              'Fence Toe Lat': [],
+              'Fence Toe Lon': [],
+              'Foreshore Slope': [],
+              'Dune Volume': [],
+              'Beach Volume': [],
+              'Profile Volume': [],
+              'Fenced Dune Volume': [],
+              'Total Dune Volume': [],
+              'Start Lat': [],
+              'Start Lon': [],
+              'End Lat': [],
+              'End Lon': [],
+              'QC Flag': []}
+    for col in columns:
+        morpho[col] = []
+
+    return morpho
+
+
+def morpho_row(morpho, row):
+    """
+    Return a morpho dict holding only one row of another morpho dict
+
+    morpho: Dict with morphometrics
+    row: Int with the row to use
+    """
+
+    return {key: [values[row]] for key, values in morpho.items()}
+
+
+def replace_row(morpho, row, other, other_row=-1):
+    """
+    Replace a row of the morpho dict with a row from another morpho dict
+    that has the same columns
+
+    morpho: Dict with morphometrics
+    row: Int with the row to replace
+    other: Dict with the morphometrics to use
+    other_row: Int with the row of other to use (Default: -1)
+    """
+
+    for key, values in morpho.items():
+        values[row] = other[key][other_row]
+
+    return morpho
+
+
+def morphometrics_file(location, year):
+    """
+    Return the path to the morphometrics .csv for a survey
+
+    location: String with the location
+    year: String with the year being looked at
+    """
+
+    return os.path.join('..', f'{location}', f'{year}',
+                        f'Morphometrics for {location} {year}.csv')
+
+
+def checkpoint_file(location, year):
+    """
+    Return the path to the checkpoint file for a survey. The checkpoint
+    is an append-only file with one JSON record per finished profile
+
+    location: String with the location
+    year: String with the year being looked at
     """
 
-    return {'Profile': [],
-            'XMHW': [],
-            'YMHW': [],
-            'MHW Lat': [],
-            'MHW Lon': [],
-            'MHW CI': [],
-            'MHW Lidar Error': [],
-            'MHW X Error': [],
-            'MHW Error': [],
-            'XCrest': [],
-            'YCrest': [],
-            'Crest Lat': [],
-            'Crest Lon': [],
-            'XHeel': [],
-            'YHeel': [],
-            'Heel Lat': [],
-            'Heel Lon': [],
-            'XToe': [],
-            'YToe': [],
-            'Toe Lat': [],
-            'Toe Lon': [],
-            'Foreshore Slope': [],
-            'Dune Volume': [],
-            'Beach Volume': [],
-            'Profile Volume': [],
-            'Orientation': []}
-
-
-def setup_profile(location, year, profile, grid=0.5):
+    return os.path.join('..', f'{location}', f'{year}',
+                        f'Morphometrics for {location} {year}.checkpoint')
+
+
+def load_checkpoint(location, year, columns=()):
+    """
+    Load the finished profiles from the checkpoint file into a morpho
+    dict. A partly written record at the end of the file (from a crash
+    during a write) is cut off of the file and will be recalculated
+
+    location: String with the location
+    year: String with the year being looked at
+    columns: List of strings with extra columns in the morpho dict
+    """
+
+    morpho = morpho_dict(columns)
+    fname = checkpoint_file(location, year)
+    if not os.path.exists(fname):
+        return morpho
+
+    with open(fname, 'rb+') as checkpoint:
+        good_bytes = 0
+        for line in checkpoint:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b'\n') or record.keys() != morpho.keys():
+                break
+            for key, value in record.items():
+                morpho[key].append(value)
+            good_bytes += len(line)
+        checkpoint.truncate(good_bytes)
+
+    return morpho
+
+
+def append_checkpoint(location, year, morpho, count):
+    """
+    Append the last profiles in the morpho dict to the checkpoint file
+    and force them to disk. Each record is one line written in a single
+    call so a crash can at worst leave one partial record at the end
+
+    location: String with the location
+    year: String with the year being looked at
+    morpho: Dict with morphometrics
+    count: Int with the number of profiles at the end of morpho to append
+    """
+
+    if count == 0:
+        return
+
+    lines = []
+    for row in range(len(morpho['Profile']) - count, len(morpho['Profile'])):
+        record = {key: values[row] for key, values in morpho.items()}
+        lines.append(json.dumps(record, default=float) + '\n')
+
+    with open(checkpoint_file(location, year), 'a') as checkpoint:
+        checkpoint.write(''.join(lines))
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+
+    # Update the profiles in the transect catalog
+    rows = slice(len(morpho['Profile']) - count, None)
+    flags = morpho['QC Flag'][rows] if 'QC Flag' in morpho else None
+    catfuncs.set_status(location, year, morpho['Profile'][rows], catfuncs.CHECKPOINTED, flags)
+
+
+def save_morphometrics(df, location, year):
+    """
+    Save the morphometrics for a survey to a .csv. The file is written
+    to a temporary name and then renamed so that a crash never leaves a
+    half written .csv behind, and it is read back to check that every
+    profile made it into the file before the checkpoint is removed
+
+    df: DataFrame with the morphometrics
+    location: String with the location
+    year: String with the year being looked at
+    """
+
+    fname = morphometrics_file(location, year)
+    temp_fname = f'{fname}.tmp'
+    with open(temp_fname, 'w', newline='') as outfile:
+        df.to_csv(outfile, index=False)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_fname, fname)
+
+    # Verify the write
+    if not survey_complete(location, year, list(df['Profile'])):
+        raise IOError(f'Could not verify the morphometrics saved to {fname}')
+
+    # Record where each profile is in the .csv in the transect catalog
+    catfuncs.index_morphometrics(location, year, fname)
+
+    # The .csv now has everything so the checkpoint is no longer needed
+    if os.path.exists(checkpoint_file(location, year)):
+        os.remove(checkpoint_file(location, year))
+
+
+def survey_complete(location, year, profiles):
+    """
+    Check if the morphometrics .csv for a survey
+    exists and has a row for every profile
+
+    location: String with the location
+    year: String with the year being looked at
+    profiles: List of ints with the profile numbers that should be in the file
+    """
+
+    fname = morphometrics_file(location, year)
+    if not os.path.exists(fname):
+        return False
+
+    try:
+        saved = pd.read_csv(fname, header=0, usecols=['Profile'])
+    except (ValueError, pd.errors.ParserError, pd.errors.EmptyDataError):
+        return False
+
+    return list(saved['Profile']) == list(profiles)
+
+
+def read_profile(location, year, profile):
+    """
+    Load a profile file into a DataFrame with
+    the X, Y, Z, Lat, and Lon values
+
+    location: String with the location
+    year: String with the year being looked at
+    profile: Int with the profile number
+    """
+
+    fname = os.path.join('..',
+                         f'{location}',
+                         f'{year}',
+                         'Profiles',
+                         f'{location} {year} {profile}.txt')
+
+    return pd.read_table(fname, header=0, names=['X', 'Y', 'Z', 'Lat', 'Lon'])
+
+
+def setup_profile(location, year, profile, grid=0.5, df=None):
     """
     Determine the cross-shore distance of the profile
     and interpolate onto a 1m spaced grid
@@ -146,23 +564,36 @@ def setup_profile(location, year, profile, grid=0.5):
     year: String with the year being looked at
     profile: Int with the profile number
     grid: Interpolate onto the grid of spacing
+    df: DataFrame with the profile already loaded by read_profile() (Default: None)
 
     This comes from Paige's field profile code
     """
 
     # Load the profiles into a Pandas DataFrame
-    fname = os.path.join('..',
-                         f'{location}',
-                         f'{year}',
-                         'Profiles',
-                         f'{location} {year} {profile}.txt')
-    df = pd.read_table(fname, header=0, names=['X', 'Y', 'Z', 'Lat', 'Lon'])
+    if df is None:
+        df = read_profile(location, year, profile)
+    else:
+        df = df.copy()
+
+    return format_profile(df, grid)
+
+
+def format_profile(df, grid=0.5):
+    """
+    Determine the cross-shore distance of the profile
+    and interpolate onto a 1m spaced grid
+
+    df: DataFrame with the X, Y, Z, Lat, and Lon values of the profile
+    grid: Interpolate onto the grid of spacing
+    """
 
-    # Loop over the Z-Values
-    for ix in df['Z'].index:
-        if 'NoData' in str(df['Z'][ix]):
-            df['Z'].iloc[ix] = np.nan
-    df = df.fillna(method='ffill').fillna(method='bfill')
+    # Set "NoData" Z-Values to NaN and fill in the gaps. The DataFrame
+    # is only copied by the filling when there is something to fill
+    if df['Z'].dtype == object:
+        df['Z'] = df['Z'].where(~df['Z'].astype(str).str.contains('NoData'), np.nan)
+        df['Z'] = df['Z'].astype(np.float64)
+    if df.isnull().values.any():
+        df = df.ffill().bfill()
 
     # Compute the cross-shore distance by identifying maximum easting
     idx = df['Y'].idxmin()
@@ -172,7 +603,7 @@ def setup_profile(location, year, profile, grid=0.5):
 
     # Interpolate onto a regularly spaced grid
     x_new = np.arange(start=0, stop=np.around(np.nanmax(dist_cross)), step=grid)
-    f = interp1d(dist_cross, elev_cross)
+    f = interpolate.interp1d(dist_cross, elev_cross)
     y_new = f(x_new)
 
     # Convert all to Numpy arrays for consistency
@@ -183,13 +614,14 @@ def setup_profile(location, year, profile, grid=0.5):
     lons = np.asarray(df['Lon'])
 
     # Flip the profile if needed to guarantee
-    # that the indices increase landwards
+    # that the indices increase landwards. The
+    # flipped arrays are views, not copies
     if dist_cross[-1] > dist_cross[0]:
-        dist_cross = np.flip(dist_cross)
-        elev_cross = np.flip(elev_cross)
-        x_new = np.flip(x_new)
-        y_new = np.flip(y_new)
-        lats = np.flip(lats)
-        lons = np.flip(lons)
+        dist_cross = dist_cross[::-1]
+        elev_cross = elev_cross[::-1]
+        x_new = x_new[::-1]
+        y_new = y_new[::-1]
+        lats = lats[::-1]
+        lons = lons[::-1]
 
     return dist_cross, elev_cross, x_new, y_new, lats, lons
@@ -0,0 +1,179 @@
+"""
+Functions to thin out dense profiles before the morphometrics are found
+
+Modern LiDAR profiles can have a point every few centimeters while the
+landmarks only need meter-scale resolution. A profile is decimated with
+the Douglas-Peucker algorithm using the vertical distance to the
+simplified line, so no dropped point is further than the tolerance above
+or below the decimated profile. Local extrema around MHW, and around the
+dune peaks down to their landward bases, are always kept so the detectors
+see the same shapes
+"""
+
+from Functions.Lazy_Import import lazy_import
+
+import numpy as np
+
+# Scipy is only imported when it is first used
+signal = lazy_import('scipy.signal')
+
+# Morphometrics compared with and without decimation
+REPORT_METRICS = ['XMHW', 'XCrest', 'YCrest', 'XHeel', 'XToe', 'YToe', 'XBerm',
+                  'Foreshore Slope', 'Dune Volume', 'Beach Volume', 'Profile Volume']
+
+
+"""
+Functions to pick the points to keep
+"""
+
+
+def douglas_peucker(X, y, tolerance, keep=None):
+    """
+    Return a boolean array marking the points kept by the Douglas-Peucker
+    algorithm. The error is measured vertically so every dropped point is
+    within the tolerance of a straight line between the kept points on
+    either side of it
+
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    tolerance: Float with the largest vertical error allowed (m)
+    keep: Boolean array with points that must be kept (Default: None)
+    """
+
+    n = len(y)
+    kept = np.zeros(n, dtype=bool) if keep is None else keep.copy()
+    kept[[0, -1]] = True
+    if n < 3:
+        return np.ones(n, dtype=bool)
+
+    # Split the profile at the points that have to be kept first
+    anchors = np.flatnonzero(kept)
+    stack = list(zip(anchors[:-1], anchors[1:]))
+
+    # Keep the point furthest from the line between the ends of
+    # each segment until every segment is within the tolerance
+    while len(stack) > 0:
+        lo, hi = stack.pop()
+        if hi - lo < 2:
+            continue
+        slope = (y[hi] - y[lo]) / (X[hi] - X[lo])
+        error = np.abs(y[lo + 1:hi] - (y[lo] + slope * (X[lo + 1:hi] - X[lo])))
+        worst = int(np.argmax(error))
+        if error[worst] > tolerance:
+            mid = lo + 1 + worst
+            kept[mid] = True
+            stack.append((lo, mid))
+            stack.append((mid, hi))
+
+    return kept
+
+
+def protected_points(y, mhw, tolerance, pad=0.5):
+    """
+    Return a boolean array marking the points that are always kept:
+
+    - Local peaks and troughs within the pad of MHW, and the points on
+      either side of every place the profile crosses MHW
+    - For every dune peak (peaks above MHW standing out from their
+      surroundings by more than the tolerance), every local peak and
+      trough from where the profile first comes within the pad of the
+      peak down to the lowest point landward of it, so the crest, the
+      backshore drop, and the heel are found on the same points
+
+    y: Array with the elevation values
+    mhw: Float with the MHW elevation
+    tolerance: Float with the largest vertical error allowed (m)
+    pad: Float with the distance (+/-) around MHW and below the dune
+         peaks to protect (Default: 0.5)
+    """
+
+    keep = np.zeros(len(y), dtype=bool)
+    if len(y) < 3:
+        keep[:] = True
+        return keep
+
+    # Extrema and crossings around MHW
+    near = np.abs(y - mhw) <= pad
+    peaks, _ = signal.find_peaks(y)
+    troughs, _ = signal.find_peaks(-y)
+    extrema = np.sort(np.concatenate([peaks, troughs]))
+    keep[extrema[near[extrema]]] = True
+    crossings = np.flatnonzero(np.diff(np.sign(y - mhw)) != 0)
+    keep[crossings] = True
+    keep[crossings + 1] = True
+
+    # Extrema around the dune peaks and down their landward side. The
+    # indices increase landward so the landward base is the right base
+    dunes, props = signal.find_peaks(y, prominence=tolerance)
+    above = y[dunes] > mhw
+    for peak, left, right in zip(dunes[above], props['left_bases'][above],
+                                 props['right_bases'][above]):
+        top = left + np.flatnonzero(y[left:peak + 1] >= y[peak] - pad)[0]
+        keep[extrema[(extrema >= top) & (extrema <= right)]] = True
+        keep[[peak, left, right]] = True
+
+    return keep
+
+
+def decimate_profile(X, y, lats, lons, tolerance, mhw, pad=0.5):
+    """
+    Decimate a profile so no dropped point is more than the tolerance
+    above or below the decimated profile. Local extrema around MHW and
+    around the dune peaks down to their landward bases are always kept.
+    Returns the decimated X, y, lats, and lons arrays (still ordered
+    seaward to landward)
+
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    tolerance: Float with the largest vertical error allowed (m)
+    mhw: Float with the MHW elevation
+    pad: Float with the distance (+/-) around MHW and below the dune
+         peaks to protect (Default: 0.5)
+    """
+
+    keep = douglas_peucker(X, y, tolerance, protected_points(y, mhw, tolerance, pad))
+
+    return X[keep], y[keep], lats[keep], lons[keep]
+
+
+"""
+Functions to report on the decimation
+"""
+
+
+def compression_ratio(original, decimated):
+    """
+    Return the number of points before decimation
+    for every point kept after it
+
+    original: Int with the number of points before decimation
+    decimated: Int with the number of points after decimation
+    """
+
+    return original / max(decimated, 1)
+
+
+def morphometric_deltas(original, decimated, metrics):
+    """
+    Return a dict with the mean and largest absolute difference of each
+    metric between profiles run with and without decimation. Profiles
+    where either run is missing a metric (NaN or 9999) are left out
+
+    original: Dict (or DataFrame) with lists of the metrics without decimation
+    decimated: Dict (or DataFrame) with lists of the metrics with decimation
+    metrics: List of strings with the metrics to compare
+    """
+
+    deltas = {}
+    for metric in metrics:
+        a = np.asarray(original[metric], dtype=np.float64)
+        b = np.asarray(decimated[metric], dtype=np.float64)
+        found = np.isfinite(a) & np.isfinite(b) & (a < 9999) & (b < 9999)
+        diff = np.abs(a[found] - b[found])
+        deltas[metric] = {'mean': diff.mean() if len(diff) > 0 else np.nan,
+                          'max': diff.max() if len(diff) > 0 else np.nan,
+                          'missing': int((~found).sum())}
+
+    return deltas
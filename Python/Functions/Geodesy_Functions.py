@@ -0,0 +1,134 @@
+"""
+Functions to calculate the geometry of the transects in a survey
+
+Everything works on whole arrays of latitudes and longitudes at once
+so a survey of thousands of transects is handled in one call. The
+distances and bearings are geodesics on the WGS84 ellipsoid
+"""
+
+from Functions.Lazy_Import import lazy_import
+
+import numpy as np
+
+# Pyproj is only imported when it is first used
+pyproj = lazy_import('pyproj')
+
+
+# Set general information
+ELLIPSOID = 'WGS84'
+MISSING = 9999
+
+
+"""
+Functions to calculate bearings and distances
+"""
+
+
+def inverse(lat1, lon1, lat2, lon2):
+    """
+    Solve the inverse geodesic problem between two sets of points
+    and return the bearing from the first point to the second
+    (degrees clockwise from north, 0-360) and the distance (m)
+
+    lat1, lon1: Arrays with the latitudes and longitudes of the first points
+    lat2, lon2: Arrays with the latitudes and longitudes of the second points
+    """
+
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*[np.asarray(a, dtype=np.float64)
+                                                   for a in (lat1, lon1, lat2, lon2)])
+    azimuth, _, distance = pyproj.Geod(ellps=ELLIPSOID).inv(lon1, lat1, lon2, lat2)
+
+    return np.mod(azimuth, 360), distance
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    """
+    Return the bearing from one set of points to another
+    in degrees clockwise from north (0-360)
+
+    lat1, lon1: Arrays with the latitudes and longitudes of the start points
+    lat2, lon2: Arrays with the latitudes and longitudes of the end points
+    """
+
+    return inverse(lat1, lon1, lat2, lon2)[0]
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Return the distance (m) between two sets of points
+
+    lat1, lon1: Arrays with the latitudes and longitudes of the first points
+    lat2, lon2: Arrays with the latitudes and longitudes of the second points
+    """
+
+    return inverse(lat1, lon1, lat2, lon2)[1]
+
+
+def alongshore_spacing(lats, lons):
+    """
+    Return the alongshore width each transect represents. Transects
+    are taken to be in alongshore order and each one gets half of the
+    distance to each neighbor (the trapezoidal rule), so the widths
+    add up to the length of the survey
+
+    lats: Array with a latitude on each transect
+    lons: Array with a longitude on each transect
+    """
+
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    spacing = np.zeros(len(lats))
+    if len(lats) < 2:
+        return spacing
+
+    gaps = distance(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    spacing[:-1] += gaps / 2
+    spacing[1:] += gaps / 2
+
+    return spacing
+
+
+"""
+Functions to add the survey geometry to the morphometrics
+"""
+
+
+def survey_geometry(df):
+    """
+    Add the seaward orientation, transect length, alongshore spacing, and
+    alongshore-integrated volumes to a DataFrame of morphometrics for a
+    survey. The profiles are used in the order of the "Profile" column
+
+    Orientation: Bearing from the heel to MHW (the seaward end of the
+                 transect is used when MHW was not found)
+    Transect Length: Distance between the landward and seaward ends
+    Alongshore Spacing: Alongshore width represented by the transect,
+                        measured between the transect midpoints
+    Alongshore ... Volume: Volume per meter times the alongshore spacing
+
+    df: DataFrame with the morphometrics for a survey
+    """
+
+    df = df.sort_values(by='Profile').reset_index(drop=True)
+
+    # Orientation from the heel to MHW
+    has_mhw = df['XMHW'].to_numpy() < MISSING
+    mhw_lat = np.where(has_mhw, df['MHW Lat'], df['End Lat'])
+    mhw_lon = np.where(has_mhw, df['MHW Lon'], df['End Lon'])
+    df['Orientation'] = bearing(df['Heel Lat'], df['Heel Lon'], mhw_lat, mhw_lon)
+
+    # Length of the transects
+    df['Transect Length'] = distance(df['Start Lat'], df['Start Lon'],
+                                     df['End Lat'], df['End Lon'])
+
+    # Alongshore spacing between the transect midpoints. The midpoints
+    # are close enough together that averaging the coordinates is fine
+    mid_lat = (df['Start Lat'].to_numpy() + df['End Lat'].to_numpy()) / 2
+    mid_lon = (df['Start Lon'].to_numpy() + df['End Lon'].to_numpy()) / 2
+    df['Alongshore Spacing'] = alongshore_spacing(mid_lat, mid_lon)
+
+    # Alongshore-integrated volumes
+    for volume in ['Dune Volume', 'Beach Volume', 'Profile Volume',
+                   'Fenced Dune Volume', 'Total Dune Volume']:
+        df[f'Alongshore {volume}'] = df[volume] * df['Alongshore Spacing']
+
+    return df
@@ -0,0 +1,309 @@
+"""
+Kernels for the sequential scans in Morpho_Functions
+
+The crest backshore-drop walk, the heel walk, and the toe stretched
+sheet search all step along a profile one point at a time. Each scan
+has a plain loop version that is compiled with Numba when it is
+installed, and a vectorized NumPy version that is used otherwise.
+Both return exactly the same indices
+
+The backend is picked with set_backend() or the AUTOMORPH_KERNELS
+environment variable ("auto", "numba", or "numpy"). "auto" uses
+Numba if it can be imported and NumPy if not
+"""
+
+import numpy as np
+import os
+
+
+BACKENDS = ('auto', 'numba', 'numpy')
+BLOCK = 32      # First block size for the NumPy scans
+_backend = os.environ.get('AUTOMORPH_KERNELS', 'auto').lower()
+_compiled = None
+
+
+"""
+Plain loop versions of the scans. These are what Numba compiles
+"""
+
+
+def _backshore_peak_loop(y, pks_idx, threshold):
+    """
+    Return the position in pks_idx of the first peak with a backshore
+    drop of at least the threshold before the profile rises above the
+    peak again, or -1 if no peak has one
+    """
+
+    n = len(y)
+    for pos in range(len(pks_idx)):
+        idx = pks_idx[pos]
+        check_idx = idx
+        while check_idx + 1 < n:
+            if y[check_idx + 1] > y[idx]:
+                break
+            if y[idx] - y[check_idx + 1] >= threshold:
+                return pos
+            check_idx += 1
+
+    return -1
+
+
+def _heel_walk_loop(y, crest_idx, threshold):
+    """
+    Walk landward from the crest and return the heel index
+    """
+
+    n = len(y)
+    idx = crest_idx
+    while idx + 1 < n:
+        if y[idx + 1] < y[idx]:
+            idx += 1
+        elif y[crest_idx] - y[idx] >= threshold:
+            break
+        elif y[idx + 1] * 0.95 >= y[idx]:
+            break
+        else:
+            idx += 1
+
+    return idx
+
+
+def _toe_search_loop(y, x, lo, hi):
+    """
+    Return the index between lo and hi that is furthest below a
+    straight line from (x[lo], y[lo]) to (x[hi], y[hi])
+    """
+
+    if hi < lo:
+        lo, hi = hi, lo
+    if hi - lo < 2:
+        return lo
+
+    step = 0.0
+    if x[hi] != x[lo]:
+        step = (y[hi] - y[lo]) / (x[hi] - x[lo])
+    best, best_idx = -np.inf, lo + 1
+    for i in range(lo + 1, hi):
+        diff = y[lo] + (x[i] - x[lo]) * step - y[i]
+        if diff > best:
+            best, best_idx = diff, i
+
+    return best_idx
+
+
+"""
+Vectorized NumPy versions of the scans
+"""
+
+
+def _backshore_peak_numpy(y, pks_idx, threshold):
+    """
+    NumPy version of _backshore_peak_loop()
+    """
+
+    for pos, idx in enumerate(pks_idx):
+
+        # The peak passes if the profile drops by the threshold before
+        # it first rises above the peak elevation. Look landward in
+        # growing blocks since the answer is usually close to the peak
+        lo, size = idx + 1, BLOCK
+        while lo < len(y):
+            landward = y[lo:lo + size]
+            ends = np.flatnonzero((landward > y[idx]) |
+                                  (y[idx] - landward >= threshold))
+            if len(ends) > 0:
+                if landward[ends[0]] <= y[idx]:
+                    return pos
+                break
+            lo, size = lo + size, size * 2
+
+    return -1
+
+
+def _heel_walk_numpy(y, crest_idx, threshold):
+    """
+    NumPy version of _heel_walk_loop()
+    """
+
+    # The walk stops at the first point where the profile does not
+    # drop to the next point and either the drop from the crest is
+    # big enough or the next point is noticeably higher. Look landward
+    # in growing blocks since the heel is usually close to the crest
+    lo, size = crest_idx, BLOCK
+    while lo < len(y) - 1:
+        here, ahead = y[lo:lo + size], y[lo + 1:lo + size + 1]
+        here = here[:len(ahead)]
+        stops = ~(ahead < here) & ((y[crest_idx] - here >= threshold) |
+                                   (ahead * 0.95 >= here))
+        hits = np.flatnonzero(stops)
+        if len(hits) > 0:
+            return lo + hits[0]
+        lo, size = lo + size, size * 2
+
+    return max(len(y) - 1, crest_idx)
+
+
+def _toe_search_numpy(y, x, lo, hi):
+    """
+    NumPy version of _toe_search_loop()
+    """
+
+    if hi < lo:
+        lo, hi = hi, lo
+    if hi - lo < 2:
+        return lo
+
+    return lo + 1 + int(np.argmax(sheet_distance(y, lo, hi, x)))
+
+
+def sheet_distance(y, lo, hi, x=None):
+    """
+    Return the distance below a straight line from y[lo] to y[hi] for
+    the points between them. Only a buffer the size of the window is
+    made and the profile is read through a view
+
+    y: Array with the elevation values
+    lo: Int with the first index of the line
+    hi: Int with the last index of the line (hi > lo)
+    x: Array with the cross-shore distance values. The line is drawn
+       against the index if there are none (Default: None)
+    """
+
+    if x is None:
+        diff = np.arange(1, hi - lo, dtype=np.float64)
+        step = (y[hi] - y[lo]) / (hi - lo)
+    else:
+        diff = x[lo + 1:hi] - x[lo]
+        step = 0.0 if x[hi] == x[lo] else (y[hi] - y[lo]) / (x[hi] - x[lo])
+    diff *= step
+    diff += y[lo]
+    diff -= y[lo + 1:hi]
+
+    return diff
+
+
+"""
+Functions to pick the backend
+"""
+
+
+def set_backend(name):
+    """
+    Set the kernel backend
+
+    name: String with "auto", "numba", or "numpy"
+    """
+
+    global _backend, _compiled
+    name = name.lower()
+    if name not in BACKENDS:
+        raise ValueError(f'Kernel backend must be one of {BACKENDS}, not {name!r}')
+    _backend, _compiled = name, None
+
+
+def get_backend():
+    """
+    Return the name of the backend the kernels are running on
+    """
+
+    return kernels()['name']
+
+
+def kernels():
+    """
+    Return a dict with the kernels for the current backend. Numba
+    kernels are compiled the first time they are asked for
+    """
+
+    global _compiled
+    if _compiled is not None:
+        return _compiled
+
+    numpy_kernels = {'name': 'numpy',
+                     'backshore_peak': _backshore_peak_numpy,
+                     'heel_walk': _heel_walk_numpy,
+                     'toe_search': _toe_search_numpy}
+
+    if _backend == 'numpy':
+        _compiled = numpy_kernels
+        return _compiled
+
+    try:
+        import numba
+    except ImportError:
+        if _backend == 'numba':
+            raise ImportError('Numba is needed for the "numba" kernel backend')
+        _compiled = numpy_kernels
+        return _compiled
+
+    jit = numba.njit(cache=True, nogil=True)
+    _compiled = {'name': 'numba',
+                 'backshore_peak': jit(_backshore_peak_loop),
+                 'heel_walk': jit(_heel_walk_loop),
+                 'toe_search': jit(_toe_search_loop)}
+
+    return _compiled
+
+
+"""
+Functions to run the kernels
+"""
+
+
+def backshore_peak(y, pks_idx, threshold):
+    """
+    Return the position in pks_idx of the first peak with a backshore
+    drop of at least the threshold landward of it before the profile
+    rises above the peak again. Returns -1 if no peak has one
+
+    y: Array with the elevation values
+    pks_idx: Array of ints with the peak indices, ordered seaward to landward
+    threshold: Float with the minimum backshore drop
+    """
+
+    return int(kernels()['backshore_peak'](np.asarray(y, dtype=np.float64),
+                                           np.asarray(pks_idx, dtype=np.int64),
+                                           float(threshold)))
+
+
+def heel_walk(y, crest_idx, threshold):
+    """
+    Walk landward from the crest and return the heel index
+
+    y: Array with the elevation values
+    crest_idx: Int with the crest index
+    threshold: Float with the minimum crest-to-heel elevation distance
+    """
+
+    return int(kernels()['heel_walk'](np.asarray(y, dtype=np.float64),
+                                      int(crest_idx), float(threshold)))
+
+
+def toe_search(y, lo, hi, x=None):
+    """
+    Return the toe index with the stretched sheet method. A straight
+    line is stretched from y[lo] to y[hi] and the point between them
+    that is furthest below the line is the toe. Only the window between
+    lo and hi is looked at. If there are no points between them then
+    lo is returned
+
+    y: Array with the elevation values
+    lo: Int with the index at one end of the sheet (e.g., MHW)
+    hi: Int with the index at the other end of the sheet (e.g., the crest)
+    x: Array with the cross-shore distance values so the sheet is right
+       for unevenly spaced points. The points are taken to be evenly
+       spaced if there are none (Default: None)
+    """
+
+    y = np.asarray(y, dtype=np.float64)
+    lo, hi = int(lo), int(hi)
+    if x is not None:
+        return int(kernels()['toe_search'](y, np.asarray(x, dtype=np.float64), lo, hi))
+
+    # Without distances the sheet is drawn against the index, so only
+    # the window is passed to the kernel with indices counted from lo
+    first, last = min(lo, hi), max(lo, hi)
+    window = np.arange(last - first + 1, dtype=np.float64)
+
+    return first + int(kernels()['toe_search'](y[first:last + 1], window,
+                                               lo - first, hi - first))
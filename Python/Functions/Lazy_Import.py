@@ -0,0 +1,44 @@
+"""
+Import heavy dependencies the first time they are used
+
+Most Automorph runs never touch some of the big packages (plotting
+when figures are turned off, scikit-learn when MHW is never fit,
+etc.) so they are wrapped in a stand-in module that only does the
+real import when one of its attributes is first looked up
+"""
+
+import importlib
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access.
+    Attributes are cached on the stand-in after the first lookup so
+    later lookups cost the same as on the real module
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        value = getattr(self._module, attr)
+        self.__dict__[attr] = value
+        return value
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
+
+
+def lazy_import(name):
+    """
+    Return a stand-in for a module that is only
+    imported when it is first used
+
+    name: String with the full module name (e.g. "scipy.signal")
+    """
+
+    return LazyModule(name)
@@ -4,13 +4,17 @@ Functions to extract morphology from profiles with Automorph
 Michael Itzkin, 6/29/2021
 """
 
-from sklearn.linear_model import LinearRegression
-from scipy import signal, stats
+from Functions import Kernel_Functions as kfuncs
+from Functions.Lazy_Import import lazy_import
 
-import matplotlib.pyplot as plt
 import numpy as np
 import copy
 
+# Heavy dependencies are only imported when first used
+linear_model = lazy_import('sklearn.linear_model')
+signal = lazy_import('scipy.signal')
+stats = lazy_import('scipy.stats')
+
 
 """
 Functions to help identify various morphometrics
@@ -41,7 +45,7 @@ def getPairStats(x, y):
     return s_xx, s_yy, s_xy
 
 
-def store_morpho(idx, col, morpho, X, y, lats, lons, replace=False):
+def store_morpho(idx, col, morpho, X, y, lats, lons, replace=False, cache=None):
     """
     Place the morphometric values into the dict
 
@@ -52,7 +56,12 @@ def store_morpho(idx, col, morpho, X, y, lats, lons, replace=False):
     y: Array with the elevation values
     lats: Array with the latitudes for the profile points
     lons: Array with the longitudes for the profile points
+    replace: Bool to overwrite the last stored value (Default: False)
+    cache: Dict from profile_cache() to remember the index in (Default: None)
     """
+    if cache is not None:
+        cache['index'][col] = int(idx)
+
     if replace:
         morpho[f'X{col}'][-1] = X[idx]
         morpho[f'Y{col}'][-1] = y[idx]
@@ -67,26 +76,203 @@ def store_morpho(idx, col, morpho, X, y, lats, lons, replace=False):
     return morpho
 
 
+def store_missing(col, morpho):
+    """
+    Place NaN values into the dict for a
+    morphometric that is not on the profile
+
+    col: String with the morphometric name
+    morpho: Dict with morphometrics
+    """
+
+    for key in [f'X{col}', f'Y{col}', f'{col} Lat', f'{col} Lon']:
+        morpho[key].append(np.nan)
+
+    return morpho
+
+
+def remove_morpho(col, morpho):
+    """
+    Remove the last stored values of a morphometric
+    so that it can be found again
+
+    col: String with the morphometric name
+    morpho: Dict with morphometrics
+    """
+
+    for key in [f'X{col}', f'Y{col}', f'{col} Lat', f'{col} Lon']:
+        morpho[key].pop()
+
+    return morpho
+
+
+def search_window(X, center, half_width):
+    """
+    Return the (first, last) indices of the points within the half width
+    of a cross-shore position, or None if no point is within it
+
+    X: Array with the cross-shore distance values
+    center: Float with the cross-shore position to search around
+    half_width: Float with the distance (+/-) to search
+    """
+
+    inside = np.flatnonzero(np.abs(X - center) <= half_width)
+    if len(inside) == 0:
+        return None
+
+    return int(inside[0]), int(inside[-1])
+
+
+def alongshore_prior(morpho):
+    """
+    Return a dict with the distance of the crest and the toe landward of
+    MHW on the last profile in the morpho dict, or None if MHW wasn't
+    found on it. The distances are measured from MHW so that profiles
+    that don't start on the same baseline can be compared
+
+    morpho: Dict with morphometrics
+    """
+
+    x_mhw = morpho['XMHW'][-1]
+    if not np.isfinite(x_mhw) or x_mhw == 9999:
+        return None
+
+    return {'Crest': x_mhw - morpho['XCrest'][-1],
+            'Toe': x_mhw - morpho['XToe'][-1]}
+
+
+def prior_windows(morpho, X, prior, half_width):
+    """
+    Return a dict with the (first, last) indices to search for the crest
+    and the toe on the current profile. The windows are centered the same
+    distance landward of MHW as the landmarks on the neighboring profile.
+    No windows are returned if MHW wasn't found on the current profile
+
+    morpho: Dict with morphometrics, MHW found for the current profile
+    X: Array with the cross-shore distance values
+    prior: Dict from alongshore_prior() for the neighboring profile
+    half_width: Float with the distance (+/-) to search around each landmark
+    """
+
+    x_mhw = morpho['XMHW'][-1]
+    if prior is None or not np.isfinite(x_mhw) or x_mhw == 9999:
+        return {}
+
+    windows = {}
+    for col, distance in prior.items():
+        window = search_window(X, x_mhw - distance, half_width)
+        if window is not None:
+            windows[col] = window
+
+    return windows
+
+
+def profile_cache(X, y):
+    """
+    Return a dict with the intermediate values that the detectors share
+    so they are only calculated once per profile. Holds the peak indices
+    of the profile, the cumulative area under the profile, and the index
+    of every landmark stored so far (filled in by store_morpho())
+
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    """
+
+    return {'peaks': signal.find_peaks(y)[0],
+            'cumulative': cumulative_area(X, y),
+            'index': {}}
+
+
+def cumulative_area(X, y):
+    """
+    Return the area under the profile (trapezoidal rule) from
+    the first point to each point on the profile
+
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    """
+
+    cumulative = np.zeros(len(y))
+    np.cumsum((y[1:] + y[:-1]) / 2 * np.diff(X), out=cumulative[1:])
+
+    return cumulative
+
+
+def landmark_index(col, morpho, X, cache=None):
+    """
+    Return the index of a morphometric on the profile, or
+    None if it was not found (stored as NaN or 9999)
+
+    col: String with the morphometric name
+    morpho: Dict with morphometrics
+    X: Array with the cross-shore distance values
+    cache: Dict from profile_cache() (Default: None)
+    """
+
+    if cache is not None and col in cache['index']:
+        return cache['index'][col]
+
+    value = morpho[f'X{col}'][-1]
+    if np.isnan(value) or value >= 9999:
+        return None
+
+    return np.argwhere(X == value)[0][0]
+
+
+def fill_volume(X, y, lo, hi, base, cumulative=None):
+    """
+    Return the volume of the profile above a base elevation between two
+    indices. This is the area between the profile and a copy of it with
+    y[lo:hi] set to the base, worked out from the cumulative area under
+    the profile so no copy of the profile has to be made
+
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    lo: Int with the first index set to the base
+    hi: Int with the index after the last index set to the base
+    base: Float with the base elevation
+    cumulative: Array with the cumulative area under the profile
+                from profile_cache() (Default: None)
+    """
+
+    if hi <= lo:
+        return 0.0
+    if cumulative is None:
+        cumulative = cumulative_area(X, y)
+
+    # Area of the segments with both ends raised above the base
+    area = (cumulative[hi - 1] - cumulative[lo]) - base * (X[hi - 1] - X[lo])
+
+    # Half-raised segments at either end
+    if lo > 0:
+        area += (y[lo] - base) / 2 * (X[lo] - X[lo - 1])
+    if hi < len(y):
+        area += (y[hi - 1] - base) / 2 * (X[hi] - X[hi - 1])
+
+    # The cross-shore distance decreases with the index
+    return -area
+
+
 """
 Functions to identify key morphometrics
 """
 
 
-def beach_volume(X, y, morpho):
+def beach_volume(X, y, morpho, cache=None):
     """
     Calculate the beach volume
 
     X: Array of cross-shore distance values
     y: Array of the upper-elevation values
     morpho: Dict with morphometric values
+    cache: Dict from profile_cache() (Default: None)
     """
 
     # Find the mhw and toe indices
-    if morpho['XMHW'][-1] < 9999:
-        mhw_ix = np.argwhere(X == morpho['XMHW'][-1])[0][0]
-    else:
+    mhw_ix = landmark_index('MHW', morpho, X, cache)
+    if mhw_ix is None:
         mhw_ix = 0
-    toe_ix = np.argwhere(X == morpho['XToe'][-1])[0][0]
+    toe_ix = landmark_index('Toe', morpho, X, cache)
 
     # Set a base elevation based on whichever is
     # lower; the toe or heel
@@ -95,35 +281,30 @@ def beach_volume(X, y, morpho):
     else:
         base = y[mhw_ix]
 
-    # Make a fake profile with values between the
-    # toe and the heel set to the base
-    fake_profile = copy.deepcopy(y)
-    fake_profile[mhw_ix:toe_ix] = base
-
-    # Integrate over the full profile and
-    # the fake profile
-    profile_vol = -np.trapz(y, X)
-    fake_vol = -np.trapz(fake_profile, X)
-    dune_vol = profile_vol - fake_vol
+    # Integrate the profile above the base between MHW and the toe
+    cumulative = cache['cumulative'] if cache is not None else None
+    beach_vol = fill_volume(X, y, mhw_ix, toe_ix, base, cumulative)
 
-    # Put the dune volume in the morpho dict
-    morpho['Beach Volume'].append(dune_vol)
+    # Put the beach volume in the morpho dict
+    morpho['Beach Volume'].append(beach_vol)
 
     return morpho
 
 
-def dune_volume(X, y, morpho):
+def dune_volume(X, y, morpho, cache=None):
     """
-    Calculate the dune volume
+    Calculate the (natural) dune volume between the toe and the heel.
+    Port of natural_dune_volume_finder.m
 
     X: Array of cross-shore distance values
     y: Array of the upper-elevation values
     morpho: Dict with morphometric values
+    cache: Dict from profile_cache() (Default: None)
     """
 
     # Find the toe and heel indices
-    toe_ix = np.argwhere(X == morpho['XToe'][-1])[0][0]
-    heel_ix = np.argwhere(X == morpho['XHeel'][-1])[0][0]
+    toe_ix = landmark_index('Toe', morpho, X, cache)
+    heel_ix = landmark_index('Heel', morpho, X, cache)
 
     # Set a base elevation based on whichever is
     # lower; the toe or heel
@@ -132,16 +313,9 @@ def dune_volume(X, y, morpho):
     else:
         base = y[toe_ix]
 
-    # Make a fake profile with values between the
-    # toe and the heel set to the base
-    fake_profile = copy.deepcopy(y)
-    fake_profile[toe_ix:heel_ix] = base
-
-    # Integrate over the full profile and
-    # the fake profile
-    profile_vol = -np.trapz(y, X)
-    fake_vol = -np.trapz(fake_profile, X)
-    dune_vol = profile_vol - fake_vol
+    # Integrate the profile above the base between the toe and the heel
+    cumulative = cache['cumulative'] if cache is not None else None
+    dune_vol = fill_volume(X, y, toe_ix, heel_ix, base, cumulative)
 
     # Put the dune volume in the morpho dict
     morpho['Dune Volume'].append(dune_vol)
@@ -149,6 +323,64 @@ def dune_volume(X, y, morpho):
     return morpho
 
 
+def fenced_dune_volume(X, y, morpho, cache=None):
+    """
+    Calculate the volume of the fenced dune between the fenced dune
+    toe and heel. NaN if the profile has no fenced dune. Port of
+    fenced_dune_volume_finder.m
+
+    X: Array of cross-shore distance values
+    y: Array of the upper-elevation values
+    morpho: Dict with morphometric values
+    cache: Dict from profile_cache() (Default: None)
+    """
+
+    # Find the fenced dune toe and heel indices
+    toe_ix = landmark_index('Fence Toe', morpho, X, cache)
+    heel_ix = landmark_index('Fence Heel', morpho, X, cache)
+
+    if toe_ix is None or heel_ix is None:
+        dune_vol = np.nan
+    else:
+        base = min(y[toe_ix], y[heel_ix])
+        cumulative = cache['cumulative'] if cache is not None else None
+        dune_vol = fill_volume(X, y, toe_ix, heel_ix, base, cumulative)
+
+    # Put the dune volume in the morpho dict
+    morpho['Fenced Dune Volume'].append(dune_vol)
+
+    return morpho
+
+
+def total_dune_volume(X, y, morpho, cache=None):
+    """
+    Calculate the volume of the natural and fenced dunes together
+    between the fenced dune toe and the natural dune heel. NaN if the
+    profile has no fenced dune. Port of total_dune_volume_finder.m
+
+    X: Array of cross-shore distance values
+    y: Array of the upper-elevation values
+    morpho: Dict with morphometric values
+    cache: Dict from profile_cache() (Default: None)
+    """
+
+    # Find the fenced dune toe and natural dune heel indices
+    toe_ix = landmark_index('Fence Toe', morpho, X, cache)
+    heel_ix = landmark_index('Heel', morpho, X, cache)
+
+    if toe_ix is None:
+        dune_vol = np.nan
+    else:
+        base = min(y[toe_ix], y[heel_ix])
+        cumulative = cache['cumulative'] if cache is not None else None
+        dune_vol = fill_volume(X, y, toe_ix, heel_ix, base, cumulative)
+
+    # Put the dune volume in the morpho dict
+    morpho['Total Dune Volume'].append(dune_vol)
+
+    return morpho
+
+
 def profile_volume(X, y, morpho):
     """
     Calculate the volume of the profile above mhw
@@ -178,7 +410,27 @@ def profile_volume(X, y, morpho):
     return morpho
 
 
-def find_crest(morpho, X, y, lats, lons, mhw, threshold=0.6, crest_pct=0.2):
+def derived_metrics(df):
+    """
+    Add the metrics that can be calculated from the
+    landmarks of every profile at once without looping
+    through the profiles
+
+    df: DataFrame with morphometric values
+    """
+
+    df['Dune Height'] = df['YCrest'] - df['YToe']
+    df['Dune Width'] = df['XToe'] - df['XHeel']
+    df['Dune Aspect Ratio'] = df['Dune Height'] / df['Dune Width']
+    df['Dune Face Slope'] = df['Dune Height'] / (df['XToe'] - df['XCrest'])
+    df['Beach Width'] = df['XMHW'] - df['XToe']
+    df['Beach Slope'] = (df['YToe'] - df['YMHW']) / df['Beach Width']
+
+    return df
+
+
+def find_crest(morpho, X, y, lats, lons, mhw, threshold=0.6, crest_pct=0.2, cache=None,
+               window=None):
     """
     Identify the dune crest on the profile using the method
     from Mull and Ruggiero (2014) where the crest is identified
@@ -194,63 +446,55 @@ def find_crest(morpho, X, y, lats, lons, mhw, threshold=0.6, crest_pct=0.2):
     threshold: Float with the minimum rest-to-heel
                elevation distance (Default = 0.6 m)
     crest_pct: Float to check if a more seaward peak might be more appropriate
+    cache: Dict from profile_cache() (Default: None)
+    window: Tuple with the (first, last) indices to look for the crest
+            between. The whole profile is used if there are no peaks
+            in the window (Default: None)
     """
 
     # Find peaks on the profile. The indices increase landwards
-    pks_idx, _ = signal.find_peaks(y)
+    if cache is not None:
+        pks_idx = cache['peaks']
+    else:
+        pks_idx, _ = signal.find_peaks(y)
 
     # Remove peaks below MHW
     if len(pks_idx) > 0:
         pks_idx = pks_idx[y[pks_idx] > mhw]
 
+    # Only use the peaks in the window, if there are any
+    if window is not None:
+        in_window = pks_idx[(pks_idx >= window[0]) & (pks_idx <= window[1])]
+        if len(in_window) > 0:
+            pks_idx = in_window
+
     # If there aren't any peaks just take the maximum value
     if len(pks_idx) == 0:
         idx = np.argmax(y)
 
     else:
 
-        # Loop through the peaks
-        for idx in pks_idx:
-            backshore_drop = 0
-
-            # Set the current peak elevation
-            curr_elevation = y[idx]
-
-            # Loop landwards across the profile
-            check_idx = idx
-            while check_idx < len(y):
-
-                # Check that the next landward point is lower
-                if check_idx + 1 >= len(y):
-                    break
-                elif y[check_idx + 1] > y[idx]:
-                    break
-                else:
-
-                    # Check the elevation distance
-                    check_elevation = y[check_idx + 1]
-                    backshore_drop = curr_elevation - check_elevation
-                    if backshore_drop >= threshold:
-                        break
-                    else:
-                        check_idx += 1
-
-            if backshore_drop >= threshold:
-
-                # Check the seaward peaks
-                lo = y[idx] * (1 - crest_pct)
-                pks_idx = pks_idx[y[pks_idx] > lo]
-                if len(pks_idx) > 0:
-                    idx = pks_idx[0]
-                break
+        # Find the first peak with a big enough backshore drop landward of
+        # it before the profile rises above the peak. If no peak has one
+        # then the most landward peak is used
+        first = kfuncs.backshore_peak(y, pks_idx, threshold)
+        idx = pks_idx[first]
+
+        if first >= 0:
+
+            # Check the seaward peaks
+            lo = y[idx] * (1 - crest_pct)
+            pks_idx = pks_idx[y[pks_idx] > lo]
+            if len(pks_idx) > 0:
+                idx = pks_idx[0]
 
     # Put the crest into the DataFrame
-    morpho = store_morpho(idx, 'Crest', morpho, X, y, lats, lons)
+    morpho = store_morpho(idx, 'Crest', morpho, X, y, lats, lons, cache=cache)
 
     return morpho
 
 
-def find_heel(morpho, X, y, lats, lons, threshold=0.6):
+def find_heel(morpho, X, y, lats, lons, threshold=0.6, cache=None):
     """
     Find the dune heel on the profile
 
@@ -261,10 +505,11 @@ def find_heel(morpho, X, y, lats, lons, threshold=0.6):
     lons: Array with the longitudes for the profile points
     threshold: Float with the minimum rest-to-heel
                elevation distance (Default = 0.6 m)
+    cache: Dict from profile_cache() (Default: None)
     """
 
     # Find the crest position
-    crest_idx = np.argwhere(X == morpho['XCrest'][-1])[0][0]
+    crest_idx = landmark_index('Crest', morpho, X, cache)
 
     # If the crest is the last "index" then
     # just set the heel to equal the crest
@@ -273,41 +518,31 @@ def find_heel(morpho, X, y, lats, lons, threshold=0.6):
         morpho['YHeel'].append(morpho['YCrest'][-1])
         morpho['Heel Lat'].append(morpho['Crest Lat'][-1])
         morpho['Heel Lon'].append(morpho['Crest Lon'][-1])
+        if cache is not None:
+            cache['index']['Heel'] = crest_idx
 
     # Find the heel
     else:
 
-        # Loop landward from the crest
-        idx = crest_idx
-        while idx < len(X):
-
-            # Check the elevation difference
-            elevation_difference = y[crest_idx] - y[idx]
-            if idx + 1 >= len(X):
-                break
-            elif y[idx + 1] < y[idx]:
-                idx += 1
-            elif elevation_difference >= threshold:
-                break
-            elif y[idx + 1] * 0.95 >= y[idx]:
-                break
-            else:
-                idx += 1
+        # Walk landward from the crest while the profile keeps dropping
+        # until the drop from the crest reaches the threshold or the
+        # profile starts to rise
+        idx = kfuncs.heel_walk(y, crest_idx, threshold)
 
         # Store the heel position
-        morpho = store_morpho(idx, 'Heel', morpho, X, y, lats, lons)
+        morpho = store_morpho(idx, 'Heel', morpho, X, y, lats, lons, cache=cache)
 
         # The crest may need to be re-adjusted here so set the crest
         # equal to the tallest point between the heel and the current
         # crest position
         new_crest_idx = np.argmax(y[crest_idx:idx]) + crest_idx
         morpho = store_morpho(new_crest_idx, 'Crest', morpho,
-                              X, y, lats, lons, replace=True)
+                              X, y, lats, lons, replace=True, cache=cache)
 
     return morpho
 
 
-def find_mhw(morpho, X, y, lats, lons, mhw, pad=0.5):
+def find_mhw(morpho, X, y, lats, lons, mhw, pad=0.5, cache=None):
     """
     Identify the MHW contour on the profile using a regression
     of points around the MHW contour. Keep performing regressions
@@ -328,6 +563,7 @@ def find_mhw(morpho, X, y, lats, lons, mhw, pad=0.5):
     lons: Array of longitudes for the profile
     mhw: Float with the MHW elevation for the profile
     pad: Float with the distance (+/-) around MHW to regress on (Default: 0.5)
+    cache: Dict from profile_cache() (Default: None)
     """
 
     # Pull out all points within the pad distance of MHW. The landward
@@ -347,11 +583,13 @@ def find_mhw(morpho, X, y, lats, lons, mhw, pad=0.5):
         observed_mhw_ix = np.argmin(y_search)
         observed_x_mhw = X_use[observed_mhw_ix]
         observed_y_mhw = y_use[observed_mhw_ix]
-        mhw_lat = lats[observed_mhw_ix]
-        mhw_lon = lons[observed_mhw_ix]
+        mhw_lat = lats[mask][observed_mhw_ix]
+        mhw_lon = lons[mask][observed_mhw_ix]
+        if cache is not None:
+            cache['index']['MHW'] = int(np.flatnonzero(mask)[observed_mhw_ix])
 
         # Peform a linear regression on the X_use and y_use arrays
-        reg = LinearRegression().fit(X_use.reshape(-1, 1), y_use.reshape(-1, 1))
+        reg = linear_model.LinearRegression().fit(X_use.reshape(-1, 1), y_use.reshape(-1, 1))
         m = reg.coef_[0][0]
         b = reg.intercept_[0]
 
@@ -415,76 +653,317 @@ def find_mhw(morpho, X, y, lats, lons, mhw, pad=0.5):
     return morpho
 
 
-def find_toe(morpho, X, y, lats, lons):
+def find_toe(morpho, X, y, lats, lons, cache=None, window=None):
     """
     Find the dune toe on the profile using the stretched
-    sheet method from Mitasova et al. (2011)
+    sheet method from Mitasova et al. (2011). Only the
+    points between MHW and the crest are considered
 
     morpho: Dict with morphometrics
     X: Array with the cross-shore distance values
     y: Array with the elevation values
     lats: Array with the latitudes for the profile points
     lons: Array with the longitudes for the profile points
+    cache: Dict from profile_cache() (Default: None)
+    window: Tuple with the (first, last) indices to look for the toe
+            between. The sheet still runs from MHW to the crest. All of
+            the points between MHW and the crest are used if none of
+            them are in the window (Default: None)
     """
 
     # Get the crest and MHW indices
-    crest_idx = np.argwhere(X == morpho['XCrest'][-1])[0][0]
-    if morpho['XMHW'][-1] < 9999:
-        mhw_idx = np.argwhere(X == morpho['XMHW'][-1])[0][0]
-    else:
+    crest_idx = landmark_index('Crest', morpho, X, cache)
+    mhw_idx = landmark_index('MHW', morpho, X, cache)
+    if mhw_idx is None:
         mhw_idx = 1
 
-    # Make a copy of the profile with a straight
-    # line from the MHW to Crest positions
-    y_copy = copy.deepcopy(y)
-    y_copy[mhw_idx:crest_idx] = np.linspace(start=morpho['YMHW'][-1],
-                                            stop=morpho['YCrest'][-1],
-                                            num=crest_idx - mhw_idx)
-
-    # Subtract the copy from the original profile and idenitfy
-    # the maximum point
-    y_diff = y_copy - y
-    toe_idx = np.argmax(y_diff)
+    # Stretch a straight line from the MHW to Crest positions
+    # and find the point furthest below it, only looking in
+    # the window if there is one
+    lo, hi = min(mhw_idx, crest_idx), max(mhw_idx, crest_idx)
+    first, last = lo + 1, hi - 1
+    if window is not None:
+        first, last = max(first, window[0]), min(last, window[1])
+    if window is not None and first <= last:
+        step = 0.0 if X[hi] == X[lo] else (y[hi] - y[lo]) / (X[hi] - X[lo])
+        sheet = y[lo] + (X[first:last + 1] - X[lo]) * step - y[first:last + 1]
+        toe_idx = first + int(np.argmax(sheet))
+    else:
+        toe_idx = kfuncs.toe_search(y, mhw_idx, crest_idx, X)
 
     # Store the toe location
-    morpho = store_morpho(toe_idx, 'Toe', morpho, X, y, lats, lons)
+    morpho = store_morpho(toe_idx, 'Toe', morpho, X, y, lats, lons, cache=cache)
 
     return morpho
 
 
-def orientation(morpho, X, lats, lons):
+def find_berm(morpho, X, y, lats, lons, cache=None):
     """
-    Calculate the profile bearing pointing seawards
+    Find the berm on the profile. A straight line is stretched from
+    MHW to the toe and the berm is the peak above the line that is
+    closest to MHW. Port of berm_finder.m
 
-    Modified from:
-    https://towardsdatascience.com/calculating-the-bearing-between-two-geospatial-coordinates-66203f57e4b4
+    morpho: Dict with morphometrics
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    cache: Dict from profile_cache() (Default: None)
+    """
 
-    morpho: Dict with morphmetric values
+    # Get the MHW and toe indices
+    mhw_idx = landmark_index('MHW', morpho, X, cache)
+    toe_idx = landmark_index('Toe', morpho, X, cache)
+    if mhw_idx is None or toe_idx - mhw_idx < 2:
+        return store_missing('Berm', morpho)
+
+    # Find the peaks in the height of the profile above the line. The
+    # first one is the closest to MHW since the indices increase landward
+    height = -kfuncs.sheet_distance(y, mhw_idx, toe_idx, X)
+    pks_idx, _ = signal.find_peaks(height)
+    pks_idx = pks_idx[height[pks_idx] > 0]
+    if len(pks_idx) == 0:
+        return store_missing('Berm', morpho)
+
+    # Store the berm location
+    morpho = store_morpho(mhw_idx + 1 + pks_idx[0], 'Berm', morpho,
+                          X, y, lats, lons, cache=cache)
+
+    return morpho
+
+
+def find_fence(morpho, X, y, lats, lons, crossings=None, cache=None):
+    """
+    Find where a sand fence crosses the profile. The fence is put at the
+    profile point closest to the crossing. If a profile is crossed by
+    more than one fence the most seaward is used. Port of fence_locator.m
+
+    morpho: Dict with morphometrics
     X: Array with the cross-shore distance values
-    lats: Array with latitude values
-    lons: Array with longitude values
+    y: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    crossings: Array with a (Lat, Lon) row for every fence crossing
+               on the profile, or None if there are no fences (Default: None)
+    cache: Dict from profile_cache() (Default: None)
     """
 
-    # Get the heel and MHW indices
-    if morpho['XMHW'][-1] < 9999:
-        mhw_ix = np.argwhere(X == morpho['XMHW'][-1])[0][0]
+    if crossings is None or len(crossings) == 0:
+        return store_missing('Fence', morpho)
+
+    # Find the closest profile point to each crossing. The profile is
+    # short enough that scaling the longitudes is as good as a geodesic
+    crossings = np.atleast_2d(crossings)
+    scale = np.cos(np.radians(np.mean(lats)))
+    fence_idx = min(int(np.argmin((lats - lat) ** 2 + ((lons - lon) * scale) ** 2))
+                    for lat, lon in crossings)
+
+    # Store the fence location
+    morpho = store_morpho(fence_idx, 'Fence', morpho, X, y, lats, lons, cache=cache)
+
+    return morpho
+
+
+def find_fence_crest(morpho, X, y, lats, lons, min_gap=4, cache=None):
+    """
+    Find the crest of the fenced dune as the most seaward peak between
+    the fence and the natural dune crest. Port of fence_crest_finder.m
+
+    morpho: Dict with morphometrics
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    min_gap: Int with the fewest points between the fence and the
+             crest to look for a fenced dune in (Default: 4)
+    cache: Dict from profile_cache() (Default: None)
+    """
+
+    # Get the fence and crest indices
+    fence_idx = landmark_index('Fence', morpho, X, cache)
+    crest_idx = landmark_index('Crest', morpho, X, cache)
+    if fence_idx is None or crest_idx - fence_idx < min_gap:
+        return store_missing('Fence Crest', morpho)
+
+    # Use the profile peaks between the fence and the crest
+    if cache is not None:
+        pks_idx = cache['peaks']
     else:
-        mhw_ix = 0
-    heel_ix = np.argwhere(X == morpho['XHeel'][-1])[0][0]
+        pks_idx, _ = signal.find_peaks(y)
+    pks_idx = pks_idx[(pks_idx > fence_idx) & (pks_idx < crest_idx - 1)]
+    if len(pks_idx) == 0:
+        return store_missing('Fence Crest', morpho)
+
+    # Store the fenced dune crest location
+    morpho = store_morpho(pks_idx[0], 'Fence Crest', morpho,
+                          X, y, lats, lons, cache=cache)
+
+    return morpho
+
+
+def find_fence_heel(morpho, X, y, lats, lons, cache=None):
+    """
+    Find the heel of the fenced dune by walking landward from the
+    fenced dune crest toward the natural dune crest while the profile
+    does not rise. Port of fence_heel_finder.m
+
+    morpho: Dict with morphometrics
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    cache: Dict from profile_cache() (Default: None)
+    """
+
+    # Get the fenced dune crest and natural dune crest indices
+    fence_crest_idx = landmark_index('Fence Crest', morpho, X, cache)
+    crest_idx = landmark_index('Crest', morpho, X, cache)
+    if fence_crest_idx is None:
+        return store_missing('Fence Heel', morpho)
+
+    # Count the steps landward before the profile first rises
+    here = y[fence_crest_idx:crest_idx]
+    ahead = y[fence_crest_idx + 1:crest_idx + 1]
+    rises = np.flatnonzero(ahead > here)
+    steps = rises[0] if len(rises) > 0 else len(here)
+    if steps == 0:
+        return store_missing('Fence Heel', morpho)
+
+    # Store the fenced dune heel location
+    morpho = store_morpho(fence_crest_idx + steps, 'Fence Heel', morpho,
+                          X, y, lats, lons, cache=cache)
+
+    return morpho
+
+
+def find_fence_toe(morpho, X, y, lats, lons, cache=None):
+    """
+    Find the toe of the fenced dune using the stretched sheet
+    method between MHW and the fenced dune crest. Port of
+    fence_toe_finder.m
+
+    morpho: Dict with morphometrics
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    lats: Array with the latitudes for the profile points
+    lons: Array with the longitudes for the profile points
+    cache: Dict from profile_cache() (Default: None)
+    """
+
+    # Get the fenced dune crest and MHW indices
+    fence_crest_idx = landmark_index('Fence Crest', morpho, X, cache)
+    mhw_idx = landmark_index('MHW', morpho, X, cache)
+    if fence_crest_idx is None or mhw_idx is None:
+        return store_missing('Fence Toe', morpho)
+
+    # Stretch a straight line from MHW to the fenced
+    # dune crest and find the point furthest below it
+    toe_idx = kfuncs.toe_search(y, mhw_idx, fence_crest_idx, X)
+
+    # Store the fenced dune toe location
+    morpho = store_morpho(toe_idx, 'Fence Toe', morpho, X, y, lats, lons, cache=cache)
+
+    return morpho
+
+
+def toe_candidates(y, mhw_idx, crest_idx, k=5, X=None):
+    """
+    Rank the points between MHW and the crest by how far below the
+    stretched sheet they are. The first candidate is the toe from
+    find_toe(). Useful for checking profiles with more than one
+    plausible toe
+
+    Returns an array with the indices of the top k candidates and
+    an array with their distances below the sheet
+
+    y: Array with the elevation values
+    mhw_idx: Int with the MHW index
+    crest_idx: Int with the crest index
+    k: Int with the number of candidates to return (Default: 5)
+    X: Array with the cross-shore distance values (Default: None = evenly spaced)
+    """
+
+    lo, hi = min(mhw_idx, crest_idx), max(mhw_idx, crest_idx)
+    if hi - lo < 2:
+        return np.array([lo]), np.array([np.nan])
+
+    # Rank the points in the window by their distance below the sheet
+    diff = kfuncs.sheet_distance(y, lo, hi, X)
+    k = min(k, len(diff))
+    top = np.argpartition(-diff, k - 1)[:k]
+    top = top[np.lexsort((top, -diff[top]))]
 
-    # Grab the starting and ending points
-    a = {'lat': lons[heel_ix], 'lon': lats[heel_ix]}
-    b = {'lat': lons[mhw_ix], 'lon': lats[mhw_ix]}
+    return lo + 1 + top, diff[top]
 
-    # Calculate the change in longitude
-    dl = b['lon'] - a['lon']
 
-    # Calculate X and Y
-    X = np.cos(b['lat']) * np.sin(dl)
-    y = np.cos(a['lat']) * np.sin(b['lat']) - np.sin(a['lat']) * np.cos(b['lat']) * np.cos(dl)
+def find_toe_batch(Y, mhw_idx, crest_idx, k=1, X=None):
+    """
+    Find the dune toe on a batch of profiles at once with the stretched
+    sheet method. Profiles of different lengths can be padded with NaN
+    since only the points between MHW and the crest are read
+
+    Returns arrays of shape (profiles, k) with the indices of the top k
+    toe candidates and their distances below the sheet. The first column
+    is the toe. Profiles without k points between MHW and the crest
+    have their extra columns filled with the index of the first
+    candidate (or MHW) and a NaN distance
+
+    Y: 2D array with one profile of elevations per row
+    mhw_idx: Array of ints with the MHW index of each profile
+    crest_idx: Array of ints with the crest index of each profile
+    k: Int with the number of candidates to return (Default: 1)
+    X: Array with the cross-shore distance values, either one row shared
+       by every profile or one row per profile (Default: None = evenly spaced)
+    """
 
-    # Get the bearing and convert to degrees
-    bearing = (np.arctan2(X, y) * (180 / np.pi)) % 360
-    morpho['Orientation'].append(bearing)
+    Y = np.asarray(Y, dtype=np.float64)
+    rows = np.arange(Y.shape[0])
+    lo = np.minimum(mhw_idx, crest_idx).astype(int)
+    hi = np.maximum(mhw_idx, crest_idx).astype(int)
+    width = np.maximum(hi - lo - 1, 0)
+
+    # Make the stretched sheets over the widest window in the batch
+    # and subtract the profiles from them in place
+    steps = np.arange(1, max(width.max(), k) + 1)
+    cols = np.minimum(lo[:, None] + steps, Y.shape[1] - 1)
+    if X is None:
+        diff = (Y[rows, hi] - Y[rows, lo]) / np.maximum(hi - lo, 1)
+        diff = diff[:, None] * steps
+    else:
+        X = np.broadcast_to(np.asarray(X, dtype=np.float64), Y.shape)
+        run = X[rows, hi] - X[rows, lo]
+        diff = np.divide(Y[rows, hi] - Y[rows, lo], run,
+                         out=np.zeros(len(rows)), where=run != 0)
+        diff = diff[:, None] * (X[rows[:, None], cols] - X[rows, lo][:, None])
+    diff += Y[rows, lo][:, None]
+    diff -= Y[rows[:, None], cols]
+    diff[steps > width[:, None]] = -np.inf
+
+    # Rank the candidates in each window
+    top = np.argsort(-diff, axis=1, kind='stable')[:, :k]
+    distance = np.take_along_axis(diff, top, axis=1)
+    index = lo[:, None] + 1 + top
+    missing = ~np.isfinite(distance)
+    index[missing] = np.broadcast_to(np.where(width > 0, index[:, 0], lo)[:, None],
+                                     index.shape)[missing]
+    distance[missing] = np.nan
+
+    return index, distance
+
+
+def transect_ends(morpho, lats, lons):
+    """
+    Store the coordinates of the landward (start) and
+    seaward (end) ends of the transect
 
-    return morpho
\ No newline at end of file
+    morpho: Dict with morphmetric values
+    lats: Array with latitude values
+    lons: Array with longitude values
+    """
+
+    morpho['Start Lat'].append(lats[-1])
+    morpho['Start Lon'].append(lons[-1])
+    morpho['End Lat'].append(lats[0])
+    morpho['End Lon'].append(lons[0])
+
+    return morpho
@@ -0,0 +1,160 @@
+"""
+Functions to overlap reading, computing, and writing surveys
+
+Running the surveys one after the other leaves the CPU waiting while a
+survey is read and parsed and the disk waiting while the profiles are
+computed, which adds up on network storage. A reader thread prepares
+the next surveys into a bounded queue while the current survey is
+computed and a writer thread saves the results in the order they were
+handed to it, so the disk and the CPU are kept busy at the same time
+"""
+
+import threading
+import queue
+
+
+# Marks the end of the items in a queue
+DONE = object()
+
+
+"""
+Functions to read ahead
+"""
+
+
+def prefetch(items, func=None, depth=1):
+    """
+    Yield func(item) for every item in order. func, and the iterating
+    over items, run on a background thread that stays up to depth
+    results ahead of the one being used. An error raised there is
+    raised here when its result would have been used
+
+    items: Iterable with the items
+    func: Function to call on every item (Default: None, use the items as they are)
+    depth: Int with the most results to hold ready. 0 calls func on
+           the current thread when each result is needed (Default: 1)
+    """
+
+    if func is None:
+        def func(item):
+            return item
+
+    if depth <= 0:
+        for item in items:
+            yield func(item)
+        return
+
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(result):
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read():
+        try:
+            for item in items:
+                if not put((func(item), None)):
+                    return
+        except BaseException as error:
+            put((None, error))
+            return
+        put((DONE, None))
+
+    reader = threading.Thread(target=read, name='Automorph reader', daemon=True)
+    reader.start()
+    try:
+        while True:
+            result, error = results.get()
+            if error is not None:
+                raise error
+            if result is DONE:
+                return
+            yield result
+    finally:
+        stop.set()
+
+
+"""
+Functions to write in the background
+"""
+
+
+class Writer:
+    """
+    Run jobs one at a time on a background thread in the order they are
+    submitted. An error raised by a job stops the jobs after it and is
+    raised by the next call to submit() or close()
+    """
+
+    def __init__(self, background=True, depth=8):
+        """
+        background: Bool to run the jobs on a background thread. False
+                    runs each job when it is submitted (Default: True)
+        depth: Int with the most jobs waiting to run before submit()
+               waits for one to finish (Default: 8)
+        """
+
+        self.background = background
+        self.error = None
+        if background:
+            self.jobs = queue.Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self.run, name='Automorph writer',
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is DONE:
+                return
+            if self.error is not None:
+                continue
+            func, args, kwargs = job
+            try:
+                func(*args, **kwargs)
+            except BaseException as error:
+                self.error = error
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) after the jobs already submitted
+
+        func: Function to run
+        """
+
+        self.raise_error()
+        if self.background:
+            self.jobs.put((func, args, kwargs))
+        else:
+            func(*args, **kwargs)
+
+    def close(self):
+        """
+        Wait for every job to finish
+        """
+
+        if self.background and self.thread.is_alive():
+            self.jobs.put(DONE)
+            self.thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.background and self.thread.is_alive():
+            self.jobs.put(DONE)
+            self.thread.join()
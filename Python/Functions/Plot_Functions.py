@@ -4,11 +4,14 @@ Functions to make figures while Automorph runs
 Michael Itzkin, 6/28/2021
 """
 
+from Functions.Lazy_Import import lazy_import
 
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 
+# Matplotlib is only imported when a figure is made
+plt = lazy_import('matplotlib.pyplot')
+
 
 # General plot parameters
 font = {'fontname': 'Arial', 'fontsize': 14, 'fontweight': 'normal'}
@@ -0,0 +1,361 @@
+"""
+Functions to cut profiles out of LiDAR point clouds for Automorph
+
+Point clouds can be LAS/LAZ files (read with laspy) or plain ASCII
+files with X, Y, and Z in the first three columns. The cloud is
+streamed in chunks and every chunk is matched against the transect
+corridors with a grid hash, so only points near a transect are
+ever kept. Kept points are spilled to a scratch file per transect
+when the buffer fills up, which keeps the memory use bounded no
+matter how many points are in the cloud
+"""
+
+from Functions import Catalog_Functions as catfuncs
+from Functions import Data_Functions as dfuncs
+from Functions.Lazy_Import import lazy_import
+
+import numpy as np
+import tempfile
+import shutil
+import os
+
+# Pandas is only imported when it is first used
+pd = lazy_import('pandas')
+
+
+# Set general information
+DATA_DIR = os.path.join('..', 'Data')
+CLOUD_EXTENSIONS = ('.las', '.laz')                   # Read with laspy
+ASCII_EXTENSIONS = ('.pts', '.xyz', '.txt', '.csv')   # X, Y, and Z columns
+
+
+"""
+Functions to read point clouds
+"""
+
+
+def read_chunks(fname, chunk_size=1_000_000, classes=None):
+    """
+    Generator that streams a point cloud in chunks of
+    X, Y, and Z arrays
+
+    fname: String with the path to the point cloud
+    chunk_size: Int with the number of points per chunk
+    classes: List of LAS classification codes to keep (Default: None
+             keeps every point). Only used for LAS/LAZ files
+    """
+
+    extension = os.path.splitext(fname)[1].lower()
+
+    if extension in CLOUD_EXTENSIONS:
+
+        # Laspy is only needed for LAS files so only
+        # import it when one is actually used
+        try:
+            import laspy
+        except ImportError:
+            raise ImportError('laspy is needed to read LAS/LAZ point clouds')
+
+        with laspy.open(fname) as las:
+            for points in las.chunk_iterator(chunk_size):
+                ex = np.asarray(points.x, dtype=np.float64)
+                why = np.asarray(points.y, dtype=np.float64)
+                zed = np.asarray(points.z, dtype=np.float64)
+                if classes is not None:
+                    keep = np.isin(np.asarray(points.classification), classes)
+                    ex, why, zed = ex[keep], why[keep], zed[keep]
+                yield ex, why, zed
+
+    elif extension in ASCII_EXTENSIONS:
+
+        # Check for a header line. Comments and blank lines are
+        # skipped the same way the parser skips them
+        first = []
+        with open(fname) as cloud_file:
+            for line in cloud_file:
+                first = line.split('#', 1)[0].replace(',', ' ').split()
+                if len(first) > 0:
+                    break
+        try:
+            [float(value) for value in first[:3]]
+            header = None
+        except ValueError:
+            header = 0
+
+        sep = ',' if extension == '.csv' else r'\s+'
+        reader = pd.read_csv(fname, sep=sep, header=header, usecols=[0, 1, 2],
+                             comment='#', chunksize=chunk_size)
+        for df in reader:
+            values = df.to_numpy(dtype=np.float64)
+            yield values[:, 0], values[:, 1], values[:, 2]
+
+    else:
+        raise ValueError(f'{fname} is not a supported point cloud format')
+
+
+"""
+Functions to index the transects and match points to them
+"""
+
+
+def transect_index(transects, half_width, cell_size=10.0):
+    """
+    Build a grid hash of the transect corridors. Every grid cell
+    that a corridor touches is paired with the transect, and the
+    pairs are sorted by cell so a chunk of points can be matched
+    with a single searchsorted call
+
+    transects: DataFrame of transects from Data_Functions.load_transects()
+    half_width: Float with the distance either side of a transect to keep
+    cell_size: Float with the size of the grid hash cells
+    """
+
+    x0 = transects[['X Start', 'X End']].to_numpy()
+    y0 = transects[['Y Start', 'Y End']].to_numpy()
+    x_origin = x0.min() - half_width - cell_size
+    y_origin = y0.min() - half_width - cell_size
+    nx = int(np.ceil((x0.max() + half_width + cell_size - x_origin) / cell_size)) + 1
+    ny = int(np.ceil((y0.max() + half_width + cell_size - y_origin) / cell_size)) + 1
+
+    # Unit vectors and lengths of the transects
+    dx, dy = x0[:, 1] - x0[:, 0], y0[:, 1] - y0[:, 0]
+    length = np.hypot(dx, dy)
+    ux, uy = dx / length, dy / length
+
+    # Find the cells within reach of every corridor
+    reach = half_width + cell_size * np.sqrt(2) / 2
+    keys, tids = [], []
+    for tid in range(len(transects)):
+        ix = np.arange(int((min(x0[tid]) - half_width - x_origin) // cell_size),
+                       int((max(x0[tid]) + half_width - x_origin) // cell_size) + 1)
+        iy = np.arange(int((min(y0[tid]) - half_width - y_origin) // cell_size),
+                       int((max(y0[tid]) + half_width - y_origin) // cell_size) + 1)
+        gx, gy = np.meshgrid(ix, iy, indexing='ij')
+        cx = x_origin + (gx.ravel() + 0.5) * cell_size - x0[tid, 0]
+        cy = y_origin + (gy.ravel() + 0.5) * cell_size - y0[tid, 0]
+        along = np.clip(cx * ux[tid] + cy * uy[tid], 0, length[tid])
+        near = np.hypot(cx - along * ux[tid], cy - along * uy[tid]) <= reach
+        keys.append(gx.ravel()[near] * ny + gy.ravel()[near])
+        tids.append(np.full(near.sum(), tid))
+
+    keys, tids = np.concatenate(keys), np.concatenate(tids)
+    order = np.argsort(keys, kind='stable')
+
+    return {'keys': keys[order],
+            'tids': tids[order],
+            'x_origin': x_origin,
+            'y_origin': y_origin,
+            'nx': nx,
+            'ny': ny,
+            'cell_size': cell_size,
+            'half_width': half_width,
+            'x_start': x0[:, 0],
+            'y_start': y0[:, 0],
+            'ux': ux,
+            'uy': uy,
+            'length': length}
+
+
+def match_points(index, ex, why, zed):
+    """
+    Match a chunk of points to the transect corridors they fall in
+    and project them onto the transect lines. A point near two
+    transects is kept for both
+
+    index: Dict with the grid hash from transect_index()
+    ex, why, zed: Arrays with the point coordinates
+    """
+
+    # Find the grid cell for every point and drop
+    # the points outside of the indexed area
+    ix = np.floor((ex - index['x_origin']) / index['cell_size']).astype(np.int64)
+    iy = np.floor((why - index['y_origin']) / index['cell_size']).astype(np.int64)
+    inside = (ix >= 0) & (ix < index['nx']) & (iy >= 0) & (iy < index['ny'])
+    pts = np.flatnonzero(inside)
+    point_keys = ix[pts] * index['ny'] + iy[pts]
+
+    # Look up the transects registered to each cell and
+    # expand into (point, transect) candidate pairs
+    lo = np.searchsorted(index['keys'], point_keys, side='left')
+    hi = np.searchsorted(index['keys'], point_keys, side='right')
+    counts = hi - lo
+    pts = np.repeat(pts, counts)
+    starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    tids = index['tids'][np.arange(len(pts)) + starts]
+
+    # Project the candidates onto their transect and keep
+    # those inside of the corridor
+    px = ex[pts] - index['x_start'][tids]
+    py = why[pts] - index['y_start'][tids]
+    along = px * index['ux'][tids] + py * index['uy'][tids]
+    across = np.abs(px * index['uy'][tids] - py * index['ux'][tids])
+    keep = (across <= index['half_width']) & (along >= 0) & (along <= index['length'][tids])
+
+    pts, tids = pts[keep], tids[keep]
+    return tids, along[keep], zed[pts], ex[pts], why[pts]
+
+
+def transect_points(fname, transects, half_width=1.0, cell_size=10.0,
+                    chunk_size=1_000_000, buffer_size=10_000_000, classes=None):
+    """
+    Generator that streams a point cloud through the transect
+    corridors and yields the transect number (in file order starting
+    at 1) and the distance, Z, X, and Y arrays of the points in the
+    corridor ordered by distance along the transect
+
+    fname: String with the path to the point cloud
+    transects: DataFrame of transects from Data_Functions.load_transects()
+    half_width: Float with the distance either side of a transect to keep
+    cell_size: Float with the size of the grid hash cells
+    chunk_size: Int with the number of points to read at a time
+    buffer_size: Int with the number of corridor points to hold in
+                 memory before spilling them to scratch files
+    classes: List of LAS classification codes to keep (Default: None)
+    """
+
+    index = transect_index(transects, half_width, cell_size)
+    num_transects = len(transects)
+    scratch = tempfile.mkdtemp(prefix='automorph_')
+
+    try:
+
+        # Stream the cloud and spill the corridor points
+        # to a scratch file per transect as the buffer fills
+        buffered, held = [], 0
+        for ex, why, zed in read_chunks(fname, chunk_size, classes):
+            tids, along, z, x, y = match_points(index, ex, why, zed)
+            buffered.append(np.column_stack((tids, along, z, x, y)))
+            held += len(tids)
+            if held >= buffer_size:
+                spill(scratch, buffered)
+                buffered, held = [], 0
+        spill(scratch, buffered)
+
+        # Sort and yield the points for each transect
+        for tid in range(num_transects):
+            spill_file = os.path.join(scratch, f'{tid}.bin')
+            if os.path.exists(spill_file):
+                values = np.fromfile(spill_file, dtype=np.float64).reshape(-1, 4)
+            else:
+                values = np.empty((0, 4))
+            values = values[np.argsort(values[:, 0], kind='stable')]
+            yield tid + 1, (values[:, 0], values[:, 1], values[:, 2], values[:, 3])
+
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def spill(scratch, buffered):
+    """
+    Append buffered corridor points to a scratch file per transect
+
+    scratch: String with the path to the scratch directory
+    buffered: List of arrays with transect, distance, Z, X, and Y columns
+    """
+
+    if len(buffered) == 0:
+        return
+    values = np.concatenate(buffered)
+    values = values[np.argsort(values[:, 0], kind='stable')]
+    tids, starts = np.unique(values[:, 0].astype(int), return_index=True)
+    for tid, lo, hi in zip(tids, starts, np.append(starts[1:], len(values))):
+        with open(os.path.join(scratch, f'{tid}.bin'), 'ab') as spill_file:
+            np.ascontiguousarray(values[lo:hi, 1:]).tofile(spill_file)
+
+
+"""
+Functions to turn the transect points into profiles
+"""
+
+
+def cloud_profile(transect, dist, zed, epsg):
+    """
+    Put the points for a transect into a DataFrame in the same format
+    as the individual profile files. The points are placed on the
+    transect line at their distance along it, like the samples of a
+    DEM profile, so the spread of the corridor across the transect
+    doesn't end up in the cross-shore distance
+
+    transect: Row of the transects DataFrame
+    dist: Array with the distance of the points along the transect
+    zed: Array with the point elevations
+    epsg: Int with the number code for the in projection
+    """
+
+    x_start, y_start = transect['X Start'], transect['Y Start']
+    length = np.hypot(transect['X End'] - x_start, transect['Y End'] - y_start)
+    ux = (transect['X End'] - x_start) / length
+    uy = (transect['Y End'] - y_start) / length
+
+    df = pd.DataFrame({'X': x_start + dist * ux, 'Y': y_start + dist * uy, 'Z': zed})
+    df = dfuncs.add_lat_lon(df, epsg)
+
+    return df
+
+
+def cloud_profiles(cloud_file, transect_file, epsg, grid=0.5, **kwargs):
+    """
+    Generator that cuts every transect out of a point cloud and yields the
+    profile number and the same arrays as Data_Functions.setup_profile().
+    Transects without enough points in their corridor are skipped
+
+    cloud_file: String with the path to the point cloud
+    transect_file: String with the path to the transect file
+    epsg: Int with the number code for the in projection
+    grid: Interpolate onto the grid of spacing
+    kwargs: Passed on to transect_points()
+    """
+
+    transects = dfuncs.load_transects(transect_file)
+    skipped = []
+    for profile, (dist, zed, _, _) in transect_points(cloud_file, transects, **kwargs):
+        if len(dist) < dfuncs.MIN_POINTS:
+            skipped.append(profile)
+            continue
+        df = cloud_profile(transects.iloc[profile - 1], dist, zed, epsg)
+        yield profile, dfuncs.format_profile(df, grid)
+    dfuncs.report_skipped(skipped, f'point cloud {os.path.basename(cloud_file)}')
+
+
+def make_cloud_profile_files(file, location, year, epsg, **kwargs):
+    """
+    Make individual profile files by cutting transects out of
+    a point cloud and place them into the correct folder for
+    the location and year. Transects without enough points in
+    their corridor are skipped and reported
+
+    file: String with the point cloud file name
+    location: String with the profile location name
+    year: String with the year of the data
+    epsg: Int with the number code for the in projection
+    kwargs: Passed on to transect_points()
+    """
+
+    transect_file = os.path.join(DATA_DIR, dfuncs.transect_file_name(file))
+    transects = dfuncs.load_transects(transect_file)
+
+    # Loop through the transects. Transects without enough points in
+    # their corridor get no profile file and are left out of the survey
+    records, skipped = [], []
+    for profile, (dist, zed, _, _) in transect_points(os.path.join(DATA_DIR, file),
+                                                      transects, **kwargs):
+        profile_file = os.path.join('..',
+                                    f'{location}',
+                                    f'{year}',
+                                    'Profiles',
+                                    f'{location} {year} {profile}.txt')
+        if len(dist) < dfuncs.MIN_POINTS:
+            skipped.append(profile)
+            if os.path.exists(profile_file):
+                os.remove(profile_file)
+            continue
+        df = cloud_profile(transects.iloc[profile - 1], dist, zed, epsg)
+        df.to_csv(profile_file, sep='\t', index=False)
+        records.append(catfuncs.profile_record(location, year, profile,
+                                               df, profile_file, file))
+
+    # Add the profiles to the transect catalog
+    catfuncs.add_transects(records)
+    dfuncs.report_skipped(skipped, f'point cloud for {location} {year}')
+
+    print(f'Finished cutting profiles from the point cloud for {location} {year}...')
@@ -0,0 +1,170 @@
+"""
+Functions to check the morphometrics for a batch of profiles
+
+The checks run on the landmark columns of the whole batch at once and
+give every profile a "QC Flag" made of the bits below added together
+(0 means every check passed). The flags decide which profiles are run
+again with fallback settings and which profiles are plotted
+"""
+
+import numpy as np
+
+
+# QC flag bits
+PASSED = 0
+MHW_FAILED = 1          # No MHW found, or no error estimate for it
+TOE_LANDWARD = 2        # Toe on or landward of the crest
+HEEL_AT_CREST = 4       # Heel on the crest
+BAD_SLOPE = 8           # Foreshore, beach, or dune face slope out of range
+NEGATIVE_WIDTH = 16     # Dune or beach width below zero
+REPROCESSED = 32        # Found with the fallback settings
+FLAG_NAMES = {MHW_FAILED: 'MHW failed',
+              TOE_LANDWARD: 'Toe landward of crest',
+              HEEL_AT_CREST: 'Heel at crest',
+              BAD_SLOPE: 'Implausible slope',
+              NEGATIVE_WIDTH: 'Negative width',
+              REPROCESSED: 'Reprocessed'}
+FAILURES = MHW_FAILED | TOE_LANDWARD | HEEL_AT_CREST | BAD_SLOPE | NEGATIVE_WIDTH
+
+# Columns of the morpho dict the checks use
+COLUMNS = ['XMHW', 'YMHW', 'MHW Error', 'Foreshore Slope',
+           'XCrest', 'YCrest', 'XHeel', 'XToe', 'YToe']
+
+# Plausible (low, high) range of each slope
+SLOPE_LIMITS = {'Foreshore Slope': (0.0, 0.5),
+                'Beach Slope': (0.0, 0.5),
+                'Dune Face Slope': (0.0, 2.0)}
+
+
+"""
+Functions to flag profiles
+"""
+
+
+def column(morpho, key, rows):
+    """
+    Return a column of the morpho dict for some rows as a float array
+
+    morpho: Dict with morphometrics
+    key: String with the column name
+    rows: Slice or array of ints with the rows to use
+    """
+
+    return np.asarray(morpho[key], dtype=np.float64)[rows]
+
+
+def qc_flags(morpho, rows=slice(None), limits=None):
+    """
+    Return an array with the QC flag of each profile
+
+    morpho: Dict (or DataFrame) with morphometrics
+    rows: Slice or array of ints with the rows to check (Default: all)
+    limits: Dict with the (low, high) range of each slope (Default: SLOPE_LIMITS)
+    """
+
+    if limits is None:
+        limits = SLOPE_LIMITS
+    x_mhw, y_mhw = column(morpho, 'XMHW', rows), column(morpho, 'YMHW', rows)
+    x_crest, y_crest = column(morpho, 'XCrest', rows), column(morpho, 'YCrest', rows)
+    x_toe, y_toe = column(morpho, 'XToe', rows), column(morpho, 'YToe', rows)
+    x_heel = column(morpho, 'XHeel', rows)
+    flags = np.zeros(len(x_mhw), dtype=np.int64)
+
+    # MHW. A missing MHW is stored as 9999
+    has_mhw = np.isfinite(x_mhw) & (x_mhw < 9999) &\
+        np.isfinite(column(morpho, 'MHW Error', rows))
+    flags[~has_mhw] |= MHW_FAILED
+
+    # Landmarks out of order. The cross-shore distance decreases landward
+    flags[~(x_toe > x_crest)] |= TOE_LANDWARD
+    flags[x_heel == x_crest] |= HEEL_AT_CREST
+    beach_width = np.where(has_mhw, x_mhw - x_toe, np.nan)
+    flags[(x_toe - x_heel < 0) | (beach_width < 0)] |= NEGATIVE_WIDTH
+
+    # Slopes. The ones that need MHW are only checked when it was found
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = {'Foreshore Slope': (column(morpho, 'Foreshore Slope', rows), has_mhw),
+                  'Beach Slope': ((y_toe - y_mhw) / beach_width, has_mhw),
+                  'Dune Face Slope': ((y_crest - y_toe) / (x_toe - x_crest),
+                                      np.ones(len(flags), dtype=bool))}
+    for name, (slope, check) in slopes.items():
+        low, high = limits[name]
+        bad = ~((slope >= low) & (slope <= high))
+        flags[check & bad] |= BAD_SLOPE
+
+    return flags
+
+
+def last_flag(morpho, limits=None):
+    """
+    Return the QC flag of the last profile in the morpho dict. Only the
+    columns in COLUMNS have to be filled in for the profile, so it can
+    be checked before the rest of its morphometrics are found
+
+    morpho: Dict with morphometrics
+    limits: Dict with the (low, high) range of each slope (Default: SLOPE_LIMITS)
+    """
+
+    return int(qc_flags({key: morpho[key][-1:] for key in COLUMNS}, limits=limits)[0])
+
+
+def needs_reprocessing(flags):
+    """
+    Return a boolean array marking the profiles that failed a check
+    and have not already been run with the fallback settings
+
+    flags: Array with QC flags
+    """
+
+    flags = np.asarray(flags)
+
+    return ((flags & FAILURES) != 0) & ((flags & REPROCESSED) == 0)
+
+
+def needs_rendering(flags, mode='flagged'):
+    """
+    Return a boolean array marking the profiles to plot
+
+    flags: Array with QC flags
+    mode: String with "all", "flagged" (profiles that failed a check or
+          were reprocessed), or "none" (Default: "flagged")
+    """
+
+    flags = np.asarray(flags)
+    if mode == 'all':
+        return np.ones(len(flags), dtype=bool)
+    if mode == 'none':
+        return np.zeros(len(flags), dtype=bool)
+    if mode == 'flagged':
+        return flags != PASSED
+
+    raise ValueError(f'Render mode must be "all", "flagged", or "none", not {mode!r}')
+
+
+"""
+Functions to report the flags
+"""
+
+
+def describe(flag):
+    """
+    Return a string with the names of the checks in a QC flag
+
+    flag: Int with a QC flag
+    """
+
+    names = [name for bit, name in FLAG_NAMES.items() if flag & bit]
+
+    return ', '.join(names) if len(names) > 0 else 'Passed'
+
+
+def summary(flags):
+    """
+    Return a dict with the number of profiles with each flag bit
+
+    flags: Array with QC flags
+    """
+
+    flags = np.asarray(flags)
+
+    return {name: int(((flags & bit) != 0).sum()) for bit, name in FLAG_NAMES.items()}
@@ -0,0 +1,329 @@
+"""
+Functions to cut profiles out of gridded DEMs for Automorph
+
+DEMs can be a GeoTIFF (read with rasterio), a raw ESRI .flt
+grid, or a .npy array. The .flt and .npy grids need an ESRI
+style .hdr file with the same name next to them. Only the
+windows of the DEM that the transects pass through are ever
+read, so large DEMs do not need to fit in memory
+"""
+
+from Functions import Catalog_Functions as catfuncs
+from Functions import Data_Functions as dfuncs
+from Functions.Lazy_Import import lazy_import
+
+import numpy as np
+import os
+
+# Pandas is only imported when it is first used
+pd = lazy_import('pandas')
+
+
+# Set general information
+DATA_DIR = os.path.join('..', 'Data')
+DEM_EXTENSIONS = ('.tif', '.tiff', '.flt', '.npy')
+
+
+"""
+Functions to open and read DEMs
+"""
+
+
+def read_header(fname):
+    """
+    Read an ESRI style .hdr file into a dict with the
+    keys in lower case
+
+    fname: String with the path to the .hdr file
+    """
+
+    header = {}
+    with open(fname) as hdr_file:
+        for line in hdr_file:
+            parts = line.split()
+            if len(parts) == 2:
+                header[parts[0].lower()] = parts[1]
+
+    return header
+
+
+def open_dem(fname):
+    """
+    Open a DEM without reading the elevations and return a dict
+    with the grid geometry and a handle to read windows from
+
+    The geometry is stored as the upper-left corner of the grid
+    ("x0", "y0") and the signed cell sizes ("dx", "dy") so that
+    cell centers are at x0 + (col + 0.5) * dx, y0 + (row + 0.5) * dy
+
+    fname: String with the path to the DEM
+    """
+
+    extension = os.path.splitext(fname)[1].lower()
+
+    if extension in ('.tif', '.tiff'):
+
+        # Rasterio is only needed for GeoTIFFs so only
+        # import it when one is actually used
+        try:
+            import rasterio
+        except ImportError:
+            raise ImportError('rasterio is needed to read GeoTIFF DEMs')
+
+        src = rasterio.open(fname)
+        transform = src.transform
+        if transform.b != 0 or transform.d != 0:
+            raise ValueError(f'{fname} is rotated, only north-up DEMs are supported')
+
+        return {'format': 'tif',
+                'handle': src,
+                'nrows': src.height,
+                'ncols': src.width,
+                'x0': transform.c,
+                'y0': transform.f,
+                'dx': transform.a,
+                'dy': transform.e,
+                'nodata': src.nodata}
+
+    elif extension in ('.flt', '.npy'):
+
+        # Load the grid geometry from the header
+        header = read_header(os.path.splitext(fname)[0] + '.hdr')
+        nrows, ncols = int(header['nrows']), int(header['ncols'])
+        cellsize = float(header['cellsize'])
+        if 'xllcenter' in header:
+            xll = float(header['xllcenter']) - cellsize / 2
+            yll = float(header['yllcenter']) - cellsize / 2
+        else:
+            xll = float(header['xllcorner'])
+            yll = float(header['yllcorner'])
+        nodata = header.get('nodata_value', None)
+
+        # Memory map the elevations so that only
+        # the windows being read are loaded
+        if extension == '.npy':
+            handle = np.load(fname, mmap_mode='r')
+        else:
+            byteorder = '>' if header.get('byteorder', 'LSBFIRST').upper() == 'MSBFIRST' else '<'
+            handle = np.memmap(fname, dtype=f'{byteorder}f4', mode='r',
+                               shape=(nrows, ncols))
+
+        return {'format': 'grid',
+                'handle': handle,
+                'nrows': nrows,
+                'ncols': ncols,
+                'x0': xll,
+                'y0': yll + nrows * cellsize,
+                'dx': cellsize,
+                'dy': -cellsize,
+                'nodata': None if nodata is None else float(nodata)}
+
+    else:
+        raise ValueError(f'{fname} is not a supported DEM format')
+
+
+def close_dem(dem):
+    """
+    Close the file handle for a DEM
+
+    dem: Dict with the DEM from open_dem()
+    """
+
+    if dem['format'] == 'tif':
+        dem['handle'].close()
+
+
+def read_window(dem, row_lo, row_hi, col_lo, col_hi):
+    """
+    Read a window of the DEM as a float64 array with the
+    no data cells set to NaN
+
+    dem: Dict with the DEM from open_dem()
+    row_lo, row_hi: Ints with the first and last (exclusive) rows
+    col_lo, col_hi: Ints with the first and last (exclusive) columns
+    """
+
+    if dem['format'] == 'tif':
+        from rasterio.windows import Window
+        window = Window(col_lo, row_lo, col_hi - col_lo, row_hi - row_lo)
+        z = dem['handle'].read(1, window=window).astype(np.float64)
+    else:
+        z = np.array(dem['handle'][row_lo:row_hi, col_lo:col_hi], dtype=np.float64)
+
+    if dem['nodata'] is not None:
+        z[z == dem['nodata']] = np.nan
+
+    return z
+
+
+"""
+Functions to sample the DEM along transects
+"""
+
+
+def sample_transect(dem, x_start, y_start, x_end, y_end, spacing):
+    """
+    Sample the DEM along a transect with bilinear interpolation.
+    Only the window of the DEM covering the transect is read.
+    Points that fall outside of the DEM are returned as NaN
+
+    dem: Dict with the DEM from open_dem()
+    x_start, y_start: Floats with the start of the transect
+    x_end, y_end: Floats with the end of the transect
+    spacing: Float with the distance between samples
+    """
+
+    # Place points along the transect
+    length = np.hypot(x_end - x_start, y_end - y_start)
+    if length == 0:
+        raise ValueError(f'The transect starting at ({x_start}, {y_start}) has no length')
+    dist = np.arange(0, length + spacing / 2, spacing)
+    ex = x_start + (x_end - x_start) * dist / length
+    why = y_start + (y_end - y_start) * dist / length
+
+    # Convert the points to fractional row and column
+    # positions relative to the cell centers
+    cols = (ex - dem['x0']) / dem['dx'] - 0.5
+    rows = (why - dem['y0']) / dem['dy'] - 0.5
+
+    # Find the window of cells the transect needs
+    row_lo = max(int(np.floor(rows.min())), 0)
+    row_hi = min(int(np.floor(rows.max())) + 2, dem['nrows'])
+    col_lo = max(int(np.floor(cols.min())), 0)
+    col_hi = min(int(np.floor(cols.max())) + 2, dem['ncols'])
+    zed = np.full(dist.shape, np.nan)
+    if row_lo >= row_hi or col_lo >= col_hi:
+        return dist, ex, why, zed
+    window = read_window(dem, row_lo, row_hi, col_lo, col_hi)
+
+    # Find the four surrounding cells for every point. Points on the
+    # outer half-cell of the grid are clamped to the edge cells
+    inside = ((rows >= -0.5) & (rows <= dem['nrows'] - 0.5) &
+              (cols >= -0.5) & (cols <= dem['ncols'] - 0.5))
+    rows = np.clip(rows, row_lo, row_hi - 1) - row_lo
+    cols = np.clip(cols, col_lo, col_hi - 1) - col_lo
+    r0, c0 = np.floor(rows).astype(int), np.floor(cols).astype(int)
+    r1 = np.minimum(r0 + 1, window.shape[0] - 1)
+    c1 = np.minimum(c0 + 1, window.shape[1] - 1)
+    fr, fc = rows - r0, cols - c0
+
+    # Bilinear interpolation
+    top = window[r0, c0] * (1 - fc) + window[r0, c1] * fc
+    bottom = window[r1, c0] * (1 - fc) + window[r1, c1] * fc
+    zed[inside] = (top * (1 - fr) + bottom * fr)[inside]
+
+    return dist, ex, why, zed
+
+
+def dem_profile(dem, transect, epsg, spacing=None):
+    """
+    Cut a single profile out of a DEM and return it as a DataFrame
+    in the same format as the individual profile files
+
+    dem: Dict with the DEM from open_dem()
+    transect: Row of the transects DataFrame
+    epsg: Int with the number code for the in projection
+    spacing: Float with the sample spacing (Default: DEM cell size)
+    """
+
+    if spacing is None:
+        spacing = min(abs(dem['dx']), abs(dem['dy']))
+
+    _, ex, why, zed = sample_transect(dem,
+                                      transect['X Start'], transect['Y Start'],
+                                      transect['X End'], transect['Y End'],
+                                      spacing)
+    df = pd.DataFrame({'X': ex, 'Y': why, 'Z': zed})
+    df = dfuncs.add_lat_lon(df, epsg)
+
+    return df
+
+
+def dem_profiles(dem_file, transect_file, epsg, grid=0.5, spacing=None):
+    """
+    Generator that cuts every transect out of a DEM and yields the
+    profile number and the same arrays as Data_Functions.setup_profile().
+    Transects with no elevations on the DEM are skipped
+
+    dem_file: String with the path to the DEM
+    transect_file: String with the path to the transect file
+    epsg: Int with the number code for the in projection
+    grid: Interpolate onto the grid of spacing
+    spacing: Float with the sample spacing (Default: DEM cell size)
+    """
+
+    dem = open_dem(dem_file)
+    transects = dfuncs.load_transects(transect_file)
+    skipped = []
+    try:
+        for profile, (_, transect) in enumerate(transects.iterrows(), start=1):
+            df = dem_profile(dem, transect, epsg, spacing)
+            if df['Z'].notnull().sum() < dfuncs.MIN_POINTS:
+                skipped.append(profile)
+                continue
+            yield profile, dfuncs.format_profile(df, grid)
+    finally:
+        close_dem(dem)
+    dfuncs.report_skipped(skipped, f'DEM {os.path.basename(dem_file)}')
+
+
+def dem_sidecar_files(file):
+    """
+    Return the paths to the transect and header files
+    in the data directory that go with a DEM
+
+    file: String with the filename of the DEM
+    """
+
+    sidecars = [os.path.join(DATA_DIR, dfuncs.transect_file_name(file))]
+    header = os.path.join(DATA_DIR, f'{os.path.splitext(file)[0]}.hdr')
+    if os.path.exists(header):
+        sidecars.append(header)
+
+    return sidecars
+
+
+def make_dem_profile_files(file, location, year, epsg, spacing=None):
+    """
+    Make individual profile files by sampling a DEM along
+    transects and place them into the correct folder for
+    the location and year. Transects with no elevations on
+    the DEM are skipped and reported
+
+    file: String with the DEM file name
+    location: String with the profile location name
+    year: String with the year of the data
+    epsg: Int with the number code for the in projection
+    spacing: Float with the sample spacing (Default: DEM cell size)
+    """
+
+    dem = open_dem(os.path.join(DATA_DIR, file))
+    transects = dfuncs.load_transects(os.path.join(DATA_DIR, dfuncs.transect_file_name(file)))
+
+    # Loop through the transects. Transects that miss the DEM get
+    # no profile file and are left out of the survey
+    records, skipped = [], []
+    try:
+        for profile, (_, transect) in enumerate(transects.iterrows(), start=1):
+            profile_file = os.path.join('..',
+                                        f'{location}',
+                                        f'{year}',
+                                        'Profiles',
+                                        f'{location} {year} {profile}.txt')
+            df = dem_profile(dem, transect, epsg, spacing)
+            if df['Z'].notnull().sum() < dfuncs.MIN_POINTS:
+                skipped.append(profile)
+                if os.path.exists(profile_file):
+                    os.remove(profile_file)
+                continue
+            df.to_csv(profile_file, sep='\t', index=False)
+            records.append(catfuncs.profile_record(location, year, profile,
+                                                   df, profile_file, file))
+    finally:
+        close_dem(dem)
+
+    # Add the profiles to the transect catalog
+    catfuncs.add_transects(records)
+    dfuncs.report_skipped(skipped, f'DEM for {location} {year}')
+
+    print(f'Finished cutting profiles from the DEM for {location} {year}...')
@@ -0,0 +1,499 @@
+"""
+Functions to estimate the uncertainty of the morphometrics with a
+Monte Carlo ensemble
+
+The elevations of a profile are perturbed N times with an error model
+and the detectors and volume integrals are run on the whole (N x points)
+ensemble at once with array operations instead of once per member. Each
+vectorized detector follows its counterpart in Morpho_Functions. Peaks
+on a flat spot are taken at its seaward end instead of its middle, which
+only matters for a noise-free ensemble
+"""
+
+from Functions import Morpho_Functions as mfuncs
+from Functions.Lazy_Import import lazy_import
+
+import numpy as np
+
+# Scipy is only imported when it is first used
+signal = lazy_import('scipy.signal')
+
+
+# Morphometrics reported by the ensemble
+POSITIONS = ['MHW', 'Crest', 'Heel', 'Toe', 'Berm',
+             'Fence Crest', 'Fence Heel', 'Fence Toe']
+METRICS = [f'{axis}{col}' for col in POSITIONS for axis in 'XY'] +\
+          ['Foreshore Slope', 'Dune Volume', 'Beach Volume', 'Profile Volume',
+           'Fenced Dune Volume', 'Total Dune Volume', 'Dune Height', 'Dune Width',
+           'Dune Aspect Ratio', 'Dune Face Slope', 'Beach Width', 'Beach Slope']
+CHUNK = 128     # Members per block in the crest scan
+BLOCK = 8       # First block size for the backshore drop test
+
+
+"""
+Functions to make the ensemble
+"""
+
+
+def error_model(sigma=0.15, correlation_length=0.0, bias=0.0):
+    """
+    Return a dict describing the vertical error of the elevations
+
+    sigma: Float with the standard deviation of the random error (Default: 0.15 m)
+    correlation_length: Float with the distance (m) over which the random
+                        error is correlated along the profile. 0 makes the
+                        error independent at every point (Default: 0)
+    bias: Float with the standard deviation of an error shared by the
+          whole profile, e.g. a survey offset (Default: 0)
+    """
+
+    return {'sigma': sigma,
+            'correlation_length': correlation_length,
+            'bias': bias}
+
+
+def perturb(X, y, size, model, rng):
+    """
+    Return an array of shape (size, points) with the profile
+    elevations plus random errors drawn from the error model
+
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    size: Int with the number of ensemble members
+    model: Dict from error_model()
+    rng: NumPy random Generator
+    """
+
+    noise = rng.standard_normal((size, len(y)))
+
+    # Correlate the errors along the profile with a first order
+    # autoregressive filter. The first point is left as drawn so
+    # every point has the same variance
+    if model['correlation_length'] > 0 and len(y) > 1:
+        step = np.abs(np.diff(X)).mean()
+        rho = np.exp(-step / model['correlation_length'])
+        scale = np.sqrt(1 - rho ** 2)
+        noise[:, 0] /= scale
+        noise = signal.lfilter([scale], [1, -rho], noise, axis=1)
+
+    noise *= model['sigma']
+    if model['bias'] > 0:
+        noise += rng.normal(0, model['bias'], (size, 1))
+    noise += y
+
+    return noise
+
+
+"""
+Functions to help run the detectors on the ensemble
+"""
+
+
+def first_true(mask, default=-1):
+    """
+    Return the index of the first True in each row of
+    a 2D boolean array, or the default if there is none
+
+    mask: 2D boolean array
+    default: Int to use for rows without a True (Default: -1)
+    """
+
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), default)
+
+
+def gather(values, idx):
+    """
+    Return values[row, idx[row]] for each row, NaN where idx is -1
+
+    values: 2D array (or 1D array shared by all rows)
+    idx: Array of ints with an index for each row
+    """
+
+    safe = np.maximum(idx, 0)
+    if values.ndim == 1:
+        picked = values[safe]
+    else:
+        picked = values[np.arange(len(idx)), safe]
+
+    return np.where(idx >= 0, picked, np.nan)
+
+
+def local_peaks(Y):
+    """
+    Return a boolean array marking the points that are higher than the
+    point seaward of them and at least as high as the point landward
+
+    Y: 2D array with one profile of elevations per row
+    """
+
+    peaks = np.zeros(Y.shape, dtype=bool)
+    peaks[:, 1:-1] = (Y[:, 1:-1] > Y[:, :-2]) & (Y[:, 1:-1] >= Y[:, 2:])
+
+    return peaks
+
+
+def backshore_drop(Y, rows, cols, threshold):
+    """
+    Vectorized Kernel_Functions._backshore_peak_loop() test for many
+    peaks at once. Returns True for the peaks where the profile drops by
+    the threshold landward of the peak before it rises above the peak.
+    Most peaks are decided a few points landward so the profile is read
+    in growing blocks and only the undecided peaks look further
+
+    Y: 2D array with one profile of elevations per row
+    rows: Array of ints with the row of each peak
+    cols: Array of ints with the index of each peak
+    threshold: Float with the minimum backshore drop
+    """
+
+    n = Y.shape[1]
+    passes = np.zeros(len(rows), dtype=bool)
+    pending = np.arange(len(rows))
+    lo, size = 1, BLOCK
+    while len(pending) > 0:
+        r, c = rows[pending], cols[pending]
+        idx = c[:, None] + np.arange(lo, lo + size)
+        inside = idx < n
+        landward = Y[r[:, None], np.minimum(idx, n - 1)]
+        peak_y = Y[r, c][:, None]
+        rise = first_true(inside & (landward > peak_y), size)
+        drop = first_true(inside & (peak_y - landward >= threshold), size + 1)
+
+        # Peaks are decided by a rise, a drop, or the end of the profile
+        passes[pending] = drop < rise
+        decided = (rise < size) | (drop < size) | ~inside[:, -1]
+        pending = pending[~decided]
+        lo, size = lo + size, size * 2
+
+    return passes
+
+
+def fill_volumes(X, Y, cumulative, lo, hi, base):
+    """
+    Vectorized mfuncs.fill_volume(). Rows where lo or hi is -1 are NaN
+
+    X: Array with the cross-shore distance values
+    Y: 2D array with one profile of elevations per row
+    cumulative: 2D array with the cumulative area under each profile
+    lo: Array of ints with the first index set to the base
+    hi: Array of ints with the index after the last index set to the base
+    base: Array with the base elevation of each row
+    """
+
+    n = Y.shape[1]
+    rows = np.arange(Y.shape[0])
+    a, b = np.clip(lo, 0, n - 1), np.clip(hi - 1, 0, n - 1)
+
+    area = cumulative[rows, b] - cumulative[rows, a] - base * (X[b] - X[a])
+    area += np.where(a > 0, (Y[rows, a] - base) / 2 * (X[a] - X[np.maximum(a - 1, 0)]), 0)
+    area += np.where(hi < n, (Y[rows, b] - base) / 2 * (X[np.minimum(b + 1, n - 1)] - X[b]), 0)
+    area = np.where(hi > lo, -area, 0.0)
+
+    return np.where((lo >= 0) & (hi >= 0), area, np.nan)
+
+
+"""
+Vectorized detectors
+"""
+
+
+def ensemble_mhw(X, Y, mhw, pad):
+    """
+    Vectorized mfuncs.find_mhw() for the observed MHW position and the
+    foreshore slope. Returns the MHW indices (-1 where MHW is not found)
+    and the foreshore slopes
+
+    X: Array with the cross-shore distance values
+    Y: 2D array with one profile of elevations per row
+    mhw: Float with the MHW elevation
+    pad: Float with the distance (+/-) around MHW to regress on
+    """
+
+    within = (Y >= mhw - pad) & (Y <= mhw + pad) & (X > X.max() / 2)
+    found = within.any(axis=1)
+    mhw_idx = np.where(found, np.where(within, np.abs(Y - mhw), np.inf).argmin(axis=1), -1)
+
+    # Least squares slope of the points within the pad of MHW
+    count = within.sum(axis=1)
+    sx, sy = (within * X).sum(axis=1), np.where(within, Y, 0).sum(axis=1)
+    sxx, sxy = (within * X ** 2).sum(axis=1), np.where(within, X * Y, 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (sxy - sx * sy / count) / (sxx - sx ** 2 / count)
+
+    return mhw_idx, np.where(found, -slope, np.nan)
+
+
+def ensemble_crest(Y, mhw, threshold=0.6, crest_pct=0.2):
+    """
+    Vectorized mfuncs.find_crest(). Returns the crest index of each member
+
+    Y: 2D array with one profile of elevations per row
+    mhw: Float with the MHW elevation
+    threshold: Float with the minimum backshore drop (Default: 0.6 m)
+    crest_pct: Float to check if a more seaward peak might be more appropriate
+    """
+
+    size, n = Y.shape
+    crest_idx = Y.argmax(axis=1)
+
+    for start in range(0, size, CHUNK):
+        block = Y[start:start + CHUNK]
+        rows, cols = np.nonzero(local_peaks(block) & (block > mhw))
+        if len(rows) == 0:
+            continue
+        peak_y = block[rows, cols]
+
+        # A peak passes if the profile drops by the threshold landward
+        # of it before it rises above the peak elevation
+        passes = backshore_drop(block, rows, cols, threshold)
+
+        # Use the most landward peak when none pass
+        last = np.full(len(block), -1)
+        np.maximum.at(last, rows, cols)
+
+        # Otherwise use the most seaward peak within crest_pct
+        # of the height of the first peak that passes
+        first = np.full(len(block), n)
+        np.minimum.at(first, rows[passes], cols[passes])
+        first_y = block[np.arange(len(block)), np.minimum(first, n - 1)]
+        tall = peak_y > (first_y * (1 - crest_pct))[rows]
+        seaward = np.full(len(block), n)
+        np.minimum.at(seaward, rows[tall], cols[tall])
+        refined = np.where(first < n, np.minimum(seaward, first), last)
+
+        crest_idx[start:start + CHUNK] = np.where(last >= 0, refined,
+                                                  crest_idx[start:start + CHUNK])
+
+    return crest_idx
+
+
+def ensemble_heel(Y, crest_idx, threshold=0.6):
+    """
+    Vectorized mfuncs.find_heel(). Returns the heel index and
+    the re-adjusted crest index of each member
+
+    Y: 2D array with one profile of elevations per row
+    crest_idx: Array of ints with the crest index of each member
+    threshold: Float with the minimum crest-to-heel elevation distance (Default: 0.6 m)
+    """
+
+    n = Y.shape[1]
+    rows = np.arange(len(Y))
+    columns = np.arange(n)
+
+    # Walk landward from the crest until the profile stops dropping and
+    # either the drop from the crest is big enough or it starts to rise
+    here, ahead = Y[:, :-1], Y[:, 1:]
+    crest_y = Y[rows, crest_idx][:, None]
+    stops = ~(ahead < here) & ((crest_y - here >= threshold) | (ahead * 0.95 >= here))
+    stops &= columns[:-1] >= crest_idx[:, None]
+    heel_idx = np.maximum(first_true(stops, n - 1), crest_idx)
+
+    # Move the crest to the highest point between it and the heel
+    between = (columns >= crest_idx[:, None]) & (columns < heel_idx[:, None])
+    new_crest = np.where(between, Y, -np.inf).argmax(axis=1)
+    crest_idx = np.where(heel_idx > crest_idx, new_crest, crest_idx)
+
+    return heel_idx, crest_idx
+
+
+def ensemble_toe(X, Y, lo, hi):
+    """
+    Vectorized stretched sheet toe between two indices on each
+    member. Returns -1 where either index is -1
+
+    X: Array with the cross-shore distance values
+    Y: 2D array with one profile of elevations per row
+    lo: Array of ints with the index at one end of the sheet
+    hi: Array of ints with the index at the other end of the sheet
+    """
+
+    missing = (lo < 0) | (hi < 0)
+    toe_idx = mfuncs.find_toe_batch(Y, np.maximum(lo, 0), np.maximum(hi, 0), X=X)[0][:, 0]
+
+    return np.where(missing, -1, toe_idx)
+
+
+def ensemble_berm(X, Y, mhw_idx, toe_idx):
+    """
+    Vectorized mfuncs.find_berm(). Returns the berm
+    index of each member (-1 where there is no berm)
+
+    X: Array with the cross-shore distance values
+    Y: 2D array with one profile of elevations per row
+    mhw_idx: Array of ints with the MHW index of each member
+    toe_idx: Array of ints with the toe index of each member
+    """
+
+    rows = np.arange(len(Y))
+    columns = np.arange(Y.shape[1])
+    lo, hi = np.maximum(mhw_idx, 0), np.maximum(toe_idx, 0)
+
+    # Height of the profile above a line from MHW to the toe
+    run = X[hi] - X[lo]
+    step = np.divide(Y[rows, hi] - Y[rows, lo], run, out=np.zeros(len(Y)), where=run != 0)
+    height = Y - (Y[rows, lo][:, None] + (X - X[lo][:, None]) * step[:, None])
+
+    # The berm is the first peak above the line landward of MHW
+    inside = (columns > lo[:, None] + 1) & (columns < hi[:, None] - 1)
+    berm = local_peaks(height) & inside & (height > 0)
+    berm[mhw_idx < 0] = False
+
+    return first_true(berm)
+
+
+def ensemble_fence(X, Y, crest_idx, mhw_idx, fence_idx, min_gap=4):
+    """
+    Vectorized mfuncs.find_fence_crest(), mfuncs.find_fence_heel(), and
+    mfuncs.find_fence_toe(). Returns the fenced dune crest, heel, and toe
+    indices of each member (-1 where they are not found)
+
+    X: Array with the cross-shore distance values
+    Y: 2D array with one profile of elevations per row
+    crest_idx: Array of ints with the crest index of each member
+    mhw_idx: Array of ints with the MHW index of each member
+    fence_idx: Int with the fence index, or None if there is no fence
+    min_gap: Int with the fewest points between the fence and the crest
+    """
+
+    size, n = Y.shape
+    missing = np.full(size, -1)
+    if fence_idx is None:
+        return missing, missing, missing
+    columns = np.arange(n)
+
+    # Fenced dune crest
+    between = (columns > fence_idx) & (columns < crest_idx[:, None] - 1)
+    fence_crest = first_true(local_peaks(Y) & between)
+    fence_crest[crest_idx - fence_idx < min_gap] = -1
+
+    # Fenced dune heel
+    here, ahead = Y[:, :-1], Y[:, 1:]
+    start = np.where(fence_crest >= 0, fence_crest, n)
+    walking = (columns[:-1] >= start[:, None]) & (columns[:-1] < crest_idx[:, None])
+    rises = first_true(walking & (ahead > here), n)
+    steps = np.minimum(rises, np.maximum(crest_idx, start)) - start
+    fence_heel = np.where((fence_crest >= 0) & (steps > 0), start + steps, -1)
+
+    # Fenced dune toe
+    fence_toe = ensemble_toe(X, Y, mhw_idx, fence_crest)
+
+    return fence_crest, fence_heel, fence_toe
+
+
+"""
+Functions to run the ensemble
+"""
+
+
+def run_ensemble(X, y, mhw, pad, size=1000, model=None, fence_idx=None,
+                 threshold=0.6, crest_pct=0.2, rng=None):
+    """
+    Run the detectors and volumes on a Monte Carlo ensemble of a profile.
+    Returns a dict with an array of the values from every member for each
+    morphometric in METRICS (NaN where a member does not have it)
+
+    X: Array with the cross-shore distance values
+    y: Array with the elevation values
+    mhw: Float with the MHW elevation
+    pad: Float with the distance (+/-) around MHW to regress on
+    size: Int with the number of ensemble members (Default: 1000)
+    model: Dict from error_model() (Default: error_model())
+    fence_idx: Int with the fence index, or None if there is no fence
+    threshold: Float with the minimum backshore drop for the crest (Default: 0.6 m)
+    crest_pct: Float to check if a more seaward peak might be more appropriate
+    rng: NumPy random Generator (Default: None)
+    """
+
+    if model is None:
+        model = error_model()
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # Make the ensemble and the cumulative area under every member
+    Y = perturb(X, y, size, model, rng)
+    cumulative = np.zeros(Y.shape)
+    np.cumsum((Y[:, 1:] + Y[:, :-1]) / 2 * np.diff(X), axis=1, out=cumulative[:, 1:])
+    rows = np.arange(size)
+
+    # Find the landmarks in the same order as Automorph.py
+    idx = {}
+    idx['MHW'], foreshore_slope = ensemble_mhw(X, Y, mhw, pad)
+    crest_idx = ensemble_crest(Y, mhw, threshold, crest_pct)
+    idx['Heel'], idx['Crest'] = ensemble_heel(Y, crest_idx)
+    idx['Toe'] = ensemble_toe(X, Y, np.where(idx['MHW'] >= 0, idx['MHW'], 1), idx['Crest'])
+    idx['Berm'] = ensemble_berm(X, Y, idx['MHW'], idx['Toe'])
+    idx['Fence Crest'], idx['Fence Heel'], idx['Fence Toe'] =\
+        ensemble_fence(X, Y, idx['Crest'], idx['MHW'], fence_idx)
+
+    ensemble = {'Foreshore Slope': foreshore_slope}
+    for col in POSITIONS:
+        ensemble[f'X{col}'] = gather(X, idx[col])
+        ensemble[f'Y{col}'] = gather(Y, idx[col])
+
+    # Volumes. The base elevations are the lower of the two ends
+    beach_lo = np.maximum(idx['MHW'], 0)
+    fence_toe = idx['Fence Toe']
+    ensemble['Dune Volume'] = fill_volumes(
+        X, Y, cumulative, idx['Toe'], idx['Heel'],
+        np.minimum(ensemble['YToe'], ensemble['YHeel']))
+    ensemble['Beach Volume'] = fill_volumes(
+        X, Y, cumulative, beach_lo, idx['Toe'],
+        np.minimum(Y[rows, beach_lo], ensemble['YToe']))
+    ensemble['Fenced Dune Volume'] = fill_volumes(
+        X, Y, cumulative, fence_toe, idx['Fence Heel'],
+        np.minimum(ensemble['YFence Toe'], ensemble['YFence Heel']))
+    ensemble['Total Dune Volume'] = fill_volumes(
+        X, Y, cumulative, fence_toe, np.where(fence_toe >= 0, idx['Heel'], -1),
+        np.minimum(ensemble['YFence Toe'], ensemble['YHeel']))
+
+    # Volume above MHW. Members without MHW have no volume
+    base = np.where(idx['MHW'] >= 0, ensemble['YMHW'], np.inf)
+    ensemble['Profile Volume'] = -np.trapz(np.maximum(Y - base[:, None], 0), X, axis=1)
+
+    # Metrics made from the landmarks
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ensemble['Dune Height'] = ensemble['YCrest'] - ensemble['YToe']
+        ensemble['Dune Width'] = ensemble['XToe'] - ensemble['XHeel']
+        ensemble['Dune Aspect Ratio'] = ensemble['Dune Height'] / ensemble['Dune Width']
+        ensemble['Dune Face Slope'] = ensemble['Dune Height'] /\
+            (ensemble['XToe'] - ensemble['XCrest'])
+        ensemble['Beach Width'] = ensemble['XMHW'] - ensemble['XToe']
+        ensemble['Beach Slope'] = (ensemble['YToe'] - ensemble['YMHW']) /\
+            ensemble['Beach Width']
+
+    return ensemble
+
+
+def percentile_columns(percentiles):
+    """
+    Return the names of the columns the ensemble percentiles are stored in
+
+    percentiles: List of floats with the percentiles (0-100)
+    """
+
+    return [f'{metric} P{pct:g}' for metric in METRICS for pct in percentiles]
+
+
+def store_percentiles(morpho, ensemble, percentiles):
+    """
+    Place the percentiles of every morphometric in the ensemble into the
+    morpho dict. Members without a value are left out, and a morphometric
+    no member has gets NaN
+
+    morpho: Dict with morphometrics (made with the percentile_columns())
+    ensemble: Dict from run_ensemble()
+    percentiles: List of floats with the percentiles (0-100)
+    """
+
+    for metric in METRICS:
+        values = ensemble[metric]
+        values = values[np.isfinite(values)]
+        if len(values) > 0:
+            result = np.percentile(values, percentiles)
+        else:
+            result = np.full(len(percentiles), np.nan)
+        for pct, value in zip(percentiles, result):
+            morpho[f'{metric} P{pct:g}'].append(float(value))
+
+    return morpho